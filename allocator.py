@@ -1,3 +1,6 @@
+from formats import content_digest
+from profiler import profiled
+
 class AllocRange():
     def __init__(self, start, end=None, length=1):
         self.start = start
@@ -60,14 +63,19 @@ class Allocator():
                 
     def __init__(self):
         self.ranges = []
-        # Blocks - maps unique data block with multiple indexes (GC when empty)
-        # Index - maps unique index with corresponding data block
+        # Blocks - maps unique data block key with multiple indexes (GC when empty)
+        # Index - maps unique index with corresponding data block key
+        # Block data - maps data block key to the data itself
         # Addresses - keys should be kept identical to Index. caches addresses
         #             data blocks would have when the ROM is built.
+        # Block keys are content digests, so identical data shares a block.
         self.data_blocks = {}
         self.data_index = {}
+        self.block_data = {}
         
         self.data_is_packed = False
+        # Bumped on every change to ranges or data, for caches of derived views
+        self.version = 0
         
         # These attributes depend on allocate_data() to be accurate
         # and should not be accessed externally, only through a getter function
@@ -75,7 +83,10 @@ class Allocator():
         self.data_addresses = {}
         self.range_blocks = {}
         self.ranges_by_start_addr = {}
+        self.gaps = []
         self.out_of_room = False
+        # id -> (preferred address, key of the data found there); see pin
+        self.pins = {}
         
     def add(self, start_or_range, end=None, length=1):
         if isinstance(start_or_range, AllocRange):
@@ -99,10 +110,15 @@ class Allocator():
             result = r - release_range
             ranges.extend(result)
         self.ranges = ranges
-        self.data_is_packed = False
+        self.changed()
             
+    def changed(self):
+        self.data_is_packed = False
+        self.version += 1
+        
     # Function to handle merging overlapping ranges and
     # trimming forbidden ranges.
+    @profiled("alloc.crunch")
     def crunch(self):
         # First, forbidden ranges are trimmed, because subtraction during the
         # merge check would muck up the sorting if one range got split into 2.
@@ -134,35 +150,66 @@ class Allocator():
                 start = r.start
             end = max(end, r.end)
         self.ranges.append(AllocRange(start, end))
-        self.data_is_packed = False
+        self.changed()
 
-    def set_data(self, id, data):
+    def set_data(self, id, data, key=None):
         """
         Add or change a data bytestring managed by this allocator.
         Data blocks left without index pointers will be garbage collected.
         If data is None, removes the index pointer id from the allocator.
+        key identifies the content for deduplication; callers that already
+        hold a digest of the data (Sample/Sequence.digest) pass it in,
+        otherwise one is computed.
         """
-        data = bytes(data)
         if id in self.data_index:
-            old_data = self.data_index[id]
-            self.data_blocks[old_data].remove(id)
-            if not len(self.data_blocks[old_data]):
-                del self.data_blocks[old_data]
+            old_key = self.data_index[id]
+            self.data_blocks[old_key].remove(id)
+            if not len(self.data_blocks[old_key]):
+                del self.data_blocks[old_key]
+                del self.block_data[old_key]
         if data is None:
-            del self.data_index[id]
+            self.data_index.pop(id, None)
         else:
-            self.data_index[id] = data
-            if data in self.data_blocks:
-                self.data_blocks[data].append(id)
+            data = bytes(data)
+            if key is None:
+                key = content_digest(data)
+            self.data_index[id] = key
+            if key in self.data_blocks:
+                self.data_blocks[key].append(id)
             else:
-                self.data_blocks[data] = [id]
-        self.data_is_packed = False
+                self.data_blocks[key] = [id]
+                self.block_data[key] = data
+        self.changed()
+        
+    def get_data(self, id):
+        return self.block_data[self.data_index[id]]
     
+    def pin(self, id, addr):
+        # Ask for id's data to stay at addr (normally where it was found in
+        # the source ROM), as long as it still fits there. The data id has
+        # now is remembered as what's already at addr (see is_original).
+        self.pins[id] = (addr, self.data_index.get(id))
+        self.changed()
+        
+    def is_original(self, id, addr):
+        # True if id's current data is what it was pinned with, at addr
+        pin = self.pins.get(id)
+        return pin is not None and pin == (addr, self.data_index.get(id))
+        
+    @profiled("alloc.allocate_data")
     def allocate_data(self):
         """
-        Distribute data into data blocks (self.range_blocks).
-        This must be called for any free space or final data
-        requests to be accurate. Keys are range start addresses.
+        Assign addresses to data blocks. Placements are kept per range in
+        self.range_blocks as lists of (address, block key); keys are range
+        start addresses. This must be called for any free space or final
+        data requests to be accurate.
+        Pinned data that is still what was pinned (see is_original) goes
+        back to its address first; identical data pinned to several
+        addresses is kept at each of them, so an unmodified ROM builds back
+        unchanged. Pinned data that has changed then keeps its address if
+        that space is still free, so a block that grew can't push unchanged
+        data out of place. Everything else is packed first-fit into the
+        space left, in order of lowest id.
         Any data that could not be packed (not enough free space)
         will be collected in key None.
         """
@@ -170,32 +217,78 @@ class Allocator():
             return
         self.out_of_room = False
         self.data_addresses = {}
+        self.range_blocks = {r.start: [] for r in self.ranges}
+        self.ranges_by_start_addr = {r.start: r for r in self.ranges}
+        # free space as [start, end (exclusive), range start], in address order
+        self.gaps = [[r.start, r.end + 1, r.start] for r in self.ranges]
         sorted_data = sorted(self.data_blocks.items(), key=lambda x: min(x[1]))
-        range_bin = {r.start: bytearray() for r in self.ranges}
-        for bin, ids in sorted_data:
-            allocated = False
-            for range in self.ranges:
-                if len(bin) <= (range.length - len(range_bin[range.start])):
-                    addr = range.start + len(range_bin[range.start])
-                    range_bin[range.start] += bin
-                    allocated = True
-                    for id in ids:
-                        self.data_addresses[id] = addr
-                    break
-            if not allocated:
+        
+        # key -> ids not placed at a pinned address (yet)
+        left = {}
+        # (unchanged, key, address, ids pinned there)
+        pinned = []
+        for key, ids in sorted_data:
+            by_pin = {}
+            for id in ids:
+                if id in self.pins:
+                    by_pin.setdefault(self.pins[id][0], []).append(id)
+            left[key] = [id for id in ids if id not in self.pins]
+            for addr, pinned_ids in sorted(by_pin.items()):
+                unchanged = any(self.pins[id][1] == key for id in pinned_ids)
+                pinned.append((unchanged, key, addr, pinned_ids))
+        
+        # key -> first address it was placed at
+        placed = {}
+        for unchanged_pass in (True, False):
+            for unchanged, key, addr, pinned_ids in pinned:
+                if unchanged != unchanged_pass:
+                    continue
+                # changed data already placed elsewhere doesn't need a copy
+                if (not unchanged and key in placed) or \
+                        self.take_space(key, len(self.block_data[key]), addr) is None:
+                    left[key].extend(pinned_ids)
+                    continue
+                placed.setdefault(key, addr)
+                for id in pinned_ids:
+                    self.data_addresses[id] = addr
+                
+        for key, ids in sorted_data:
+            addr = placed.get(key)
+            if addr is None:
+                addr = self.take_space(key, len(self.block_data[key]))
+            if addr is None:
                 self.out_of_room = True
-                if None not in range_bin:
-                    range_bin[None] = bytearray()
-                range_bin[None] += bin
-        self.range_blocks = range_bin
-        self.ranges_by_start_addr = {r.start: r for r in self.ranges}
-        self.data_is_packed = True    
+                self.range_blocks.setdefault(None, []).append((None, key))
+                continue
+            for id in left[key]:
+                self.data_addresses[id] = addr
+        for placements in self.range_blocks.values():
+            placements.sort(key=lambda x: -1 if x[0] is None else x[0])
+        self.data_is_packed = True
+        
+    def take_space(self, key, length, addr=None):
+        # Claims length bytes of free space for block key, at addr or
+        # wherever it first fits. Returns the address, or None.
+        for i, gap in enumerate(self.gaps):
+            start, end, range_start = gap
+            if addr is None:
+                if end - start < length:
+                    continue
+                at = start
+            elif start <= addr and addr + length <= end:
+                at = addr
+            else:
+                continue
+            pieces = []
+            if at > start:
+                pieces.append([start, at, range_start])
+            if at + length < end:
+                pieces.append([at + length, end, range_start])
+            self.gaps[i:i+1] = pieces
+            self.range_blocks[range_start].append((at, key))
+            return at
+        return None
         
-        #print("sorted data:")
-        #for bin, ids in sorted_data:
-        #    print(f"    {min(ids)} - full ids {ids} - data len {len(bin):4X} - addr $" +
-        #            (f"{self.data_addresses[ids[0]]:06X}" if ids[0] in self.data_addresses else "None"))
-            
     def get_space_usage(self, r_start):
         """
         Retrieve the amount of used and free space
@@ -204,27 +297,29 @@ class Allocator():
         if not self.data_is_packed:
             self.allocate_data()
         if r_start is None:
-            return (len(self.range_blocks[None]), 0)
+            return (self.block_bytes(None), 0)
         range = self.ranges_by_start_addr[r_start]
-        used = len(self.range_blocks[range.start])
+        used = self.block_bytes(range.start)
         free = range.length - used
         return (used, free)
         
+    def block_bytes(self, r_start):
+        return sum(len(self.block_data[key]) for _, key in self.range_blocks.get(r_start, ()))
+        
     def repr_total_usage(self):
         if not self.data_is_packed:
             self.allocate_data()
         used, free = 0, 0
-        maxfree = 0
         for range in self.ranges:
             u, f = self.get_space_usage(range.start)
             used += u
             free += f
-            maxfree = max(maxfree, f)
+        maxfree = max((end - start for start, end, _ in self.gaps), default=0)
         if self.out_of_room:
-            used += len(self.range_blocks[None])
+            used += self.block_bytes(None)
             text = (f"${used:X} bytes used\n"
                     f"**WARNING** Not enough space!\n"
-                    f"Unplaced data: ${len(self.range_blocks[None]):X} bytes\n"
+                    f"Unplaced data: ${self.block_bytes(None):X} bytes\n"
                     f"largest free block open: ${maxfree:X} bytes")
         else:
             text = (f"${used:X} bytes used\n"
@@ -241,6 +336,9 @@ class Allocator():
             return None
         
     def get_all_data(self):
+        # (address, data) for every placed block, in address order
         if not self.data_is_packed:
             self.allocate_data()
-        return self.range_blocks
+        placed = [(addr, self.block_data[key]) for start, blocks in self.range_blocks.items()
+                if start is not None for addr, key in blocks]
+        return sorted(placed, key=lambda x: x[0])
@@ -0,0 +1,188 @@
+import numpy as np
+
+from brr import BLOCK_SAMPLES, BLOCK_BYTES, encode_brr_multi, resample_pcm
+from formats import load_rom_data_block
+from messenger import log, err
+from sample import Sample, Envelope, scale_to_pitch
+
+# SPC RAM budgeting for a sequence's instruments.
+#
+# The driver loads the static samples at brr_spc_ram_address, immediately
+# followed by the sample data for the current sequence's 16 instruments.
+# The echo buffer ends at spc_echo_end_address and grows downward with EDL.
+# Whatever lies in between is all the room the instruments have.
+
+# Resampling ratios tried for each sample when fitting, largest first.
+FIT_RATIOS = (15/16, 7/8, 5/6, 3/4, 2/3, 5/8, 9/16, 1/2)
+# Lowest pitch scale the pitch table can express (see get_pitch_as_scale)
+MIN_PITCH_SCALE = 0.5
+
+def echo_buffer_size(edl):
+    # EDL 0 still reserves 4 bytes
+    return edl * 0x800 if edl else 4
+
+class AramBudget():
+    def __init__(self, prj):
+        fmt = prj.format
+        static_brr = load_rom_data_block(prj.src.rom(), fmt.spc_static_brr_address)
+        self.edl = prj.src.edl
+        self.static_size = len(static_brr)
+        self.start = fmt.brr_spc_ram_address + self.static_size
+        self.echo_start = fmt.spc_echo_end_address - echo_buffer_size(self.edl)
+        self.size = self.echo_start - self.start
+
+    def overflow(self, prj, seqid):
+        return max(0, sequence_brr_size(prj, seqid) - self.size)
+
+def sequence_brr_size(prj, seqid):
+    # Total size of the instrument samples build_spc loads for this sequence.
+    # Every slot gets its own copy, even if it repeats another slot's sample.
+    seq = prj.seq[seqid]
+    return sum(len(prj.brr[inst_id].data) for inst_id in seq.inst.values() if inst_id)
+
+class FitOption():
+    def __init__(self, ratio, length, loop, saved, error):
+        self.ratio = ratio
+        self.length = length
+        self.loop = loop
+        self.saved = saved
+        self.error = error
+
+def get_fit_options(smp, uses=1):
+    """
+    List ways to shrink a sample by resampling it, along with the bytes each
+    would save (across all its uses) and the squared error it would add,
+    estimated by resampling back up and comparing with the original.
+    Looped samples keep a loop length that is a whole number of blocks.
+    """
+    pcm = np.asarray(smp.get_single_pass_pcm(), dtype=np.float64)
+    scale = smp.get_pitch_as_scale()
+    loop = (smp.loop // BLOCK_BYTES) * BLOCK_SAMPLES if smp.is_looped else None
+    if loop is not None and loop >= len(pcm):
+        loop = None
+    options = []
+    lengths = set()
+    for ratio in FIT_RATIOS:
+        if loop is not None:
+            looplen = len(pcm) - loop
+            newlooplen = max(BLOCK_SAMPLES,
+                    round(looplen * ratio / BLOCK_SAMPLES) * BLOCK_SAMPLES)
+            ratio = newlooplen / looplen
+            newloop = round(loop * ratio)
+            length = newloop + newlooplen
+            # the loop start gets block aligned by padding the front
+            blocks = -(-newloop // BLOCK_SAMPLES) + newlooplen // BLOCK_SAMPLES
+        else:
+            length = max(BLOCK_SAMPLES, round(len(pcm) * ratio))
+            newloop = None
+            blocks = -(-length // BLOCK_SAMPLES)
+        if scale * ratio < MIN_PITCH_SCALE:
+            break
+        saved = len(smp.data) - blocks * BLOCK_BYTES
+        if saved <= 0 or length in lengths:
+            continue
+        lengths.add(length)
+        down, _ = resample_pcm(pcm, ratio, loop=loop, length=length)
+        up, _ = resample_pcm(down, len(pcm) / length, loop=newloop, length=len(pcm))
+        error = float(np.sum((pcm - up) ** 2))
+        options.append(FitOption(ratio, length, newloop, saved * uses, error))
+    return options
+
+def fit_sequence_samples(prj, seqid, apply=True):
+    """
+    Shrink the instruments of a sequence until they fit in SPC RAM, by
+    downsampling and re-encoding the samples where that costs the least
+    error per byte saved. Pitch is lowered by the same ratio, so notes
+    still play at the same pitch.
+    Returns a dict of sample id -> replacement Sample (empty if it already
+    fits), or None if it can't be made to fit. With apply, the replacements
+    are also put into the project (see apply_fit).
+    """
+    budget = AramBudget(prj)
+    over = budget.overflow(prj, seqid)
+    if not over:
+        return {}
+
+    uses = {}
+    for inst_id in prj.seq[seqid].inst.values():
+        if inst_id:
+            uses[inst_id] = uses.get(inst_id, 0) + 1
+    options = {idx: get_fit_options(prj.brr[idx], count) for idx, count in uses.items()}
+
+    # Greedy search: repeatedly take whichever step (to any further option of
+    # any sample) adds the least error per extra byte saved.
+    chosen = {}
+    saved = 0
+    while saved < over:
+        best = None
+        for idx, opts in options.items():
+            cur = chosen.get(idx)
+            cur_saved = opts[cur].saved if cur is not None else 0
+            cur_error = opts[cur].error if cur is not None else 0.0
+            for j in range(0 if cur is None else cur + 1, len(opts)):
+                gain = opts[j].saved - cur_saved
+                if gain <= 0:
+                    continue
+                cost = max(0.0, opts[j].error - cur_error) / gain
+                if best is None or cost < best[0]:
+                    best = (cost, idx, j, gain)
+        if best is None:
+            err.send(f"Can't fit the samples for sequence {seqid:02X} into SPC RAM: "
+                    f"${over - saved:X} bytes over even at lowest quality.")
+            return None
+        _, idx, j, gain = best
+        chosen[idx] = j
+        saved += gain
+
+    sources = []
+    for idx, j in chosen.items():
+        opt = options[idx][j]
+        pcm = np.asarray(prj.brr[idx].get_single_pass_pcm(), dtype=np.float64)
+        loop = (prj.brr[idx].loop // BLOCK_BYTES) * BLOCK_SAMPLES if opt.loop is not None else None
+        down, _ = resample_pcm(pcm, opt.ratio, loop=loop, length=opt.length)
+        # decoded sample values are 15-bit; the encoder takes 16-bit
+        sources.append((np.round(down * 2), opt.loop))
+    encoded = encode_brr_multi(sources)
+
+    replacements = {}
+    for (idx, j), (data, loop, ratio) in zip(chosen.items(), encoded):
+        old = prj.brr[idx]
+        scale = old.get_pitch_as_scale() * options[idx][j].ratio * ratio
+        env = Envelope(old.env.a, old.env.d, old.env.s, old.env.r)
+        smp = Sample(data, loop, scale_to_pitch(scale), env, id=idx)
+        smp.name = old.name
+        replacements[idx] = smp
+        log.send(f"Resampled {idx:02X} {old.name} to {options[idx][j].ratio:.0%}: "
+                f"${len(old.data):X} -> ${len(data):X} bytes")
+
+    if apply:
+        apply_fit(prj, seqid, replacements)
+    return replacements
+
+def apply_fit(prj, seqid, replacements):
+    # Samples only this sequence uses are replaced. A sample other sequences
+    # also use is left to them: its replacement goes into an empty sample
+    # slot, and this sequence's instruments are pointed there. If there's no
+    # empty slot left, it's replaced for everyone, with a warning.
+    free = [idx for idx in prj.unused_samples() if f"brr{idx:02X}" not in prj.alloc.data_index]
+    prj.history.begin_group("Fit samples to ARAM")
+    for idx, smp in replacements.items():
+        users = prj.get_sample_users(idx)
+        others = sorted({s for s, _ in users if s != seqid})
+        if not others:
+            prj.replace_sample(idx, smp)
+            continue
+        names = ", ".join(f"{s:02X}" for s in others)
+        if not free:
+            prj.replace_sample(idx, smp)
+            log.send(f"No empty sample slot for the resampled {idx:02X}: replaced it, "
+                    f"which also affects sequences {names}.")
+            continue
+        slot_id = free.pop(0)
+        prj.replace_sample(slot_id, smp)
+        for s, slot in users:
+            if s == seqid:
+                prj.set_seq_inst(seqid, slot, slot_id)
+        log.send(f"Put the resampled {idx:02X} in slot {slot_id:02X} for sequence "
+                f"{seqid:02X}; sequences {names} keep the original.")
+    prj.history.end_group()
@@ -1,10 +1,17 @@
 import audioop
 import math
+import queue
+import threading
+from collections import OrderedDict
 
 import pygame
 
 ROOT_NOTE_KEY = 69 # A5
 SAMPLE_MIN_SIZE = 512 * 64
+# Rendered notes kept for the preview piano
+NOTE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Keys on either side of a played note to render ahead of time
+NOTE_CACHE_PREWARM_RANGE = 2
 
 class no():
     def __init__(self):
@@ -17,20 +24,119 @@ class no():
         return self._audio
 NO = no()
 
+def render_pitched(sample, key):
+    # Resample a sample's onset and loop to play at the given key, returning
+    # pygame Sounds for each and the number of bytes they hold.
+    onset, loopdata = sample.get_split_loop_pcm()
+    rate = int(32000 * unity_key_to_scale(key) * (1 / sample.get_pitch_as_scale()))
+    onset, cvstate = audioop.ratecv(onset, 2, 1, 32000, rate, None)
+    loopdata, cvstate = audioop.ratecv(loopdata, 2, 1, 32000, rate, cvstate)
+    # Samples are stored mono; the mixer runs in stereo.
+    onset = audioop.tostereo(onset, 2, 1, 1)
+    loopdata = audioop.tostereo(loopdata, 2, 1, 1)
+    
+    if sample.is_looped and loopdata:
+        loopdata = loopdata * -(-SAMPLE_MIN_SIZE // len(loopdata))
+    
+    return (pygame.mixer.Sound(buffer=onset), pygame.mixer.Sound(buffer=loopdata),
+            len(onset) + len(loopdata))
+
+class PitchedNoteCache():
+    """
+    LRU cache of rendered (onset, loop) Sounds, keyed by sample content,
+    loop point, pitch and key, limited to max_bytes of audio in total.
+    Neighbouring keys of a played note are rendered on a background thread
+    so a run of notes rarely has to wait for resampling.
+    """
+    def __init__(self, max_bytes=NOTE_CACHE_MAX_BYTES, prewarm_range=NOTE_CACHE_PREWARM_RANGE):
+        self.max_bytes = max_bytes
+        self.prewarm_range = prewarm_range
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.worker = None
+        self.hits = 0
+        self.misses = 0
+        
+    def make_key(self, sample, key):
+        return (sample.digest, sample.loop, sample.pitch, key)
+        
+    def get(self, sample, key):
+        ckey = self.make_key(sample, key)
+        with self.lock:
+            entry = self.entries.get(ckey)
+            if entry is not None:
+                self.entries.move_to_end(ckey)
+                self.hits += 1
+        if entry is None:
+            self.misses += 1
+            entry = render_pitched(sample, key)
+            self.store(ckey, entry)
+        self.prewarm(sample, key)
+        return entry[0], entry[1]
+        
+    def store(self, ckey, entry):
+        with self.lock:
+            if ckey in self.entries:
+                return
+            self.entries[ckey] = entry
+            self.size += entry[2]
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old[2]
+                
+    def prewarm(self, sample, key):
+        if not self.prewarm_range:
+            return
+        for d in range(1, self.prewarm_range + 1):
+            for k in (key + d, key - d):
+                if 0 <= k < 128:
+                    self.pending.put((sample, k))
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self.prewarm_worker, daemon=True)
+            self.worker.start()
+            
+    def prewarm_worker(self):
+        while True:
+            sample, key = self.pending.get()
+            ckey = self.make_key(sample, key)
+            with self.lock:
+                if ckey in self.entries:
+                    continue
+            try:
+                self.store(ckey, render_pitched(sample, key))
+            except pygame.error:
+                # mixer not (or no longer) initialized
+                pass
+                
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            
+note_cache = PitchedNoteCache()
+
 class PianoState():
-    def __init__(self, play_audio = False):
+    # With a mixer (see mixer.py), notes are voices rendered in software;
+    # otherwise each note gets its own pygame channel through KeyOnState.
+    def __init__(self, play_audio = False, mixer = None):
         keys = {}
         for i in range(128):
             keys[i] = False
         self.keys = keys
         self.play_audio = play_audio
+        self.mixer = mixer
         self.sample = None
         self.last_mouse_key = None
         
     def key_on(self, key, sample=None):
         if sample is not None:
             self.sample = sample
-        if self.play_audio:
+        if self.play_audio and self.mixer is not None:
+            if not (self.keys[key] and self.keys[key].active):
+                self.keys[key] = self.mixer.key_on(self.sample, key)
+        elif self.play_audio:
             if not self.keys[key]:
                 self.keys[key] = KeyOnState(self.sample, key)
             self.keys[key].key_on(self.sample, key)
@@ -45,16 +151,9 @@ class PianoState():
                 pass
         #self.keys[key] = False
         
-    def read_midi(self, sample, message_queue):
-        for message, delta in message_queue:
-            type = message[0]
-            if type in range(0x80, 0x90):
-                self.key_off(message[1])
-            elif type in range(0x90, 0xA0):
-                self.key_on(message[1], sample=sample)
-                # Velocity is in message[2] if we ever decide to add that
-                
     def sustain(self):
+        if self.mixer is not None:
+            self.mixer.update()
         for i in range(128):
             try:
                 self.keys[i].hold()
@@ -97,36 +196,22 @@ class KeyOnState():
         
         self.start_time = pygame.time.get_ticks()
         self.delta_time = 0
-        self.peak_time = 1
-        self.shift_time = 2
-        self.zero_time = 3
+        self.env = sample.env
         self.key_off_time = None
-        self.key_off_level = 1.0
-        self.key_off_rate = 100
-        self.sustain_level = 1.0
-        self.onset_, self.loopdata_ = sample.get_split_loop_pcm()
+        self.key_off_level = 0
         
         self.init_pitched()
         
     def init_pitched(self):
-        self.cvstate = None
-        rate = int(32000 * unity_key_to_scale(self.key) * (1 / self.smp.get_pitch_as_scale()))
-        self.onset, self.cvstate = audioop.ratecv(self.onset_, 2, 2, 32000, rate, self.cvstate)
-        self.loopdata, self.cvstate = audioop.ratecv(self.loopdata_, 2, 2, 32000, rate, self.cvstate)
-        
-        if self.smp.is_looped:
-            self.loopdata = bytearray(self.loopdata)
-            base_loopdata = bytes(self.loopdata)
-            while len(self.loopdata) < SAMPLE_MIN_SIZE:
-                self.loopdata = self.loopdata + base_loopdata
-        
-        self.pyg_sound = pygame.mixer.Sound(buffer=self.onset)
-        self.pyg_loop = pygame.mixer.Sound(buffer=self.loopdata)
+        # Pitch or loop may have been edited since the last note; the cache
+        # key covers both, so this is a lookup unless something changed.
+        self.pyg_sound, self.pyg_loop = note_cache.get(self.smp, self.key)
         
     def key_off(self):
         if self.active and not self.fadeout:
-            self.key_off_level = self.calc_env_level()
-            self.key_off_time = pygame.time.get_ticks() - self.start_time
+            self.delta_time = pygame.time.get_ticks() - self.start_time
+            self.key_off_level = self.calc_env_units()
+            self.key_off_time = self.delta_time
         self.active = False
         self.fadeout = True
         
@@ -162,17 +247,15 @@ class KeyOnState():
                 pass
                     
     def calc_envelope(self):
-        env = self.smp.env
-        self.peak_time = env.attack_time()
-        self.sustain_level = env.sustain_level()
-        self.shift_time = env.decay_time() + self.peak_time
-        self.zero_time = None if not env.release_time() else (env.release_time() + self.shift_time)
+        self.env = self.smp.env
         
-    def calc_env_level(self):
+    def calc_env_units(self):
+        # Hardware envelope value (0 - 0x7FF) at the current time
+        t = self.delta_time * 32 # samples per ms
         if self.fadeout:
-            fade_per_frame = self.key_off_level / self.key_off_rate
             try:
-                level = self.key_off_level - (fade_per_frame * (self.delta_time - self.key_off_time))
+                level = int(self.env.release_levels(self.key_off_level,
+                        t - self.key_off_time * 32))
             except TypeError:
                 level = 0
             if level <= 0:
@@ -180,20 +263,10 @@ class KeyOnState():
                 level = 0
             return level
         else:
-            if self.delta_time < self.peak_time:
-                level = self.delta_time / self.peak_time
-            elif self.delta_time < self.shift_time:
-                pct = ((self.delta_time - self.peak_time) / self.shift_time)
-                level_delta = 1.0 - self.sustain_level
-                level = ((1 - pct) * level_delta) + self.sustain_level
-            elif self.zero_time is None:
-                level = self.sustain_level
-            elif self.delta_time < self.zero_time:
-                pct = ((self.delta_time - self.shift_time) / self.zero_time)
-                level = (1 - pct) * self.sustain_level
-            else:
-                level = 0
-            return level
+            return self.env.level(t)
+        
+    def calc_env_level(self):
+        return self.calc_env_units() / 0x800
             
 def unity_key_to_scale(key):
     delta = ROOT_NOTE_KEY - key
@@ -0,0 +1,78 @@
+# Quality / speed comparison of brr.encode_brr against a naive encoder
+# (filter 0 only, shift picked from each block's peak).
+# Run from the repository root:  python bench/bench_brr_encode.py
+
+import math
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+
+import messenger
+from brr import BLOCK_SAMPLES, BLOCK_BYTES, encode_brr, prepare_pcm
+from sample import Sample
+
+def naive_encode(pcm):
+    target, _, _ = prepare_pcm(pcm)
+    out = bytearray()
+    for b in range(len(target) // BLOCK_SAMPLES):
+        block = target[b*BLOCK_SAMPLES:(b+1)*BLOCK_SAMPLES]
+        peak = int(np.abs(block).max())
+        shift = 0
+        while shift < 12 and 7 * (1 << shift) >> 1 < peak:
+            shift += 1
+        step = (1 << shift) / 2 if shift else 0.5
+        nyb = np.clip(np.floor(block / step + 0.5), -8, 7).astype(np.int64) & 0xF
+        out.append(shift << 4)
+        out += ((nyb[0::2] << 4) | nyb[1::2]).astype(np.uint8).tobytes()
+    out[-BLOCK_BYTES] |= 1
+    return bytes(out)
+
+def decode(data):
+    dec = Sample()
+    pcm, pre, prepre = [], 0, 0
+    for loc in range(0, len(data), BLOCK_BYTES):
+        block, pre, prepre = dec.decode_block(data[loc:loc+BLOCK_BYTES], pre, prepre)
+        pcm.extend(block)
+    return np.array(pcm, dtype=np.float64)
+
+def snr(pcm, data):
+    target, _, _ = prepare_pcm(pcm)
+    decoded = decode(data)[:len(target)]
+    noise = np.sum((target - decoded) ** 2)
+    return 10 * math.log10(np.sum(target.astype(np.float64) ** 2) / max(noise, 1))
+
+def signals(length):
+    t = np.arange(length) / 32000
+    rng = np.random.default_rng(6)
+    yield "sine 440", 20000 * np.sin(2 * math.pi * 440 * t)
+    yield "harmonic decay", np.exp(-t * 3) * sum(
+            (9000 / h) * np.sin(2 * math.pi * 220 * h * t) for h in range(1, 8))
+    yield "lowpass noise", np.convolve(rng.normal(0, 6000, length), np.ones(8) / 2, "same")
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return ret, time.perf_counter() - start
+
+def main():
+    messenger.init_meta()
+    length = 16000
+    print(f"{'signal':<16}{'naive SNR':>11}{'search SNR':>12}{'naive s':>10}{'search s':>10}")
+    for name, pcm in signals(length):
+        pcm = np.round(pcm).astype(np.int16)
+        naive, tn = timed(naive_encode, pcm)
+        (best, _, _), tb = timed(encode_brr, pcm, processes=1)
+        print(f"{name:<16}{snr(pcm, naive):>10.1f}dB{snr(pcm, best):>10.1f}dB{tn:>10.3f}{tb:>10.3f}")
+
+    long = np.round(next(signals(32000 * 8))[1]).astype(np.int16)
+    (data, _, _), t1 = timed(encode_brr, long, processes=1)
+    (_, _, _), tp = timed(encode_brr, long)
+    print(f"\n8s sample, segmented: {snr(long, data):.1f}dB, "
+            f"1 process {t1:.2f}s, process pool {tp:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Time taken by Project.build_rom, unmodified and after edits, and by
+# making IPS and BPS patches from each build.
+# Run from the repository root:  python bench/bench_build.py path/to/rom.smc
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import messenger
+from patch import make_ips, make_bps
+from project import Project
+from rom import Rom
+from sample import Sample
+
+def timed_build(prj, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        # as after any edit, placement is redone
+        prj.alloc.changed()
+        out, dirty = prj.build_rom()
+    return (time.perf_counter() - start) / runs, out, dirty
+
+def timed_patch(make, source, target, hints):
+    start = time.perf_counter()
+    data = make(source, target, hints)
+    return time.perf_counter() - start, len(data)
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python bench/bench_build.py ROM")
+        return 2
+    messenger.init_meta()
+    rom = Rom(sys.argv[1])
+    if not rom.is_valid:
+        print(f"{sys.argv[1]}: not a supported ROM")
+        return 2
+    prj = Project("bench", rom)
+    start = time.perf_counter()
+    for _ in prj.init_steps():
+        pass
+    print(f"load: {(time.perf_counter() - start) * 1000:.1f}ms, "
+            f"{len(prj.seq)} sequences, {len(prj.get_samples())} samples, ROM ${len(rom.rom()):X} bytes")
+    print(f"{'case':<28}{'ms/build':>10}{'writes':>8}{'bytes':>10}"
+            f"{'ips ms':>9}{'ips size':>10}{'bps ms':>9}{'bps size':>10}")
+    header = rom.header or b""
+    source = header + rom.rom()
+
+    def report(case, runs=10):
+        elapsed, out, dirty = timed_build(prj, runs)
+        hints = [(len(header) + offset, length) for offset, length in dirty]
+        ips_time, ips_size = timed_patch(make_ips, source, out, hints)
+        bps_time, bps_size = timed_patch(make_bps, source, out, hints)
+        print(f"{case:<28}{elapsed * 1000:>10.2f}{len(dirty):>8}{sum(n for _, n in dirty):>10}"
+                f"{ips_time * 1000:>9.2f}{ips_size:>10}{bps_time * 1000:>9.2f}{bps_size:>10}")
+
+    report("unmodified")
+    for idx in sorted(prj.get_samples()):
+        prj.set_smp_pitch(idx, prj.brr[idx].pitch + 1)
+    report("all pitches changed")
+    # shrinking every other sample leaves them in place; the rest keep theirs
+    for idx in sorted(prj.get_samples())[::2]:
+        smp = prj.brr[idx]
+        if len(smp.data) > 18:
+            prj.replace_sample(idx, Sample(smp.data[-18:], 0, smp.pitch, smp.env, lookup=False))
+    report("half the samples replaced")
+    # grown samples no longer fit where they were and move to free space
+    prj.add_range(len(rom.rom()) - 0x10000, len(rom.rom()) - 1)
+    for idx in sorted(prj.get_samples())[1::8]:
+        smp = prj.brr[idx]
+        head = bytearray(smp.data)
+        head[-9] &= 0xFC
+        prj.replace_sample(idx, Sample(bytes(head) + smp.data, 0, smp.pitch, smp.env, lookup=False))
+    report("some samples grown")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
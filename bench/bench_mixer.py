@@ -0,0 +1,62 @@
+# Render cost of mixer.Mixer with many simultaneous voices, against the
+# real-time budget for one block.
+# Run from the repository root:  python bench/bench_mixer.py
+
+import math
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+
+import messenger
+from brr import encode_brr
+from mixer import Mixer, MIXER_RATE, BLOCK_SIZE
+from sample import Sample, Envelope
+
+def make_samples():
+    t = np.arange(MIXER_RATE) / MIXER_RATE
+    tone = 12000 * np.sin(2 * math.pi * 440 * t) * np.exp(-t * 2)
+    data, _, _ = encode_brr(np.round(tone).astype(np.int16), processes=1)
+    oneshot = Sample(data, 0, env=Envelope(15, 7, 7, 0))
+    loop = np.round(12000 * np.sin(2 * math.pi * np.arange(256) / 64)).astype(np.int16)
+    data, loopofs, _ = encode_brr(loop, loop=128, processes=1)
+    looped = Sample(data, loopofs, env=Envelope(10, 4, 5, 0))
+    return oneshot, looped
+
+def bench(mixer, blocks):
+    start = time.perf_counter()
+    for _ in range(blocks):
+        mixer.render()
+    return (time.perf_counter() - start) / blocks
+
+def main():
+    messenger.init_meta()
+    samples = make_samples()
+    budget = BLOCK_SIZE / MIXER_RATE
+    print(f"block {BLOCK_SIZE} samples = {budget * 1000:.1f}ms real time")
+    print(f"{'voices':>8}{'ms/block':>10}{'% budget':>10}")
+    for voices in (1, 8, 32, 64, 128):
+        # looped voices, held for the whole run, so none drop out
+        mixer = Mixer(max_voices=voices)
+        for v in range(voices):
+            mixer.key_on(samples[1], 40 + v % 48)
+        elapsed = bench(mixer, 50)
+        assert len(mixer.voices) == voices
+        print(f"{voices:>8}{elapsed * 1000:>10.2f}{elapsed / budget:>10.1%}")
+
+    # one-shots, half released partway through
+    mixer = Mixer()
+    for v in range(64):
+        mixer.key_on(samples[v % 2], 40 + v % 48)
+    mixer.render()
+    for voice in mixer.voices[::2]:
+        voice.key_off()
+    elapsed = bench(mixer, 50)
+    print(f"\n64 mixed one-shot/looped, half released: {elapsed * 1000:.2f}ms/block, "
+            f"{len(mixer.voices)} voices left")
+
+if __name__ == "__main__":
+    main()
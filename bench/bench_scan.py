@@ -0,0 +1,36 @@
+# Time taken to identify every ROM file in a directory, compared with
+# reading each file in full.
+# Run from the repository root:  python bench/bench_scan.py path/to/roms
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scanner import scan_directory
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python bench/bench_scan.py DIRECTORY")
+        return 2
+    start = time.perf_counter()
+    results = list(scan_directory(sys.argv[1]))
+    scan_time = time.perf_counter() - start
+    valid = sum(r.valid for r in results)
+
+    start = time.perf_counter()
+    total = 0
+    for result in results:
+        with open(result.fn, "rb") as f:
+            total += len(f.read())
+    read_time = time.perf_counter() - start
+
+    count = max(len(results), 1)
+    print(f"{len(results)} files, {valid} supported ROMs, ${total:X} bytes")
+    print(f"scan:      {scan_time * 1000:>10.1f}ms  {scan_time * 1e6 / count:>8.1f}us/file")
+    print(f"full read: {read_time * 1000:>10.1f}ms  {read_time * 1e6 / count:>8.1f}us/file")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
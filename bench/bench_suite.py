@@ -0,0 +1,152 @@
+# Headless benchmark suite on synthetic ROMs (see fixtures.py).
+#
+# Each case runs once as a first run and then `runs` more times warm; the
+# warm figure is the median. The first run is the case's first call, not a
+# cold start: the fixture's project is loaded before any case is timed, so
+# whatever loading fills (decoded samples, imported modules) is already in
+# place. Every case is run at each fixture scale, so its cost can be seen
+# growing with the amount of data (the 10x scale takes about a minute, and
+# only runs when asked for).
+#
+# Run from the repository root:
+#   python bench/bench_suite.py [--runs N] [--scale NAME] [--json FILE]
+# The JSON output records the commit and environment along with the
+# timings, for comparing runs across commits.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import messenger
+from allocator import Allocator
+from fixtures import PRESETS, write_rom
+from formats import trim_sequence_ends
+from project import Project
+from rom import Rom
+from sample import walk_brr
+from spcfile import build_spc
+
+# fixture arguments (see fixtures.make_rom)
+SCALES = {
+    "small": dict(sequences=8, samples=16, max_blocks=50, max_seq_length=200),
+    "default": dict(sequences=16, samples=48, max_blocks=200, max_seq_length=400),
+    "large": dict(sequences=32, samples=64, max_blocks=300, max_seq_length=1500),
+    # every table slot used, ten times the vanilla game's data; slow, so
+    # only run when asked for
+    "10x": PRESETS["10x"],
+    }
+DEFAULT_SCALES = ("small", "default", "large")
+
+def load_project(fn):
+    prj = Project("bench", Rom(fn))
+    for _ in prj.init_steps():
+        pass
+    return prj
+
+def table_samples(prj):
+    # (not the empty slots)
+    return [smp for idx, smp in sorted(prj.brr.items()) if idx < 256 and smp.source_type == "rom"]
+
+def alloc_blocks(prj):
+    # (id, address, data, key) for everything the project's allocator holds
+    alloc = prj.alloc
+    return [(id, alloc.pins[id][0], alloc.get_data(id), key)
+            for id, key in alloc.data_index.items() if id in alloc.pins]
+
+def allocate(blocks):
+    alloc = Allocator()
+    for id, addr, data, key in blocks:
+        alloc.add(addr, length=len(data))
+        alloc.set_data(id, data, key=key)
+        alloc.pin(id, addr)
+    alloc.crunch()
+    alloc.allocate_data()
+    return alloc
+
+def cases(fn, prj):
+    # name: (items, function)
+    samples = table_samples(prj)
+    seqs = list(prj.seq.values())
+    blocks = alloc_blocks(prj)
+    return {
+        "load": (1, lambda: load_project(fn)),
+        "sample_decode": (len(samples),
+                lambda: [s.decode_brr(s.data, s.loop, extend=True) for s in samples]),
+        "walk_brr": (len(samples), lambda: [walk_brr(s.data) for s in samples]),
+        "akao_to_mml": (len(seqs), lambda: [s.update_raw_mml() for s in seqs]),
+        "trim_sequence_ends": (len(seqs), lambda: [trim_sequence_ends(s.data) for s in seqs]),
+        "allocator": (len(blocks), lambda: allocate(blocks)),
+        "build_spc": (len(seqs), lambda: [build_spc(prj, i) for i in prj.seq]),
+        "serialize": (1, prj.serialize),
+        }
+
+def timed(func, runs):
+    times = []
+    for _ in range(runs + 1):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times[0], times[1:]
+
+def commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                cwd=Path(__file__).resolve().parent, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmarks on synthetic ROMs.")
+    parser.add_argument("--runs", type=int, default=5, help="warm runs per case")
+    parser.add_argument("--scale", choices=SCALES, action="append",
+            help=f"fixture scale to run (default: {', '.join(DEFAULT_SCALES)})")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    messenger.init_meta()
+    results = []
+    print(f"{'scale':<9}{'case':<20}{'items':>7}{'first ms':>11}{'warm ms':>11}{'us/item':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scale or DEFAULT_SCALES:
+            fn = write_rom(os.path.join(tmp, f"{scale}.smc"), **SCALES[scale])
+            prj = load_project(fn)
+            for case, (items, func) in cases(fn, prj).items():
+                first, warm = timed(func, args.runs)
+                median = statistics.median(warm)
+                results.append({
+                    "scale": scale,
+                    "case": case,
+                    "items": items,
+                    "first_ms": first * 1000,
+                    "warm_ms": median * 1000,
+                    "warm_min_ms": min(warm) * 1000,
+                    "runs": len(warm),
+                    })
+                print(f"{scale:<9}{case:<20}{items:>7}{first * 1000:>11.2f}{median * 1000:>11.2f}"
+                        f"{median * 1e6 / max(items, 1):>12.1f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "commit": commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "scales": {name: SCALES[name] for name in args.scale or DEFAULT_SCALES},
+                "results": results,
+                }, f, indent=1)
+        print(f"Wrote {args.json}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
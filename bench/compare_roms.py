@@ -0,0 +1,30 @@
+# Loads ROMs into one RomSession and prints how each differs from the first,
+# with load time and how much of the content was shared.
+# Run from the repository root:  python bench/compare_roms.py ROM ROM...
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import messenger
+from session import RomSession
+
+def main():
+    if len(sys.argv) < 3:
+        print("usage: python bench/compare_roms.py ROM ROM...")
+        return 2
+    messenger.init_meta()
+    session = RomSession()
+    start = time.perf_counter()
+    session.load(sys.argv[1:])
+    elapsed = time.perf_counter() - start
+    print(session.report())
+    print()
+    print(f"load: {elapsed * 1000:.1f}ms for {len(session.roms)} ROMs, "
+            f"{elapsed * 1000 / max(len(session.roms), 1):.1f}ms per ROM")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+# Synthetic ROMs for the benchmarks: random sequences and BRR samples laid
+# out the way formats.FORMATS["ff6"] expects, so nothing copyrighted is
+# needed. The data is noise, but it's well-formed enough to scan, load,
+# decode, disassemble, allocate and build from.
+#
+# The ASM pointers at the format's asm_* addresses point to tables built for
+# the requested number of sequences and samples, so fixtures can go well past
+# the vanilla game's counts (see PRESETS).
+#
+# Run from the repository root:
+#   python bench/fixtures.py OUTPUT.smc [--preset NAME] [--sequences N] ...
+
+import argparse
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from allocator import Allocator
+from formats import FORMATS, to_rom_address
+
+FORMAT = FORMATS["ff6"]
+MAX_ENTRIES = 255
+# Sample data can't be longer than its 2-byte length prefix allows
+MAX_SAMPLE_BLOCKS = 0xFFFF // 9
+FIXED_SAMPLES = 8
+# Tables, then sequences, start here; samples start in the next free bank.
+# Tables are back to back and exactly as long as they need to be, since
+# Rom.truncate_max_brr takes the room before the next table as the limit.
+TABLE_AREA = 0x100000
+HIROM_SIZE = 0x400000
+EXHIROM_SIZE = 0x800000
+
+# make_rom arguments. "10x" is about ten times the vanilla game's music
+# data: every table slot used, with 255 samples of 2300 blocks (20 KB),
+# about as long as they can be and still fit in an ExHiROM alongside the
+# sequences. (The longest a single sample can be is MAX_SAMPLE_BLOCKS.)
+PRESETS = {
+    "vanilla": dict(sequences=85, samples=63, min_blocks=8, max_blocks=800,
+            min_seq_length=200, max_seq_length=4000, size=HIROM_SIZE),
+    "10x": dict(sequences=255, samples=255, min_blocks=2300, max_blocks=2300,
+            min_seq_length=4000, max_seq_length=8000, size=EXHIROM_SIZE),
+    }
+
+def make_brr(rng, blocks, looped=False):
+    data = bytearray(rng.randbytes(9 * blocks))
+    for i in range(blocks):
+        # filter 0-3, no end/loop flags except on the last block
+        data[i*9] = (data[i*9] & 0xF0) | (rng.randrange(4) << 2)
+    data[-9] |= 3 if looped else 1
+    return bytes(data)
+
+def make_sequence(rng, length):
+    # Header of 18 zero pointers, then random notes and a track end
+    body = b"\x26\x00" * 18
+    body += bytes(rng.randrange(0x80, 0xC4) for _ in range(length))
+    return body + b"\xEB"
+
+class Placer():
+    # Hands out ROM space from start upwards, skipping the ranges the
+    # allocator never uses (so data stays where the fixture put it)
+    def __init__(self, start, size):
+        self.pos = start
+        self.end = min(size, Allocator.MAX_VALUE + 1)
+
+    def take(self, length):
+        moved = True
+        while moved:
+            moved = False
+            for r in Allocator.FORBIDDEN:
+                if self.pos <= r.end and self.pos + length > r.start:
+                    self.pos = r.end + 1
+                    moved = True
+        if self.pos + length > self.end:
+            raise ValueError(f"fixture data doesn't fit: ${length:X} bytes needed "
+                    f"at ${self.pos:06X}, ROM ends at ${self.end:06X}")
+        addr = self.pos
+        self.pos += length
+        return addr
+
+def make_rom(seed=1, sequences=16, samples=48, min_blocks=8, max_blocks=200,
+        min_seq_length=50, max_seq_length=400, size=HIROM_SIZE):
+    """
+    ROM data with the given number of sequences and table samples (each up
+    to 255). Sample lengths are random between min_blocks and max_blocks BRR
+    blocks, sequence lengths between min_seq_length and max_seq_length
+    bytes. Raises ValueError if that doesn't fit in size bytes.
+    """
+    if not 1 <= sequences <= MAX_ENTRIES or not 1 <= samples <= MAX_ENTRIES:
+        raise ValueError(f"sequences and samples must be 1 to {MAX_ENTRIES}")
+    if not 1 <= min_blocks <= max_blocks <= MAX_SAMPLE_BLOCKS:
+        raise ValueError(f"sample lengths must be 1 to {MAX_SAMPLE_BLOCKS} blocks")
+    rng = random.Random(seed)
+    rom = bytearray(size)
+    rom[0xFFD5] = 0x35 if size > HIROM_SIZE else 0x31
+    rom[FORMAT.scanner_address:FORMAT.scanner_address+len(FORMAT.scanner_data)] = FORMAT.scanner_data
+    rom[FORMAT.global_edl_address] = 5
+    rom[FORMAT.sequence_count_address] = sequences
+
+    def put(addr, data):
+        rom[addr:addr+len(data)] = data
+
+    def block(addr, data):
+        put(addr, len(data).to_bytes(2, "little") + data)
+
+    fixed = [make_brr(rng, 4) for _ in range(FIXED_SAMPLES)]
+    pointers = bytearray()
+    pos = FORMAT.brr_spc_ram_address
+    for brr in fixed:
+        pointers += pos.to_bytes(2, "little") + pos.to_bytes(2, "little")
+        pos += len(brr)
+    block(FORMAT.spc_static_brr_address, b"".join(fixed))
+    block(FORMAT.spc_static_ptr_address, bytes(pointers))
+    block(FORMAT.spc_static_env_address, bytes(FIXED_SAMPLES * 2))
+    block(FORMAT.spc_static_pitch_address, bytes(FIXED_SAMPLES * 2))
+
+    space = Placer(TABLE_AREA, size)
+    tables = {}
+    for attr, name, entry, count in (
+            ("asm_brr_pointer_address", "brr", 3, samples),
+            ("asm_brr_loop_address", "loop", 2, samples),
+            ("asm_brr_pitch_address", "pitch", 2, samples),
+            ("asm_brr_env_address", "env", 2, samples),
+            ("asm_seq_pointer_address", "seq", 3, sequences),
+            ("asm_inst_table_address", "inst", 0x20, sequences)):
+        tables[name] = space.take(entry * count)
+        put(getattr(FORMAT, attr), to_rom_address(tables[name]).to_bytes(3, "little"))
+
+    for i in range(sequences):
+        data = make_sequence(rng, rng.randint(min_seq_length, max_seq_length))
+        # sequence blocks store their length minus one, then two more bytes
+        addr = space.take(len(data) + 4)
+        put(addr, (len(data) - 1).to_bytes(2, "little") + data + b"\x00\x00")
+        put(tables["seq"] + i*3, to_rom_address(addr).to_bytes(3, "little"))
+        put(tables["inst"] + i*0x20, b"".join(rng.randint(1, samples).to_bytes(2, "little")
+                for _ in range(16)))
+
+    space.pos = (space.pos + 0xFFFF) & ~0xFFFF
+    for i in range(samples):
+        blocks = rng.randint(min_blocks, max_blocks)
+        looped = rng.random() < 0.5
+        brr = make_brr(rng, blocks, looped)
+        addr = space.take(len(brr) + 2)
+        block(addr, brr)
+        put(tables["brr"] + i*3, to_rom_address(addr).to_bytes(3, "little"))
+        put(tables["loop"] + i*2, (rng.randrange(blocks) * 9 if looped else 0).to_bytes(2, "little"))
+        put(tables["pitch"] + i*2, rng.randrange(-2000, 2000).to_bytes(2, "big", signed=True))
+        put(tables["env"] + i*2, bytes([0x80 | rng.randrange(128), rng.randrange(256)]))
+    return bytes(rom)
+
+def write_rom(fn, **kwargs):
+    data = make_rom(**kwargs)
+    with open(fn, "wb") as f:
+        f.write(data)
+    return fn
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic ROM for benchmarks.")
+    parser.add_argument("output")
+    parser.add_argument("--preset", choices=PRESETS, help="start from these settings")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--sequences", type=int)
+    parser.add_argument("--samples", type=int)
+    parser.add_argument("--min-blocks", type=int)
+    parser.add_argument("--max-blocks", type=int)
+    parser.add_argument("--min-seq-length", type=int)
+    parser.add_argument("--max-seq-length", type=int)
+    parser.add_argument("--size", type=lambda s: int(s, 0), help="ROM size in bytes")
+    args = vars(parser.parse_args())
+    output, preset = args.pop("output"), args.pop("preset")
+    kwargs = dict(PRESETS[preset]) if preset else {}
+    kwargs.update({k: v for k, v in args.items() if v is not None})
+    try:
+        write_rom(output, **kwargs)
+    except ValueError as e:
+        print(f"Can't make {output}: {e}")
+        return 1
+    print(f"Wrote {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# Round-trip check for ROM export.
+#
+# A project made from a ROM and exported without changes must come out
+# byte-identical to that ROM. Then some edits are made (samples replaced
+# with a longer and a much longer one, a pitch, an envelope and an
+# instrument changed) and the build is loaded back: it must hold exactly the
+# edited project's data, and nothing that wasn't edited may have moved.
+#
+# With no ROM given, a synthetic one (fixtures.py, "vanilla" preset) is used.
+# Run from the repository root:  python bench/roundtrip_rom.py [ROM]
+
+import os
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import messenger
+from fixtures import PRESETS, make_brr, write_rom
+from project import Project
+from rom import Rom
+from sample import Sample
+
+# Blocks added to the first edited sample, and the length of the second
+GROW_BLOCKS = 20
+LARGE_BLOCKS = 3000
+# Free space added past the end of the ROM for the edits, since the ROM's
+# own space is all taken by its data
+FREE_SPACE = 0x20000
+
+def load_project(fn):
+    rom = Rom(fn)
+    if not rom.is_valid:
+        return None
+    prj = Project("roundtrip", rom)
+    for _ in prj.init_steps():
+        pass
+    return prj
+
+def table_samples(prj):
+    return [i for i, smp in sorted(prj.brr.items()) if i < 256 and smp.source_type == "rom"]
+
+def check_unmodified(fn, prj):
+    out, dirty = prj.build_rom()
+    with open(fn, "rb") as f:
+        src = f.read()
+    if bytes(out) == src:
+        print(f"unmodified: OK, {len(src)} bytes identical")
+        return True
+    if len(out) != len(src):
+        print(f"unmodified: FAILED, size {len(out)} != {len(src)}")
+    else:
+        first = next(i for i in range(len(src)) if out[i] != src[i])
+        print(f"unmodified: FAILED, first difference at ${first:06X}")
+    print(f"writes: {', '.join(f'${a:06X}+{n}' for a, n in dirty[:16])}")
+    return False
+
+def edit(prj, rng):
+    # Returns a description of each edit made
+    samples = table_samples(prj)
+    if len(samples) < 5 or not prj.seq:
+        return []
+    edits = []
+    # the samples after each replaced one are left as they were (bar a
+    # pitch or envelope), so a replacement that spills over them shows
+    grow, pitch, large, env, inst = samples[:5]
+    end = len(prj.src.rom())
+    prj.add_range(end, end + FREE_SPACE - 1)
+
+    def replace(idx, blocks):
+        old = prj.brr[idx]
+        smp = Sample(make_brr(rng, blocks, old.is_looped), old.loop, old.pitch, old.env,
+                id=idx, lookup=False)
+        prj.replace_sample(idx, smp)
+        edits.append(f"sample {idx:02X} replaced ({len(old.data)} -> {len(smp.data)} bytes)")
+
+    replace(grow, prj.brr[grow].blocks + GROW_BLOCKS)
+    replace(large, LARGE_BLOCKS)
+    prj.set_smp_pitch(pitch, (prj.brr[pitch].pitch + 0x100) % 0x8000)
+    edits.append(f"sample {pitch:02X} pitch")
+    e = prj.brr[env].env
+    prj.set_smp_env(env, (e.a + 1) % 16, e.d, e.s, (e.r + 1) % 32)
+    edits.append(f"sample {env:02X} envelope")
+    seq = min(prj.seq)
+    prj.set_seq_inst(seq, 0, inst if prj.seq[seq].inst[0] != inst else grow)
+    edits.append(f"sequence {seq:02X} instrument 0")
+    return edits
+
+def compare(prj, out):
+    # Differences between the edited project and its build, loaded back
+    problems = []
+    for i, seq in prj.seq.items():
+        other = out.seq.get(i)
+        if other is None or other.data != seq.data:
+            problems.append(f"sequence {i:02X} data")
+        elif list(other.inst) != list(seq.inst):
+            problems.append(f"sequence {i:02X} instruments")
+    for i in table_samples(prj):
+        smp, other = prj.brr[i], out.brr.get(i)
+        if other is None or other.data != smp.data:
+            problems.append(f"sample {i:02X} data")
+            continue
+        for field in ("loop", "pitch", "env"):
+            if getattr(other, field) != getattr(smp, field):
+                problems.append(f"sample {i:02X} {field}")
+    return problems
+
+def moved_blocks(prj):
+    # Blocks whose data is unchanged but that didn't stay where they were
+    alloc = prj.alloc
+    return [id for id, (addr, key) in alloc.pins.items()
+            if alloc.data_index.get(id) == key and alloc.get_address(id) != addr]
+
+def check_edited(fn, prj, tmp):
+    edits = edit(prj, random.Random(1))
+    if not edits:
+        print("edited: skipped, not enough samples")
+        return True
+    built = prj.build_rom()
+    if built is None:
+        print("edited: skipped, the edits don't fit in this ROM's free space")
+        return True
+    out_fn = os.path.join(tmp, "edited" + os.path.splitext(fn)[1])
+    with open(out_fn, "wb") as f:
+        f.write(built[0])
+    out = load_project(out_fn)
+    if out is None:
+        print("edited: FAILED, the build doesn't load")
+        return False
+    problems = compare(prj, out)
+    moved = moved_blocks(prj)
+    if moved:
+        problems.append(f"unchanged data moved: {', '.join(sorted(moved))}")
+    if problems:
+        print(f"edited: FAILED ({'; '.join(edits)})")
+        for problem in problems:
+            print(f"  {problem}")
+        return False
+    print(f"edited: OK ({'; '.join(edits)}), {len(built[1])} writes")
+    return True
+
+def main():
+    messenger.init_meta()
+    with tempfile.TemporaryDirectory() as tmp:
+        if len(sys.argv) > 1:
+            fn = sys.argv[1]
+        else:
+            fn = write_rom(os.path.join(tmp, "vanilla.smc"), **PRESETS["vanilla"])
+        print(fn)
+        prj = load_project(fn)
+        if prj is None:
+            print(f"{fn}: not a supported ROM")
+            return 2
+        ok = check_unmodified(fn, prj)
+        ok = check_edited(fn, prj, tmp) and ok
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
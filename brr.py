@@ -0,0 +1,301 @@
+import audioop
+import os
+import struct
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# BRR encoding. This module is kept free of GUI / backend imports so that it
+# can be loaded cheaply in worker processes.
+
+BLOCK_SAMPLES = 16
+BLOCK_BYTES = 9
+MAX_SHIFT = 12
+
+# Samples of at least this many blocks are cut into independent segments
+# (see split_segments) that are encoded in lockstep. Jobs of more than
+# PARALLEL_MIN_BLOCKS blocks in total are spread over worker processes.
+SEGMENT_MIN_BLOCKS = 0x200
+PARALLEL_MIN_BLOCKS = 0x2000
+# Target size of each independently encoded segment of a long sample.
+SEGMENT_BLOCKS = 0x100
+
+# Every block tries each filter with each shift range, laid out as a
+# (filter, shift) grid per segment.
+_SHIFTS = np.arange(MAX_SHIFT + 1, dtype=np.int64)
+_HALF_STEP = np.where(_SHIFTS > 0, 1 << np.maximum(_SHIFTS - 1, 0), 0)
+_NO_FILTER = np.iinfo(np.int64).max // 2
+
+def brr_filter(filtermode, pre, prepre):
+    # Integer prediction exactly as done by Sample.decode_block, but
+    # operating on arrays (or plain ints).
+    if filtermode == 1:
+        return pre + ((-pre) >> 4)
+    elif filtermode == 2:
+        return (pre << 1) + ((-((pre << 1) + pre)) >> 5) - prepre + (prepre >> 4)
+    elif filtermode == 3:
+        return ((pre << 1) + ((-(pre + (pre << 2) + (pre << 3))) >> 6)
+                - prepre + (((prepre << 1) + prepre) >> 4))
+    return pre * 0
+
+def brr_wrap(pcm):
+    # Clamp to 16 bits, then wrap into the 15-bit range like the S-DSP does.
+    pcm = np.minimum(np.maximum(pcm, -0x8000), 0x7FFF)
+    return ((pcm + 0x4000) & 0x7FFF) - 0x4000
+
+def encode_segments(targets, filter0_blocks, pre=None, prepre=None):
+    """
+    Encode several 15-bit target waveforms (lengths multiples of 16) into BRR
+    blocks with no header flags set. The waveforms are independent and are
+    processed side by side, so the per-sample work is shared across them.
+    Every block tries all 4 filters and 13 shift ranges against the actual
+    decoder state left by the previous block, and keeps the combination with
+    the least squared error. filter0_blocks holds a set of block indices for
+    each target that are restricted to filter 0, which makes their output
+    independent of the preceding decoder state.
+    pre and prepre optionally give the starting decoder state per target.
+    Returns a list of (data, pre, prepre, total squared error).
+    """
+    count = len(targets)
+    lengths = [len(t) // BLOCK_SAMPLES for t in targets]
+    nblocks = max(lengths)
+    wave = np.zeros((count, nblocks * BLOCK_SAMPLES), dtype=np.int64)
+    force = np.zeros((count, nblocks), dtype=bool)
+    for i, t in enumerate(targets):
+        wave[i, :lengths[i] * BLOCK_SAMPLES] = t[:lengths[i] * BLOCK_SAMPLES]
+        for b in filter0_blocks[i]:
+            force[i, b] = True
+
+    rows = np.arange(count)
+    grid = (count, 4, MAX_SHIFT + 1)
+    pre = np.zeros(count, dtype=np.int64) if pre is None else np.asarray(pre, dtype=np.int64)
+    prepre = np.zeros(count, dtype=np.int64) if prepre is None else np.asarray(prepre, dtype=np.int64)
+    predict = np.zeros(grid, dtype=np.int64)
+    nybs = np.empty((BLOCK_SAMPLES,) + grid, dtype=np.int64)
+    out = np.zeros((count, nblocks, BLOCK_BYTES), dtype=np.uint8)
+    errors = np.zeros(count)
+
+    for b in range(nblocks):
+        p1 = np.broadcast_to(pre[:, None, None], grid)
+        p2 = np.broadcast_to(prepre[:, None, None], grid)
+        error = np.zeros(grid, dtype=np.int64)
+        for i in range(BLOCK_SAMPLES):
+            for f in (1, 2, 3):
+                predict[:, f] = brr_filter(f, p1[:, f], p2[:, f])
+            sample = wave[:, b * BLOCK_SAMPLES + i, None, None]
+            n = (((sample - predict) << 1) + _HALF_STEP) >> _SHIFTS
+            n = np.minimum(np.maximum(n, -8), 7)
+            decoded = brr_wrap(((n << _SHIFTS) >> 1) + predict)
+            error += (sample - decoded) ** 2
+            nybs[i] = n
+            p2 = p1
+            p1 = decoded
+
+        error[force[:, b], 1:] = _NO_FILTER
+        best = error.reshape(count, -1).argmin(axis=1)
+        errors += error.reshape(count, -1)[rows, best]
+        pre = p1.reshape(count, -1)[rows, best]
+        prepre = p2.reshape(count, -1)[rows, best]
+        filtermode, shift = np.divmod(best, MAX_SHIFT + 1)
+        nyb = nybs.reshape(BLOCK_SAMPLES, count, -1)[:, rows, best].T & 0xF
+        out[:, b, 0] = (shift << 4) | (filtermode << 2)
+        out[:, b, 1:] = (nyb[:, 0::2] << 4) | nyb[:, 1::2]
+
+    return [(out[i, :lengths[i]].tobytes(), int(pre[i]), int(prepre[i]), float(errors[i]))
+            for i in range(count)]
+
+def encode_blocks(target, pre=0, prepre=0, filter0_blocks=()):
+    # Single waveform version of encode_segments.
+    return encode_segments([target], [set(filter0_blocks)], [pre], [prepre])[0]
+
+def _encode_segments(jobs):
+    # Worker entry point; segments always start on a filter 0 block, so they
+    # can be encoded with a zeroed decoder state.
+    targets, filter0_blocks = zip(*jobs)
+    return [data for data, _, _, _ in encode_segments(targets, filter0_blocks)]
+
+def split_segments(target, loop_block=None, segment_blocks=SEGMENT_BLOCKS):
+    """
+    Choose block indices at which a long waveform can be cut into segments
+    that are encoded independently. The loop start (already a filter 0 block)
+    is always a boundary; other boundaries are placed on the quietest block
+    near each nominal segment edge, where forcing filter 0 costs the least.
+    """
+    nblocks = len(target) // BLOCK_SAMPLES
+    energy = np.abs(np.asarray(target[:nblocks*BLOCK_SAMPLES], dtype=np.int64)
+            ).reshape(nblocks, BLOCK_SAMPLES).max(axis=1)
+    bounds = {0}
+    if loop_block:
+        bounds.add(loop_block)
+    window = segment_blocks // 8
+    for nominal in range(segment_blocks, nblocks, segment_blocks):
+        lo, hi = max(1, nominal - window), min(nblocks, nominal + window)
+        if any(lo <= bo < hi for bo in bounds):
+            continue
+        bounds.add(lo + int(np.argmin(energy[lo:hi])))
+    return sorted(bounds)
+
+def resample_pcm(pcm, ratio, loop=None, length=None):
+    """
+    Linear-interpolation resampler. ratio is output length / input length;
+    length overrides the rounded output length if given.
+    If loop is given, interpolation past the end wraps to the loop start so
+    that the loop seam stays continuous. Returns (pcm, new loop point).
+    """
+    pcm = np.asarray(pcm, dtype=np.float64)
+    if ratio == 1:
+        return pcm, loop
+    newlen = max(1, int(round(len(pcm) * ratio))) if length is None else length
+    pos = np.arange(newlen) / ratio
+    tail = pcm[loop] if loop is not None and loop < len(pcm) else pcm[-1]
+    ext = np.append(pcm, tail)
+    idx = np.minimum(pos.astype(np.int64), len(pcm) - 1)
+    frac = pos - idx
+    out = ext[idx] * (1 - frac) + ext[idx + 1] * frac
+    if loop is not None:
+        loop = int(round(loop * ratio))
+    return out, loop
+
+def prepare_pcm(pcm, loop=None):
+    """
+    Fit 16-bit mono PCM to BRR block structure.
+    - A loop start that isn't block aligned is aligned by adding silence to
+      the start of the sample.
+    - A loop whose length isn't a multiple of 16 samples is resampled to the
+      nearest multiple (minimum 16).
+    - An unlooped sample is padded with silence to a whole number of blocks.
+    Returns (pcm as 15-bit int array, loop block index or None, resample ratio).
+    """
+    if isinstance(pcm, (bytes, bytearray, memoryview)):
+        pcm = np.frombuffer(pcm, dtype="<i2")
+    pcm = np.asarray(pcm, dtype=np.float64)
+    ratio = 1.0
+    if loop is not None:
+        if not 0 <= loop < len(pcm):
+            raise ValueError(f"loop point {loop} is outside the sample")
+        looplen = len(pcm) - loop
+        newlooplen = max(BLOCK_SAMPLES, int(round(looplen / BLOCK_SAMPLES)) * BLOCK_SAMPLES)
+        if newlooplen != looplen:
+            ratio = newlooplen / looplen
+            newlen = int(round(loop * ratio)) + newlooplen
+            pcm, _ = resample_pcm(pcm, ratio, loop=loop, length=newlen)
+            loop = newlen - newlooplen
+        pad = (-loop) % BLOCK_SAMPLES
+        pcm = np.concatenate((np.zeros(pad), pcm))
+        loop_block = (loop + pad) // BLOCK_SAMPLES
+    else:
+        loop_block = None
+        pad = (-len(pcm)) % BLOCK_SAMPLES
+        pcm = np.concatenate((pcm, np.zeros(pad)))
+    target = np.clip(np.floor(pcm / 2 + 0.5), -0x4000, 0x3FFF).astype(np.int64)
+    return target, loop_block, ratio
+
+def encode_brr(pcm, loop=None, processes=None):
+    """
+    Encode 16-bit mono PCM (little-endian bytes, or any int sequence or
+    array) into BRR.
+    loop is the loop start as a sample index, or None for a one-shot sample.
+    Long samples are split into segments at loop-safe boundaries and encoded
+    across processes; pass processes=1 to force single-process encoding.
+    Returns (data, loop offset in bytes, resample ratio). The ratio is not 1
+    only when the loop had to be stretched to a whole number of blocks; pitch
+    should then be scaled up by the same ratio.
+    """
+    return encode_brr_multi([(pcm, loop)], processes=processes)[0]
+
+def encode_brr_multi(sources, processes=None):
+    """
+    Encode several samples at once, given as (pcm, loop) pairs. All their
+    blocks are searched side by side, which is much faster than encoding
+    them one after another. Returns a list of encode_brr results.
+    """
+    jobs = []
+    owners = []
+    results = []
+    for pcm, loop in sources:
+        target, loop_block, ratio = prepare_pcm(pcm, loop)
+        nblocks = len(target) // BLOCK_SAMPLES
+        if not nblocks:
+            raise ValueError("sample is empty")
+        # Filter 0 on the first block and on the loop start block, so the
+        # loop seam doesn't depend on the decoder state at the sample end.
+        forced = {0} if loop_block is None else {0, loop_block}
+        if nblocks < SEGMENT_MIN_BLOCKS:
+            bounds = [0, nblocks]
+        else:
+            bounds = split_segments(target, loop_block) + [nblocks]
+        for start, end in zip(bounds, bounds[1:]):
+            seg = target[start*BLOCK_SAMPLES:end*BLOCK_SAMPLES]
+            jobs.append((seg, {b - start for b in forced if start <= b < end} | {0}))
+            owners.append(len(results))
+        results.append((loop_block, ratio))
+
+    total_blocks = sum(len(seg) for seg, _ in jobs) // BLOCK_SAMPLES
+    if total_blocks < PARALLEL_MIN_BLOCKS or processes == 1 or len(jobs) == 1:
+        encoded = _encode_segments(jobs)
+    else:
+        workers = processes or os.cpu_count() or 1
+        chunk = -(-len(jobs) // workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = pool.map(_encode_segments,
+                    [jobs[i:i+chunk] for i in range(0, len(jobs), chunk)])
+            encoded = [data for part in parts for data in part]
+
+    datas = [bytearray() for r in results]
+    for owner, data in zip(owners, encoded):
+        datas[owner] += data
+    ret = []
+    for data, (loop_block, ratio) in zip(datas, results):
+        data[-BLOCK_BYTES] |= 0b11 if loop_block is not None else 0b01
+        loop_offset = 0 if loop_block is None else loop_block * BLOCK_BYTES
+        ret.append((bytes(data), loop_offset, ratio))
+    return ret
+
+def read_wav(fn):
+    """
+    Read a PCM WAV file as 16-bit mono.
+    Returns (pcm bytes, sample rate, loop start or None). The loop is taken
+    from the first loop in a 'smpl' chunk, if there is one; anything after
+    the loop end is dropped.
+    Raises wave.Error or IOError on unreadable files.
+    """
+    with wave.open(str(fn), "rb") as f:
+        channels = f.getnchannels()
+        width = f.getsampwidth()
+        rate = f.getframerate()
+        frames = f.readframes(f.getnframes())
+    if width == 1:
+        # 8-bit WAV is unsigned
+        frames = audioop.bias(frames, 1, -128)
+    frames = audioop.lin2lin(frames, width, 2)
+    if channels == 2:
+        frames = audioop.tomono(frames, 2, 0.5, 0.5)
+    elif channels != 1:
+        raise wave.Error(f"unsupported channel count {channels}")
+    loop = read_wav_loop(fn)
+    if loop is not None:
+        start, end = loop
+        if start * 2 >= len(frames):
+            return frames, rate, None
+        frames = frames[:(end + 1) * 2]
+        loop = start
+    return frames, rate, loop
+
+def read_wav_loop(fn):
+    # Returns (start, end) sample indices of the first smpl chunk loop.
+    with open(fn, "rb") as f:
+        riff = f.read(12)
+        if riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                return None
+            chunk_id, size = head[:4], int.from_bytes(head[4:], "little")
+            if chunk_id == b"smpl":
+                chunk = f.read(size)
+                if len(chunk) < 0x24 + 0x18 or not struct.unpack_from("<I", chunk, 0x1C)[0]:
+                    return None
+                return struct.unpack_from("<II", chunk, 0x24 + 8)
+            f.seek(size + (size & 1), 1)
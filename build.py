@@ -0,0 +1,124 @@
+import time
+
+from formats import G, from_rom_address, to_rom_address
+from messenger import log, err
+from sample import Envelope
+
+# ROM export. The output starts as a copy of the source ROM, and only what
+# differs from it is written: data blocks that changed or moved, table
+# entries that changed, and the ASM pointers to any table that moved. An
+# unmodified project therefore builds to exactly its source ROM.
+#
+# Sequence and sample blocks are encoded (length-prefixed) as they're set in
+# the allocator, so there's no encoding step here; the allocator also keeps
+# every block at the address it came from unless it no longer fits there.
+
+# table id: (Rom attribute holding its address, format attribute of the ASM
+# pointer to it, bytes per entry)
+TABLES = {
+    G.SEQ_ID: ("seq_table_address", "asm_seq_pointer_address", 3),
+    G.INST_ID: ("inst_table_address", "asm_inst_table_address", 0x20),
+    G.BRR_ID: ("brr_table_address", "asm_brr_pointer_address", 3),
+    G.LOOP_ID: ("loop_table_address", "asm_brr_loop_address", 2),
+    G.PITCH_ID: ("pitch_table_address", "asm_brr_pitch_address", 2),
+    G.ENV_ID: ("env_table_address", "asm_brr_env_address", 2),
+    }
+
+def pointer_entry(old, addr):
+    # 3-byte ROM pointer, left as it was if it already points at addr
+    if addr is None or from_rom_address(int.from_bytes(old, "little")) == addr:
+        return old
+    return to_rom_address(addr).to_bytes(3, "little")
+
+def table_entries(prj, id, old, i):
+    # New contents of entry i of table id, given its old contents
+    alloc = prj.alloc
+    if id == G.SEQ_ID:
+        return pointer_entry(old, alloc.get_address(f"seq{i:02X}")) if i in prj.seq else old
+    if id == G.INST_ID:
+        return bytes(prj.seq[i].get_inst_table()) if i in prj.seq else old
+    # sample tables start at sample 1; empty slots aren't in the allocator
+    sid = f"brr{i+1:02X}"
+    if sid not in alloc.data_index:
+        return old
+    smp = prj.brr[i+1]
+    if id == G.BRR_ID:
+        return pointer_entry(old, alloc.get_address(sid))
+    if id == G.LOOP_ID:
+        return smp.loop.to_bytes(2, "little")
+    if id == G.PITCH_ID:
+        return smp.pitch.to_bytes(2, "big", signed=True)
+    if id == G.ENV_ID:
+        # the high bit of the first byte isn't part of the envelope
+        return old if Envelope(bin=old) == smp.env else bytes(smp.env.bytes())
+    return old
+
+def build_rom(prj):
+    """
+    Returns (ROM data including any copier header, list of (offset, length)
+    ranges written, relative to the start of the data without header), or
+    None if the project's data doesn't fit.
+    """
+    started = time.perf_counter()
+    src = prj.src
+    rom = src.rom()
+    alloc = prj.alloc
+    alloc.allocate_data()
+    if alloc.out_of_room:
+        err.send(f"Can't build ROM: ${alloc.block_bytes(None):X} bytes of data don't fit "
+                "in the available space.")
+        return None
+
+    blocks = alloc.get_all_data()
+    size = max([len(rom)] + [addr + len(data) for addr, data in blocks])
+    header = src.header or b""
+    base = len(header)
+    out = bytearray(base + size)
+    out[:base] = header
+    out[base:base+len(rom)] = rom
+    view = memoryview(out)
+    dirty = []
+
+    def write(addr, data):
+        view[base+addr:base+addr+len(data)] = data
+        dirty.append((addr, len(data)))
+
+    # Blocks already in place in the source ROM are skipped. Tables are
+    # patched entry by entry below.
+    table_keys = {alloc.data_index[id] for id in TABLES if id in alloc.data_index}
+    original = {}
+    for id, key in alloc.data_index.items():
+        addr = alloc.get_address(id)
+        if alloc.is_original(id, addr):
+            original.setdefault(addr, set()).add(key)
+    for range_start, placements in alloc.range_blocks.items():
+        if range_start is None:
+            continue
+        for addr, key in placements:
+            if key in original.get(addr, ()) or key in table_keys:
+                continue
+            write(addr, alloc.block_data[key])
+
+    for id, (addr_attr, pointer_attr, entry) in TABLES.items():
+        if id not in alloc.data_index:
+            continue
+        old_table = alloc.get_data(id)
+        addr = alloc.get_address(id)
+        moved = addr != getattr(src, addr_attr)
+        table = bytearray(old_table)
+        for i in range(len(old_table) // entry):
+            old = old_table[i*entry:(i+1)*entry]
+            new = table_entries(prj, id, old, i)
+            if new != old:
+                table[i*entry:(i+1)*entry] = new
+                if not moved:
+                    write(addr + i*entry, new)
+        if moved:
+            write(addr, table)
+            loc = getattr(src.format, pointer_attr)
+            write(loc, to_rom_address(addr).to_bytes(3, "little"))
+            log.send(f"Moved table {id} to ${addr:06X}.")
+
+    log.send(f"Built ROM in {(time.perf_counter() - started) * 1000:.0f} ms "
+            f"({len(dirty)} writes, ${sum(n for _, n in dirty):X} bytes changed).")
+    return out, dirty
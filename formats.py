@@ -1,3 +1,5 @@
+import hashlib
+
 from messenger import OPT, log, std, err
 
 class G():
@@ -23,6 +25,11 @@ class G():
     INST_ID = "AF-inst"
     
     AUDIO_BUFFER = 1024
+    # pygame channels kept away from find_channel(): the APU's stream and
+    # the preview mixer's stream
+    APU_CHANNEL = 0
+    MIXER_CHANNEL = 1
+    RESERVED_CHANNELS = 2
 
 def from_rom_address(addr):
     # NOTE ROM offset 7E0000-7E7FFF and 7F000-7F7FFF are inaccessible.
@@ -70,6 +77,11 @@ def clamp(min, val, max):
         val = max
     return val
     
+def content_digest(data):
+    # Fast content hash used to identify data blocks (dedup, clones, caches).
+    # Not for names.ini keys, which are md5 for compatibility.
+    return hashlib.blake2b(data, digest_size=16).digest()
+    
 def load_rom_data_block(rom, offset, seq=False):
     length = int.from_bytes(rom[offset:offset+2], "little")
     if seq:
@@ -131,7 +143,7 @@ def create_rom_data_block(data):
 class GameFormat():
     def __init__(self, id, display_name):
         self.id = id
-        self.display_name = "EmptyFormat"
+        self.display_name = display_name
         self.scanner_data = b"placeholder"
 
         self.asm_inst_table_address =   0
@@ -147,15 +159,22 @@ class GameFormat():
         self.spc_static_env_address =   0
         self.spc_static_pitch_address = 0
         self.sequence_count_address =   0
+        self.brr_spc_ram_address =      0
+        self.spc_echo_end_address =     0
         
         self.valid_map_modes = set((0x31, 0x35))
         self.original_romsize = 0
         
         self.default_track_names = {}
         
+# Registered formats, in the order ROMs are checked against them
 FORMATS = {}
 
-FORMATS["ff6"] = GameFormat("ff6", "AKAO4 / Final Fantasy VI")
+def register_format(format):
+    FORMATS[format.id] = format
+    return format
+
+register_format(GameFormat("ff6", "AKAO4 / Final Fantasy VI"))
 FORMATS["ff6"].scanner_address = 0x50720
 FORMATS["ff6"].scanner_data = b"\x00\x8D\x0C\x3F\x48\x06\x8D\x1C" + \
                               b"\x3F\x48\x06\x8D\x2C\x3F\x48\x06"
@@ -173,6 +192,7 @@ FORMATS["ff6"].spc_static_env_address =   0x52038
 FORMATS["ff6"].spc_static_pitch_address = 0x5204A
 FORMATS["ff6"].sequence_count_address =   0x53C5E
 FORMATS["ff6"].brr_spc_ram_address =      0x4800
+FORMATS["ff6"].spc_echo_end_address =     0xF500
 
 FORMATS["ff6"].default_track_names = {
     0x00: "(silence)",
@@ -0,0 +1,91 @@
+import time
+
+# Undo/redo for project edits.
+#
+# Project never changes a Sample or Sequence in place: an edit is made on a
+# shallow copy (Sample.copy, Sequence.copy), which then takes the
+# original's place in Project.brr/seq. The copy shares the BRR data, decoded
+# PCM, plot pyramid and anything else the edit didn't touch. A history step
+# only keeps the objects that were swapped out and in, so it costs memory
+# for what changed and nothing else, and undo/redo swaps them back.
+#
+# A change is (kind, key, before, after):
+#   "brr", sample id,   Sample or None, Sample or None
+#   "seq", sequence id, Sequence,       Sequence
+#   "ranges", None,     [(start, end)], [(start, end)]
+
+HISTORY_LIMIT = 500
+# Edits of the same thing this close together (typing a name, dragging a
+# slider) are merged into one step
+HISTORY_MERGE_TIME = 1.0
+
+class Step():
+    def __init__(self, label, changes):
+        self.label = label
+        self.changes = changes
+        self.time = time.perf_counter()
+
+class History():
+    def __init__(self, limit=HISTORY_LIMIT):
+        self.limit = limit
+        self.undo_steps = []
+        self.redo_steps = []
+        self.group = None
+        self.group_depth = 0
+
+    def record(self, label, kind, key, before, after):
+        change = (kind, key, before, after)
+        self.redo_steps = []
+        if self.group is not None:
+            self.group.changes.append(change)
+            return
+        last = self.undo_steps[-1] if self.undo_steps else None
+        if (last is not None and last.label == label and len(last.changes) == 1
+                and last.changes[0][:2] == (kind, key)
+                and time.perf_counter() - last.time < HISTORY_MERGE_TIME):
+            last.changes[0] = (kind, key, last.changes[0][2], after)
+            last.time = time.perf_counter()
+            return
+        self.push(Step(label, [change]))
+
+    def push(self, step):
+        self.undo_steps.append(step)
+        if len(self.undo_steps) > self.limit:
+            del self.undo_steps[0]
+
+    def begin_group(self, label):
+        # Everything recorded until the matching end_group is one step
+        if not self.group_depth:
+            self.group = Step(label, [])
+        self.group_depth += 1
+
+    def end_group(self):
+        self.group_depth -= 1
+        if not self.group_depth:
+            if self.group.changes:
+                self.push(self.group)
+            self.group = None
+
+    def pop_undo(self):
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        return step
+
+    def pop_redo(self):
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        return step
+
+    def clear(self):
+        self.undo_steps = []
+        self.redo_steps = []
+
+    def undo_label(self):
+        return self.undo_steps[-1].label if self.undo_steps else None
+
+    def redo_label(self):
+        return self.redo_steps[-1].label if self.redo_steps else None
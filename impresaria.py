@@ -21,12 +21,19 @@ import win32gui
 import win32con
 
 from audio import PianoState, scale_to_unity_key
-from project import Project
+from mixer import Mixer
+from scheduler import FrameScheduler
+from tasks import TaskRunner
+from midi import MidiInput, MidiScheduler
+from project import Project, load_project
+from projfile import PROJECT_EXT
 from rom import Rom
-from formats import clamp
+from formats import G, clamp
 from spc import build_and_play_spc, apu
+from aram import AramBudget, sequence_brr_size, fit_sequence_samples
 from messenger import (KEY, log, std, err, pretty_bytes, vblank,
-        init_meta, write_metadata, repr_bank)
+        init_meta, write_metadata, export_metadata, repr_bank, OPT)
+from profiler import profiler, profiled
 import widgets
 
 prj = None
@@ -34,13 +41,17 @@ errorbox = None
 UNIT = 13
 cur_seq = 0
 cur_smp = 1
-midi_device = None
-midi_state = PianoState(play_audio=True)
+midi_input = MidiInput()
+midi_state = PianoState(play_audio=True, mixer=Mixer())
+midi_scheduler = MidiScheduler(midi_state)
+task_runner = TaskRunner()
 io = None
 logo_texture = None
 log_text = ""
 temporary_status_text = ""
 main_window_mode = "seq"
+show_profiler = False
+wave_view = [1.0, 0.0] # zoom, scroll (fraction of sample length)
 WINW, WINH, WINSCALE = 1280, 720, 1
 MAIN_MENU_HEIGHT = 15
 JPFONT, SMALLERFONT, BIGGERFONT = None, None, None
@@ -64,6 +75,7 @@ def main():
     global cur_seq, cur_smp
     global temporary_status_text
     global main_window_mode
+    global show_profiler
     global logo_texture
     global WINW, WINH, WINSCALE
     global MAIN_MENU_HEIGHT
@@ -83,6 +95,7 @@ def main():
     pygame.fastevent.init()
     
     pygame.mixer.set_num_channels(32)
+    pygame.mixer.set_reserved(G.RESERVED_CHANNELS)
     pygame.midi.init()
     apu.init()
         
@@ -109,6 +122,14 @@ def main():
     
     control_window = ControlWindow()
     
+    frame_scheduler = FrameScheduler()
+    frame_scheduler.add("midi", feed_midi_events, OPT.audio_interval, on_wake=True)
+    frame_scheduler.add("audio", midi_state.sustain, OPT.audio_interval)
+    frame_scheduler.add("background", run_background_slice, OPT.frame_interval,
+            budget=OPT.background_slice)
+    frame_scheduler.add("autosave", autosave_project, OPT.autosave_interval)
+    midi_input.notify = frame_scheduler.wake
+    
     # # # Main loop # # #
     while True:
         key_ups = []
@@ -150,6 +171,15 @@ def main():
             main_window_mode = "smp"
         elif KEY.UP(pygame.K_F3):
             main_window_mode = "rom"
+        if KEY.UP(pygame.K_F12):
+            show_profiler = not show_profiler
+            profiler.set_enabled(show_profiler)
+        # text fields have their own undo
+        if prj is not None and not imgui.get_io().want_text_input:
+            if KEY.DOWN(pygame.K_z, pygame.KMOD_CTRL):
+                undo_edit()
+            elif KEY.DOWN(pygame.K_y, pygame.KMOD_CTRL):
+                redo_edit()
 
         # # Menu # #
         make_a_new_project_window_this_frame = False
@@ -158,20 +188,66 @@ def main():
             if imgui.begin_menu("File", True):
                 c, _ = imgui.menu_item("New Project / Open Project...", "", False, True)
                 make_a_new_project_window_this_frame = c
-                c, _ = imgui.menu_item("Save Project", "Ctrl-S", False, True)
+                c, _ = imgui.menu_item("Save Project", "Ctrl-S", False, prj is not None)
+                if c:
+                    save_project(prj.filename)
+                c, _ = imgui.menu_item("Save Project As...", "", False, prj is not None)
+                if c:
+                    save_project(None)
+                c, _ = imgui.menu_item("Export Project as JSON...", "", False, prj is not None)
+                if c:
+                    fn = save_file_dialog("Export Project", "", [("JSON files", "*.json"), ("All files", "*.*")])
+                    if fn:
+                        prj.export_json(fn)
+                c, _ = imgui.menu_item("Export ROM...", "", False, prj is not None and prj.init_status is True)
                 if c:
-                    print(prj.serialize())
-                    print(len(prj.serialize()))
+                    fn = save_file_dialog("Export ROM", "", [("SNES ROM files", "*.smc;*.sfc"), ("All files", "*.*")])
+                    if fn:
+                        prj.export_rom(fn)
+                c, _ = imgui.menu_item("Export IPS patch...", "", False, prj is not None and prj.init_status is True)
+                if c:
+                    fn = save_file_dialog("Export IPS Patch", "", [("IPS patches", "*.ips"), ("All files", "*.*")])
+                    if fn:
+                        prj.export_patch(fn, "ips")
+                c, _ = imgui.menu_item("Export BPS patch...", "", False, prj is not None and prj.init_status is True)
+                if c:
+                    fn = save_file_dialog("Export BPS Patch", "", [("BPS patches", "*.bps"), ("All files", "*.*")])
+                    if fn:
+                        prj.export_patch(fn, "bps")
                 imgui.separator()
                 c, _ = imgui.menu_item("Revert sequence and sample names", "NYI", False, True)
                 c, _ = imgui.menu_item("Save sequence and sample names", "", False, True)
                 if c:
                     write_metadata(prj.seq, prj.brr)
+                c, _ = imgui.menu_item("Export names.ini", "", False, True)
+                if c:
+                    export_metadata()
                 imgui.separator()
                 c, _ = imgui.menu_item("Quit", 'Alt-F4', False, True)
                 if c:
                     cleanup_and_quit()
                 imgui.end_menu()
+            if imgui.begin_menu("Edit", True):
+                label = prj.history.undo_label() if prj else None
+                c, _ = imgui.menu_item(f"Undo {label or ''}", "Ctrl-Z", False, label is not None)
+                if c:
+                    undo_edit()
+                label = prj.history.redo_label() if prj else None
+                c, _ = imgui.menu_item(f"Redo {label or ''}", "Ctrl-Y", False, label is not None)
+                if c:
+                    redo_edit()
+                imgui.end_menu()
+            if imgui.begin_menu("View", True):
+                c, _ = imgui.menu_item("Profiler", "F12", show_profiler, True)
+                if c:
+                    show_profiler = not show_profiler
+                    profiler.set_enabled(show_profiler)
+                c, _ = imgui.menu_item("Export Trace...", "", False, len(profiler.events) > 0)
+                if c:
+                    fn = save_file_dialog("Export Trace", "trace.json", [("Chrome trace files", "*.json"), ("All files", "*.*")])
+                    if fn:
+                        profiler.export_trace(fn)
+                imgui.end_menu()
             
             if widgets.glow_button("Sequences (F1)", main_window_mode == "seq"):
                 main_window_mode = "seq"
@@ -193,7 +269,6 @@ def main():
             if prj:
                 new_project_window = None
         elif prj.init_status is not True:
-            #temporary_status_text = f"{prj.frame_init()}"
             pass
         else:
             control_window.display()
@@ -206,6 +281,7 @@ def main():
                 rom_map_window.draw()
                 
             display_spc_debug()
+            display_midi_debug()
             
             if make_a_new_project_window_this_frame:
                 new_project_window = NewProjectWindow(allow_cancel = True)
@@ -217,37 +293,29 @@ def main():
         # # Messenger # #
         
         display_log_window()
+        if show_profiler:
+            display_profiler()
         handle_stdout()
         errorbox.draw(end_frame=True)
         
         # # Audio / Vblank Loop # #
         
-        #print(pygame.time.get_ticks() - vblank._tick)
-        while True:
-            
-            if midi_device and prj is not None and prj.init_status is True:
-                if midi_device.poll():
-                    midi_events = midi_device.read(16)
-                    midi_state.read_midi(prj.brr[cur_smp], midi_events)
-            midi_state.sustain()
-            
-            if vblank.ok and prj is not None and prj.init_status is not True:
-                temporary_status_text = f"{prj.frame_init()}"
-                
-            if not vblank.ok:
-                break
+        with profiler.span("wait"):
+            frame_scheduler.wait_for_frame()
             
         apu.update()
         
         imgui.pop_font()
-        # note: cannot use screen.fill((1, 1, 1)) because pygame's screen
-        #       does not support fill() on OpenGL sufraces
-        gl.glClearColor(0, 0, 0, 1)
-        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
-        imgui.render()
-        impl.render(imgui.get_draw_data())
+        with profiler.span("render"):
+            # note: cannot use screen.fill((1, 1, 1)) because pygame's screen
+            #       does not support fill() on OpenGL sufraces
+            gl.glClearColor(0, 0, 0, 1)
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+            imgui.render()
+            impl.render(imgui.get_draw_data())
 
-        pygame.display.flip()
+            pygame.display.flip()
+        profiler.frame()
         
 class NewProjectWindow():
     def __init__(self, allow_cancel=False):
@@ -292,6 +360,7 @@ class NewProjectWindow():
                     cur_seq = 0
                     cur_smp = 1
                     prj = Project(self.new_name, rom)
+                    prj.start_init(task_runner)
                     return_true = True
             imgui.spacing()
             imgui.separator()
@@ -299,8 +368,19 @@ class NewProjectWindow():
             imgui.text("Open existing project:")
             imgui.text("Filename:")
             _, self.load_prj_fn = imgui.input_text("##prjfile", self.load_prj_fn, 256)
+            imgui.same_line()
+            if imgui.button("...##prjbrowse"):
+                self.load_prj_fn = open_file_dialog("Open Project", self.load_prj_fn,
+                        [("Impresaria projects", f"*{PROJECT_EXT}"), ("All files", "*.*")])
             _, self.recent_prj_idx = imgui.listbox("Recent files", self.recent_prj_idx, ["Not", "yet", "implemented"])
-            imgui.button("Open project")
+            if imgui.button("Open project"):
+                loaded = load_project(self.load_prj_fn, task_runner)
+                if loaded is not None:
+                    imgui.close_current_popup()
+                    cur_seq = 0
+                    cur_smp = 1
+                    prj = loaded
+                    return_true = True
             if self.allow_cancel:
                 imgui.same_line()
                 if imgui.button("Cancel"):
@@ -337,7 +417,6 @@ class ControlWindow():
     def display(self):
         global cur_seq
         global cur_smp
-        global midi_device
         
         imgui.set_next_window_position(0, MAIN_MENU_HEIGHT)
         imgui.set_next_window_size(WINW, UNIT * 6)
@@ -402,52 +481,100 @@ class ControlWindow():
             
             x, y = imgui.get_window_content_region_max()
             imgui.set_cursor_pos((x * 2 / 3, 0))
-            if midi_device is None:
+            if midi_input.device is None:
                 if imgui.button("[ ]"):
                     try:
-                        midi_device = pygame.midi.Input(
-                                self.midi_input_indices[self.selected_midi_device])
+                        midi_input.open(self.midi_input_indices[self.selected_midi_device])
                     except Exception:
                         log.send("Could not initialize MIDI input "
                                 f"'{self.midi_input_devices[self.selected_midi_device]}'")
             else:
                 if widgets.glow_button("[x]", True, (.2, .5, .2)):
-                    midi_device = None
+                    midi_input.close()
             imgui.same_line()
             imgui.text(f"MIDI:")
             imgui.same_line()
             c, self.selected_midi_device = imgui.combo(f"##MidiDeviceCombo",
                     self.selected_midi_device, self.midi_input_devices)
             if c:
-                midi_device = None
+                midi_input.close()
             imgui.end_child()
         
         imgui.end()
 control_window = None
 
-def display_midi_debug():
-    global midi_device
+def feed_midi_events():
+    if prj is not None and prj.init_status is True:
+        midi_scheduler.feed(prj.brr[cur_smp], midi_input.get_events())
+        
+def run_background_slice(budget):
+    global temporary_status_text
+    if task_runner.busy:
+        task_runner.run_slice(budget)
+        temporary_status_text = task_runner.status()
+
+def undo_edit():
+    label = prj.undo()
+    if label:
+        log.send(f"Undo: {label}")
+        
+def redo_edit():
+    label = prj.redo()
+    if label:
+        log.send(f"Redo: {label}")
+        
+def autosave_project():
+    if prj is not None:
+        prj.autosave(task_runner)
 
+def display_midi_debug():
     imgui.begin("MIDI Debug", False)
     for i in range(pygame.midi.get_count()):
         if imgui.button(f"Use##{i}"):
-            midi_device = pygame.midi.Input(i)
+            midi_input.open(i)
         imgui.same_line()
         ifc, name, inp, out, open = pygame.midi.get_device_info(i)
         imgui.text(f"Interface: {ifc} || {name} || {inp} || {out} || {open}")
     if imgui.button("Release"):
-        midi_device = None
+        midi_input.close()
     if imgui.button("Default"):
-        midi_device = pygame.midi.Input(pygame.midi.get_default_input_id())
+        midi_input.open(pygame.midi.get_default_input_id())
     imgui.same_line()
     imgui.text(f"{pygame.midi.get_default_input_id()}")
-    imgui.text(f"{midi_device}")
+    imgui.text(f"{midi_input}")
     imgui.separator()
     imgui.text(f"MIDI state: {midi_state}")
+    imgui.separator()
+    stats = midi_scheduler.stats()
+    imgui.text(f"Events: {stats['events']} || Late: {stats['late']} || "
+            f"Resyncs: {stats['resyncs']}")
+    for label in ("input latency", "schedule lead", "trigger error"):
+        avg, dev, peak = stats[label]
+        imgui.text(f"{label.capitalize()}: {avg:.2f}ms avg, {dev:.2f}ms jitter, {peak:.2f}ms max")
+    imgui.end()
+    
+def display_profiler():
+    # Per-frame time of each span over the last PROFILE_FRAMES frames
+    imgui.begin("Profiler", False)
+    _, profiler.recording = imgui.checkbox("Record trace", profiler.recording)
+    imgui.same_line()
+    imgui.text(f"{len(profiler.events)} events")
+    imgui.same_line()
+    if imgui.button("Clear"):
+        profiler.clear()
+        profiler.events.clear()
+    width = imgui.get_content_region_available_width()
+    for name in profiler.names():
+        last, avg, peak = profiler.stats(name)
+        imgui.text(f"{name}: {last:.2f}ms, {avg:.2f}ms avg, {peak:.2f}ms max")
+        imgui.plot_histogram(f"##Profile{name}", profiler.values(name),
+                scale_min=0.0, scale_max=max(peak, OPT.frame_interval),
+                graph_size=(width, UNIT * 2))
     imgui.end()
     
 big_apu_graph = widgets.APUHistGraph()
 piano_alpha = [0.0 for i in range(0x30)]
+@profiled("ui.spc_debug")
 def display_spc_debug():
     global big_apu_graph
     if apu.initialized:
@@ -537,10 +664,11 @@ def display_spc_debug():
                     alpha=piano_alpha[i+10])
             imgui.end()
         
+@profiled("ui.sequence_window")
 def display_sequence_window():
     global cur_seq
     
-    smp_list = [f"{i:02X}" for i in range(len(prj.get_samples())+1)]
+    smp_list = prj.smp_id_list_view()
             
     if KEY.UP(pygame.K_PAGEUP):
         cur_seq = clamp(0, cur_seq - 1, len(prj.seq))
@@ -558,7 +686,8 @@ def display_sequence_window():
         imgui.text(f"{idx+0x20:02X}")
         imgui.push_item_width(int(UNIT * 3.5))
         c, s = imgui.combo(f"##inst{idx}cbx", cseq.inst[idx], smp_list)
-        cseq.inst[idx] = s
+        if c:
+            prj.set_seq_inst(cur_seq, idx, s)
         imgui.pop_item_width()
         imgui.end_group()
         
@@ -568,7 +697,7 @@ def display_sequence_window():
     
     imgui.push_item_width(imgui.get_window_width() * 0.3)
     imgui.begin_group()
-    lst = [prj.repr_seq(i) for i in range(len(prj.seq))]
+    lst = prj.seq_list_view()
     _, cur_seq = imgui.listbox("##seqlist", cur_seq, lst, n_items)
     imgui.end_group()
     imgui.pop_item_width()
@@ -579,14 +708,24 @@ def display_sequence_window():
     imgui.same_line()
     if seq_changed_keyboard:
         imgui.set_keyboard_focus_here(0)
-    _, cseq.name = imgui.input_text(f"##sequence{cur_seq}name", cseq.name, 64)
+    c, name = imgui.input_text(f"##sequence{cur_seq}name", cseq.name, 64)
+    if c:
+        prj.set_seq_name(cur_seq, name)
     if cur_seq in prj.format.default_track_names:
         imgui.text(f"Originally: {prj.format.default_track_names[cur_seq]}")
     imgui.text(f"${len(cseq.get_data()):X} bytes")
     try:
-        imgui.text(f"Address: ${prj.alloc.get_address(f'seq{cur_seq:02X}'):06X}")
+        imgui.text(f"Address: ${prj.address_view(f'seq{cur_seq:02X}'):06X}")
     except TypeError:
-        imgui.text(f"Address: {prj.alloc.get_address(f'seq{cur_seq:02X}')}")
+        imgui.text(f"Address: {prj.address_view(f'seq{cur_seq:02X}')}")
+    brr_used = prj.views.get(("aram_used", cur_seq), (prj.seq_version, prj.brr_version),
+            sequence_brr_size, prj, cur_seq)
+    brr_free = prj.views.get("aram_free", (), AramBudget, prj).size
+    imgui.text(f"Sample RAM: ${brr_used:X} of ${brr_free:X} bytes")
+    if brr_used > brr_free:
+        imgui.same_line()
+        if imgui.small_button("Fit samples to RAM"):
+            fit_sequence_samples(prj, cur_seq)
     
     imgui.begin_group()
     for i in range(2):
@@ -628,6 +767,7 @@ def validate_cur_smp(cur_smp, cur_smp_last):
         cur_smp = 255 + len(prj.brr) - len(prj.get_samples())
     return cur_smp
         
+@profiled("ui.sample_window")
 def display_sample_window():
     global cur_seq, cur_smp
     
@@ -641,6 +781,8 @@ def display_sample_window():
     else:
         smp_changed_keyboard = False
     cur_smp = validate_cur_smp(cur_smp, cur_smp_last)
+    if cur_smp != cur_smp_last:
+        wave_view[:] = [1.0, 0.0]
     
     csmp = prj.brr[cur_smp]
     
@@ -650,7 +792,7 @@ def display_sample_window():
     
     imgui.push_item_width(imgui.get_window_width() * 0.3)
     imgui.begin_group()
-    lst = [prj.repr_smp(i) for i in sorted(prj.brr.keys())]
+    lst = prj.smp_list_view()
     cur_smp_tmp = cur_smp_to_idx(cur_smp)
     c, cur_smp_tmp = imgui.listbox("##smplist", cur_smp_tmp, lst, n_items)
     if c:
@@ -665,14 +807,16 @@ def display_sample_window():
     if smp_changed_keyboard:
         imgui.set_keyboard_focus_here(0)
     imgui.same_line()
-    _, csmp.name = imgui.input_text("##samplename", csmp.name, 64)
+    c, name = imgui.input_text("##samplename", csmp.name, 64)
+    if c:
+        prj.set_smp_name(cur_smp, name)
     smplen = len(csmp.get_data())
     imgui.text(f"{smplen // 9} blocks || ${smplen:X} bytes")
     try:
-        imgui.text(f"Address: ${prj.alloc.get_address(f'brr{cur_smp:02X}'):06X}")
+        imgui.text(f"Address: ${prj.address_view(f'brr{cur_smp:02X}'):06X}")
     except TypeError:
-        imgui.text(f"Address: {prj.alloc.get_address(f'brr{cur_smp:02X}')}")
-    clones = prj.sample_get_clones(cur_smp)
+        imgui.text(f"Address: {prj.address_view(f'brr{cur_smp:02X}')}")
+    clones = prj.clones_view(cur_smp)
     if clones is not None:
         clonetext = ""
         if clones[1]:
@@ -682,8 +826,25 @@ def display_sample_window():
             clonetext = (clonetext + "Shares data with " + ''.join(
                     [f"{i:02X}, " for i in clones[0]]))[:-2] + "."
         imgui.text(clonetext)
-    imgui.plot_lines("##waveplot", prj.brr[cur_smp].pcmarray,
-            graph_size=(imgui.get_window_width() * 0.66, UNIT * 5))
+    plot_width = imgui.get_window_width() * 0.66
+    zoom, scroll = wave_view
+    view_len = csmp.pcmsamples / zoom
+    view_start = int(scroll * csmp.pcmsamples)
+    imgui.plot_lines("##waveplot",
+            csmp.get_plot_envelope(plot_width, view_start, int(view_start + view_len)),
+            graph_size=(plot_width, UNIT * 5))
+    if imgui.is_item_hovered() and io.mouse_wheel:
+        # zoom around the point under the cursor
+        mouse_x = imgui.get_mouse_position()[0]
+        frac = clamp(0, (mouse_x - imgui.get_item_rect_min()[0]) / plot_width, 1)
+        anchor = scroll + frac / zoom
+        zoom = clamp(1.0, zoom * (1.25 ** io.mouse_wheel), max(1.0, csmp.pcmsamples / 32))
+        scroll = anchor - frac / zoom
+    if zoom > 1.0:
+        imgui.push_item_width(plot_width)
+        _, scroll = imgui.slider_float("##wavescroll", scroll, 0.0, 1 - 1 / zoom, "")
+        imgui.pop_item_width()
+    wave_view[:] = [zoom, clamp(0.0, scroll, 1 - 1 / zoom)]
 
     imgui.begin_group()
     etypes = (
@@ -707,20 +868,22 @@ def display_sample_window():
         imgui.same_line()
         imgui.dummy(UNIT, UNIT)
     imgui.end_group()
-    csenv.a, csenv.d, csenv.s, csenv.r = env_vals
+    prj.set_smp_env(cur_smp, *env_vals)
     
     imgui.push_item_width(imgui.get_window_width() * 0.2)
     imgui.begin_group()
     imgui.text("Pitch:")
     imgui.same_line()
-    _, csmp.pitch = imgui.input_int("##rawpitch", csmp.pitch, 1, 1, imgui.INPUT_TEXT_CHARS_HEXADECIMAL
+    c, pitch = imgui.input_int("##rawpitch", csmp.pitch, 1, 1, imgui.INPUT_TEXT_CHARS_HEXADECIMAL
             | imgui.INPUT_TEXT_CHARS_UPPERCASE)
+    if c:
+        prj.set_smp_pitch(cur_smp, pitch)
     imgui.same_line()
     imgui.text("Scale:")
     imgui.same_line()
     c, pscale = imgui.slider_float("##scalepitch", csmp.get_pitch_as_scale(), 0.5, (0x17FFF/0x10000))
     if c:
-        csmp.pitch = int((pscale - 1) * 0x10000)
+        prj.set_smp_pitch(cur_smp, int((pscale - 1) * 0x10000))
     imgui.end_group()
     
     if csmp.is_looped:
@@ -728,21 +891,19 @@ def display_sample_window():
     else:
         imgui.text("Loop: OFF")
         
-    used_in = {k: seq for k, seq in prj.seq.items() if cur_smp in seq.inst.values()}
+    used_in = prj.used_in_view(cur_smp)
     imgui.begin_group()
     imgui.text("Sample is used in:")
     if used_in:
         imgui.begin_child("##sample_used_in", imgui.get_window_width() * 0.5,
                 imgui.get_window_height() * 0.4)
-        namelen = max(10, *[len(seq.name) for seq in used_in.values()])
-        for k, seq in used_in.items():
-            if cur_smp in seq.inst.values():
-                if imgui.small_button(f"{k:02X} {seq.name:{namelen}}##sample_used_in"):
-                    cur_seq = k
-                text = "as " + ''.join([f"{prg+0x20:02X}, "
-                        for prg, sid in seq.inst.items() if sid == cur_smp])
-                imgui.same_line()
-                imgui.text(text[:-2])
+        namelen = max(10, *[len(prj.seq[k].name) for k in used_in])
+        for k, slots in used_in.items():
+            if imgui.small_button(f"{k:02X} {prj.seq[k].name:{namelen}}##sample_used_in"):
+                cur_seq = k
+            text = "as " + ''.join([f"{prg+0x20:02X}, " for prg in slots])
+            imgui.same_line()
+            imgui.text(text[:-2])
         imgui.end_child()
     else:
         imgui.text("        Nothing!")
@@ -835,7 +996,7 @@ class RomMapWindow():
             if answer is True:
                 log.send(f"Released range {repr_bank(self.selected_range[0])} "
                         f"to {repr_bank(self.selected_range[1])}")
-                prj.alloc.release(*self.selected_range)
+                prj.release_range(*self.selected_range)
             if answer is not None:
                 self.remove_range_qbox = None
                 self.selected_range = None
@@ -855,9 +1016,9 @@ class RomMapWindow():
                         err.send("Enter a valid start and end.")
                     else:
                         if self.dialog_label == "add":
-                            prj.alloc.add(self.enter_range_start, self.enter_range_end)
+                            prj.add_range(self.enter_range_start, self.enter_range_end)
                         elif self.dialog_label == "release":
-                            prj.alloc.release(self.enter_range_start, self.enter_range_end)
+                            prj.release_range(self.enter_range_start, self.enter_range_end)
                         imgui.close_current_popup()
                 imgui.same_line()
                 if imgui.button("Cancel", width = UNIT * 4):
@@ -891,6 +1052,33 @@ def open_file_dialog(win_title, orig_file, filespec):
     except win32gui.error:
         return orig_file
     
+def save_file_dialog(win_title, orig_file, filespec):
+    # # Win32
+    # Returns "" if cancelled
+    try:
+        filespec_win32 = ""
+        for type, ext in filespec:
+            filespec_win32 += f"{type}\0{ext}\0"
+        fn, filter, flags = win32gui.GetSaveFileNameW(
+                Title = win_title,
+                File = orig_file,
+                Filter = filespec_win32,
+                Flags = win32con.OFN_EXPLORER | win32con.OFN_OVERWRITEPROMPT
+                )
+        return fn
+    except win32gui.error:
+        return ""
+        
+def save_project(fn):
+    # fn None: ask where
+    if fn is None:
+        fn = save_file_dialog("Save Project", f"{prj.name}{PROJECT_EXT}",
+                [("Impresaria projects", f"*{PROJECT_EXT}"), ("All files", "*.*")])
+        if not fn:
+            return
+    prj.save(fn)
+    
+@profiled("ui.side_panel")
 def display_side_panel():
     head = UNIT * 6 + MAIN_MENU_HEIGHT
     foot = UNIT * 10
@@ -909,7 +1097,7 @@ def display_side_panel():
     imgui.begin("SidePanel", True, MAIN_WINDOW_FLAGS)
     if prj and prj.init_status is True:
         imgui.push_text_wrap_pos(0.0)
-        imgui.text(f"{prj.alloc.repr_total_usage()}")
+        imgui.text(f"{prj.usage_view()}")
         imgui.pop_text_wrap_pos()
     imgui.end()
     
@@ -1023,8 +1211,7 @@ class Texture():
         return self.texture, self.width*scale, self.height*scale
 
 def cleanup_and_quit():
-    global midi_device
-    midi_device = None
+    midi_input.close()
     sys.exit(0)
     
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+import os
+import struct
+import zlib
+
+from messenger import err
+from projfile import pack_record, unpack_record
+
+# Write-ahead journal of project edits, kept next to the project file.
+#
+# Each edit is appended as one record as it's made, so the cost of keeping
+# it is the size of the edit. Records are framed with their length and a
+# CRC, and reading stops at the first incomplete or damaged one (the tail of
+# a write that was cut off). Compaction saves the project file and empties
+# the journal; anything still in the journal when a project is opened is
+# replayed on top of it.
+#
+# Every edit records the resulting value rather than a change, so replaying
+# a record that had already reached the project file is harmless.
+
+JOURNAL_EXT = ".journal"
+# payload length, crc32 of payload
+RECORD = struct.Struct("<II")
+
+class Journal():
+    def __init__(self, fn):
+        self.fn = fn
+        self.file = None
+        self.count = 0
+        self.size = 0
+
+    def open(self):
+        # Returns the records already in the journal as (op, args, data),
+        # and positions it after the last good one for appending.
+        records, end = self.read()
+        self.file = open(self.fn, "ab")
+        if end < self.file.tell():
+            self.file.truncate(end)
+            self.file.seek(end)
+        self.count = len(records)
+        self.size = end
+        return records
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read(self):
+        records = []
+        pos = 0
+        try:
+            with open(self.fn, "rb") as f:
+                buf = f.read()
+        except FileNotFoundError:
+            return records, 0
+        while pos + RECORD.size <= len(buf):
+            length, crc = RECORD.unpack_from(buf, pos)
+            payload = buf[pos+RECORD.size:pos+RECORD.size+length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                err.send(f"Journal {self.fn} ends in a damaged record; "
+                        f"recovered {len(records)} edits before it.")
+                break
+            meta, data = unpack_record(payload)
+            records.append((meta["op"], meta["args"], data))
+            pos += RECORD.size + length
+        return records, pos
+
+    def append(self, op, *args, data=b""):
+        payload = pack_record({"op": op, "args": args}, data)
+        self.file.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.file.flush()
+        self.count += 1
+        self.size += RECORD.size + len(payload)
+
+    def clear(self):
+        self.file.truncate(0)
+        self.file.seek(0)
+        os.fsync(self.file.fileno())
+        self.count = 0
+        self.size = 0
@@ -1,9 +1,10 @@
-import configparser
-import hashlib
+import sqlite3
 from pathlib import Path
 
 import pygame
 
+from metadb import MetaDB
+
 IMPRESARIA_VERSION = "0.0.0"
 
 # this file has basically ballooned out from its original purpose
@@ -19,13 +20,16 @@ IMPRESARIA_VERSION = "0.0.0"
 class Vblank():
     def __init__(self):
         self._tick = 0
+        self._budget = 15
         
     @property
     def ok(self):
-        return (pygame.time.get_ticks() - self._tick) < 15
+        return (pygame.time.get_ticks() - self._tick) < self._budget
         
-    def tick(self):
+    def tick(self, budget=15):
+        # budget: ms from now that calculations may run for
         self._tick = pygame.time.get_ticks()
+        self._budget = budget
         
 vblank = Vblank()
 
@@ -57,6 +61,7 @@ KEY = KeyboardEventHandler()
 
 # TODO this is likely to break with pyinstaller (resolves to temp dir)?
 META_FILENAME = Path(__file__).resolve().parent / "names.ini"
+META_DB_FILENAME = Path(__file__).resolve().parent / "names.db"
 meta = None
 
 class LogMessenger():
@@ -112,65 +117,79 @@ def pretty_bytes(bin, group=2, line=None):
     
 class OPT():
     trim_sequence_ends = True
+    # Main loop pacing (see scheduler.py), all in ms
+    frame_interval = 16
+    audio_interval = 4
+    background_slice = 10
+    # How often the edit journal is folded into the project file
+    autosave_interval = 30000
 
 def init_meta():
+    # Opens the names database, first pulling in names.ini if it has changed
+    # since it was last imported.
     global meta
-    meta = configparser.ConfigParser(interpolation=None)
+    if meta is not None:
+        return
+    meta = MetaDB(META_DB_FILENAME)
+    import_meta_ini()
+    
+def import_meta_ini():
     try:
-        meta.read(META_FILENAME)
-    except IOError:
-        pass
-    if not meta.has_section("Sequences"):
-        meta.add_section("Sequences")
-    if not meta.has_section("Samples"):
-        meta.add_section("Samples")
+        mtime = META_FILENAME.stat().st_mtime
+    except OSError:
+        return
+    if meta.get_info("ini_mtime") != str(mtime):
+        count = meta.import_ini(META_FILENAME)
+        meta.set_info("ini_mtime", mtime)
+        log.queue(f"Imported {count} names from {META_FILENAME.name}.")
+     
+def seq_meta_key(seq):
+    return seq.meta_hash, len(seq.data)
+    
+def brr_meta_key(brr):
+    return brr.meta_hash, brr.blocks
      
 def write_metadata(seq, brr):
-    cp = configparser.ConfigParser(interpolation=None)
+    # Stores the names of all named sequences and samples in the database.
+    # Only those rows are written; names.ini is left alone (see
+    # export_metadata).
     try:
-        cp.read(META_FILENAME)
-    except IOError:
-        err.send("Can't read file {META_FILENAME}")
+        meta.store_many("seq", ((*seq_meta_key(s), s.name) for s in seq.values() if s.name))
+        meta.store_many("brr", ((*brr_meta_key(b), b.name) for b in brr.values() if b.name))
+    except sqlite3.Error as e:
+        err.send(f"Can't write to {META_DB_FILENAME}: {e}")
         return
-        
-    if not cp.has_section("Sequences"):
-        cp.add_section("Sequences")
-    if not cp.has_section("Samples"):
-        cp.add_section("Samples")
-        
-    for id, sequence in seq.items():
-        if not sequence.name:
-            continue
-        blob = sequence.get_inst_table() + sequence.data
-        key = (f"{hashlib.md5(blob).hexdigest()}"
-                f" {len(sequence.data):x}")
-        val = f"{sequence.name}"
-        cp["Sequences"][key] = val
-        
-    for id, sample in brr.items():
-        if not sample.name:
-            continue
-        key = f"{hashlib.md5(sample.data).hexdigest()} {sample.blocks}"
-        val = f"{sample.name}"
-        cp["Samples"][key] = val
-        
+    log.send("Names and meta-information saved.")
+    
+def export_metadata():
+    # Writes every name in the database to names.ini, for sharing. Any
+    # change to names.ini since it was last imported is merged in first, so
+    # the export doesn't drop it.
     try:
-        with open(META_FILENAME, "w") as f:
-            cp.write(f)
-        log.send("Names and meta-information saved.")
-    except IOError:
-        err.send("Can't write to file {META_FILENAME}")
-        
+        import_meta_ini()
+        meta.export_ini(META_FILENAME)
+        meta.set_info("ini_mtime", META_FILENAME.stat().st_mtime)
+    except (OSError, sqlite3.Error) as e:
+        err.send(f"Can't write to {META_FILENAME}: {e}")
+        return
+    log.send(f"Exported {meta.count()} names to {META_FILENAME.name}.")
         
 def lookup_brr_metadata(brr):
-    key = f"{hashlib.md5(brr.data).hexdigest()} {brr.blocks}"
-    if key in meta["Samples"]:
-        val = meta["Samples"][key]
+    val = meta.lookup("brr", *brr_meta_key(brr))
+    if val is not None:
         brr.name = val
         
 def lookup_seq_metadata(seq):
-    blob = seq.get_inst_table() + seq.data
-    key = f"{hashlib.md5(blob).hexdigest()} {len(seq.data):x}"
-    if key in meta["Sequences"]:
-        val = meta["Sequences"][key]
+    val = meta.lookup("seq", *seq_meta_key(seq))
+    if val is not None:
         seq.name = val
+        
+def lookup_metadata_batch(seqs=(), brrs=()):
+    # Same as the lookups above for many objects at once, in a few queries.
+    seqs, brrs = list(seqs), list(brrs)
+    for kind, objs, keyfunc in (("seq", seqs, seq_meta_key), ("brr", brrs, brr_meta_key)):
+        keys = [keyfunc(o) for o in objs]
+        found = meta.lookup_many(kind, keys)
+        for obj, key in zip(objs, keys):
+            if key in found:
+                obj.name = found[key]
@@ -0,0 +1,129 @@
+import configparser
+import sqlite3
+
+# Local store for sequence and sample names, keyed by content hash and size
+# (the same keys as names.ini: md5 of the data, plus the sequence length in
+# bytes or the sample length in blocks). names.ini stays the shareable
+# format; it's imported into the database whenever it's newer than the last
+# import, and lookups after that are single indexed queries no matter how
+# many entries the database holds.
+#
+# Names saved locally are marked as such until they're exported to
+# names.ini, so importing a changed names.ini (after a pull, say) doesn't
+# overwrite them.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS names (
+    kind TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    local INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, hash, length)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# names.ini section for each kind, and how its length is written
+INI_SECTIONS = {"seq": ("Sequences", 16), "brr": ("Samples", 10)}
+
+# SQLite's default limit on host parameters is 999 on older builds
+BATCH_SIZE = 400
+
+class MetaDB():
+    def __init__(self, fn):
+        self.fn = fn
+        self.db = sqlite3.connect(str(fn))
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(names)")]
+        if "local" not in columns:
+            # Databases from before names were marked local: as nothing
+            # tells the saved names from the imported ones, keep them all
+            with self.db:
+                self.db.execute("ALTER TABLE names ADD COLUMN local INTEGER NOT NULL DEFAULT 0")
+                self.db.execute("UPDATE names SET local = 1")
+
+    def close(self):
+        self.db.close()
+
+    def get_info(self, key):
+        row = self.db.execute("SELECT value FROM info WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_info(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO info VALUES (?, ?)", (key, str(value)))
+
+    def lookup(self, kind, hash, length):
+        row = self.db.execute("SELECT name FROM names WHERE kind = ? AND hash = ? AND length = ?",
+                (kind, hash, length)).fetchone()
+        return row[0] if row else None
+
+    def lookup_many(self, kind, keys):
+        # keys: iterable of (hash, length); returns {(hash, length): name}
+        # for the ones that have names.
+        keys = list(set(keys))
+        found = {}
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i:i+BATCH_SIZE]
+            hashes = {h for h, _ in batch}
+            rows = self.db.execute("SELECT hash, length, name FROM names WHERE kind = ? "
+                    f"AND hash IN ({','.join('?' * len(hashes))})", (kind, *hashes))
+            wanted = set(batch)
+            for h, length, name in rows:
+                if (h, length) in wanted:
+                    found[(h, length)] = name
+        return found
+
+    def store_many(self, kind, entries):
+        # entries: iterable of (hash, length, name), saved as local names.
+        # Only these rows are written; nothing else in the database is
+        # touched.
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?, 1)",
+                    ((kind, h, length, name) for h, length, name in entries))
+
+    def count(self, kind=None):
+        if kind is None:
+            return self.db.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+        return self.db.execute("SELECT COUNT(*) FROM names WHERE kind = ?", (kind,)).fetchone()[0]
+
+    def import_ini(self, fn):
+        # Merge a names.ini file in. Its entries replace earlier imports, but
+        # not names saved locally since the last export.
+        cp = configparser.ConfigParser(interpolation=None)
+        cp.read(fn)
+        imported = 0
+        for kind, (section, base) in INI_SECTIONS.items():
+            if not cp.has_section(section):
+                continue
+            entries = []
+            for key, name in cp[section].items():
+                try:
+                    h, length = key.split()
+                    entries.append((h, int(length, base), name))
+                except ValueError:
+                    continue
+            with self.db:
+                self.db.executemany("INSERT INTO names VALUES (?, ?, ?, ?, 0) "
+                        "ON CONFLICT (kind, hash, length) DO UPDATE SET name = excluded.name "
+                        "WHERE local = 0", ((kind, h, length, name) for h, length, name in entries))
+            imported += len(entries)
+        return imported
+
+    def export_ini(self, fn):
+        # Writes every name to a names.ini file. Raises OSError if it can't;
+        # otherwise the local names are in the file now, and no longer local.
+        cp = configparser.ConfigParser(interpolation=None)
+        for kind, (section, base) in INI_SECTIONS.items():
+            cp.add_section(section)
+            rows = self.db.execute("SELECT hash, length, name FROM names WHERE kind = ?", (kind,))
+            for h, length, name in rows:
+                cp[section][f"{h} {length:x}" if base == 16 else f"{h} {length}"] = name
+        with open(fn, "w") as f:
+            cp.write(f)
+        with self.db:
+            self.db.execute("UPDATE names SET local = 0")
@@ -0,0 +1,151 @@
+import queue
+import threading
+import time
+from statistics import mean, pstdev
+
+import pygame
+import pygame.midi
+
+from mixer import MIXER_RATE
+
+# Live MIDI input for the preview piano. A thread reads the device as soon
+# as events arrive and queues them with their portmidi timestamps (ms); the
+# scheduler then places each one on the mixer's sample clock, a fixed lead
+# ahead of where rendering is, so relative timing between notes is kept to
+# the sample regardless of when the GUI loop gets around to them.
+
+MIDI_POLL_INTERVAL = 0.001
+MIDI_READ_SIZE = 64
+# How far ahead of the mixer clock events are placed, in samples. Must cover
+# the audio that's already been rendered and queued (see Mixer.update).
+MIDI_SCHEDULE_LEAD = 1536
+# Events are re-anchored if they'd land this far from the expected lead
+# (the mixer was idle, or the audio and MIDI clocks drifted apart).
+MIDI_RESYNC_SAMPLES = 2048
+MIDI_STATS_WINDOW = 256
+
+SAMPLES_PER_MS = MIXER_RATE / 1000
+
+class MidiInput():
+    def __init__(self):
+        self.device = None
+        self.thread = None
+        self.running = False
+        self.queue = queue.Queue()
+        self.name = ""
+        # called from the reader thread when events arrive
+        self.notify = None
+
+    def open(self, device_id):
+        self.close()
+        self.device = pygame.midi.Input(device_id)
+        self.name = pygame.midi.get_device_info(device_id)[1].decode(errors="replace")
+        self.running = True
+        self.thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.device is not None:
+            self.device.close()
+            self.device = None
+
+    def read_loop(self):
+        while self.running:
+            if not self.device.poll():
+                time.sleep(MIDI_POLL_INTERVAL)
+                continue
+            received = pygame.midi.time()
+            for message, timestamp in self.device.read(MIDI_READ_SIZE):
+                self.queue.put((message, timestamp, received))
+            if self.notify is not None:
+                self.notify()
+
+    def get_events(self):
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def __repr__(self):
+        return f"<MIDI input '{self.name}'>" if self.device else "<no MIDI input>"
+
+class MidiScheduler():
+    """
+    Turns timestamped MIDI events into key-ons/key-offs on a PianoState,
+    scheduled on its mixer's clock at (timestamp * rate + offset). The offset
+    is fixed when the first event arrives and only moved when the mixer clock
+    has drifted from MIDI time by more than MIDI_RESYNC_SAMPLES (e.g. after
+    the mixer sat idle), so note spacing follows the timestamps.
+    Without a mixer, events are applied as they're read.
+    """
+    def __init__(self, piano):
+        self.piano = piano
+        self.offset = None
+        self.input_latency = []
+        self.lead = []
+        self.jitter = []
+        self.late = 0
+        self.resyncs = 0
+        self.count = 0
+
+    def feed(self, sample, events):
+        mixer = self.piano.mixer
+        if mixer is not None and events:
+            # offset that would put an event stamped now one lead ahead
+            ideal = mixer.clock + MIDI_SCHEDULE_LEAD - round(pygame.midi.time() * SAMPLES_PER_MS)
+            if self.offset is None or abs(self.offset - ideal) > MIDI_RESYNC_SAMPLES:
+                self.offset = ideal
+                self.resyncs += 1
+        for message, timestamp, received in events:
+            if message[0] & 0xF0 not in (0x80, 0x90):
+                continue
+            # note-on with velocity 0 is a note-off
+            on = message[0] & 0xF0 == 0x90 and message[2] > 0
+            key = message[1]
+            self.count += 1
+            self.record(self.input_latency, received - timestamp)
+            if mixer is None:
+                self.trigger(on, key, sample)
+                continue
+            target = round(timestamp * SAMPLES_PER_MS) + self.offset
+            if target < mixer.clock:
+                self.late += 1
+            self.record(self.lead, (target - mixer.clock) / SAMPLES_PER_MS)
+            mixer.schedule(target, self.fire, on, key, sample, target)
+
+    def fire(self, on, key, sample, target):
+        # Runs inside Mixer.render at the scheduled sample (or later, if late)
+        self.record(self.jitter, (self.piano.mixer.clock_at - target) / SAMPLES_PER_MS)
+        self.trigger(on, key, sample)
+
+    def trigger(self, on, key, sample):
+        if on:
+            self.piano.key_on(key, sample=sample)
+        else:
+            self.piano.key_off(key)
+
+    def record(self, values, value):
+        values.append(value)
+        if len(values) > MIDI_STATS_WINDOW:
+            del values[0]
+
+    def stats(self):
+        # Recent figures, in ms
+        def summary(values):
+            if not values:
+                return (0.0, 0.0, 0.0)
+            return (mean(values), pstdev(values), max(values))
+        return {
+            "events": self.count,
+            "input latency": summary(self.input_latency),
+            "schedule lead": summary(self.lead),
+            "trigger error": summary(self.jitter),
+            "late": self.late,
+            "resyncs": self.resyncs,
+            }
@@ -0,0 +1,165 @@
+import heapq
+from itertools import count as counter
+
+import numpy as np
+import pygame
+
+from audio import ROOT_NOTE_KEY
+from formats import G
+
+# Software mixer for the preview piano. Every sounding note is a Voice that
+# steps through its sample's PCM at its own rate; all voices are rendered
+# block by block into a single stereo stream, which is fed to its own reserved
+# pygame channel (G.MIXER_CHANNEL; the APU has G.APU_CHANNEL). Envelopes are applied per output sample.
+
+MIXER_RATE = 32000
+BLOCK_SIZE = 512
+MAX_VOICES = 64
+# Decoded samples are 15-bit; this brings one full-scale voice to 16-bit
+# with a little headroom for chords.
+MIXER_GAIN = 1.5
+
+def key_to_step(sample, key):
+    # Source samples advanced per output sample
+    return sample.get_pitch_as_scale() * 2 ** ((key - ROOT_NOTE_KEY) / 12)
+
+def envelope_levels(env, t, release_t=None, release_level=0):
+    """
+    Envelope gain (0-1) at each output sample index in t (samples since
+    key-on), from the S-DSP envelope tables. After key-off at release_t,
+    the hardware release runs down from release_level.
+    """
+    level = env.levels(t).astype(np.float32)
+    if release_t is not None:
+        released = t >= release_t
+        level[released] = env.release_levels(release_level, t[released] - release_t)
+    return level * (1 / 0x800)
+
+class Voice():
+    def __init__(self, sample, key):
+        self.smp = sample
+        self.key = key
+        self.env = sample.env
+        pcm = np.asarray(sample.get_single_pass_pcm(), dtype=np.float32)
+        self.length = len(pcm)
+        if sample.is_looped and sample.loop // 9 * 16 < self.length:
+            self.loop = sample.loop // 9 * 16
+            tail = pcm[self.loop]
+        else:
+            self.loop = None
+            tail = 0.0
+        # one extra point so interpolation past the last sample reads the
+        # sample it wraps (or ends) to
+        self.pcm = np.append(pcm, np.float32(tail))
+        self.step = key_to_step(sample, key)
+        self.pos = 0.0
+        self.t = 0
+        self.release_t = None
+        self.release_level = 0
+        self.active = True
+        self.finished = False
+
+    def key_off(self):
+        if self.active:
+            self.release_level = self.env.level(self.t)
+            self.release_t = self.t
+        self.active = False
+
+    def hold(self):
+        # Envelopes run inside the mixer; nothing to do per frame.
+        pass
+
+    def render(self, count):
+        pos = self.pos + self.step * np.arange(count, dtype=np.float64)
+        self.pos += self.step * count
+        if self.loop is not None:
+            looplen = self.length - self.loop
+            over = pos >= self.length
+            pos[over] = self.loop + (pos[over] - self.loop) % looplen
+            if self.pos >= self.length:
+                self.pos = self.loop + (self.pos - self.loop) % looplen
+            valid = count
+        else:
+            valid = int(np.searchsorted(pos, self.length - 1, side="right"))
+            pos = pos[:valid]
+            if self.pos >= self.length - 1:
+                self.finished = True
+        idx = pos.astype(np.int64)
+        frac = (pos - idx).astype(np.float32)
+        out = np.zeros(count, dtype=np.float32)
+        out[:valid] = self.pcm[idx] + (self.pcm[idx + 1] - self.pcm[idx]) * frac
+
+        t = np.arange(self.t, self.t + count)
+        level = envelope_levels(self.env, t, self.release_t, self.release_level)
+        self.t += count
+        if self.release_t is not None and level[-1] <= 0:
+            self.finished = True
+        return out * level
+
+class Mixer():
+    def __init__(self, max_voices=MAX_VOICES, block_size=BLOCK_SIZE):
+        self.max_voices = max_voices
+        self.block_size = block_size
+        self.voices = []
+        self.chn = None
+        # samples rendered so far; the clock scheduled events are placed on
+        self.clock = 0
+        # mixer clock at which the event being run was actually applied
+        self.clock_at = 0
+        self.events = []
+        self._event_order = counter()
+
+    def start(self):
+        # The channel is reserved at startup (impresaria.main), so
+        # find_channel() never hands it out for anything else
+        if self.chn is None:
+            self.chn = pygame.mixer.Channel(G.MIXER_CHANNEL)
+
+    def key_on(self, sample, key):
+        if len(self.voices) >= self.max_voices:
+            # steal a released voice if there is one, else the oldest
+            released = [v for v in self.voices if not v.active]
+            self.voices.remove(released[0] if released else self.voices[0])
+        voice = Voice(sample, key)
+        self.voices.append(voice)
+        return voice
+
+    def schedule(self, time, func, *args):
+        # Call func(*args) when rendering reaches sample `time` on the mixer
+        # clock (or at the start of the next block, if that's already past).
+        heapq.heappush(self.events, (time, next(self._event_order), func, args))
+
+    def render(self, count=None):
+        # Events due inside the block split it, so notes start on the exact
+        # sample they were scheduled for.
+        count = self.block_size if count is None else count
+        mix = np.zeros(count, dtype=np.float32)
+        pos = 0
+        while True:
+            end = count
+            if self.events:
+                end = min(count, max(pos, self.events[0][0] - self.clock))
+            if end > pos:
+                for voice in self.voices:
+                    mix[pos:end] += voice.render(end - pos)
+                self.voices = [v for v in self.voices if not v.finished]
+                pos = end
+            if pos >= count:
+                break
+            _, _, func, args = heapq.heappop(self.events)
+            self.clock_at = self.clock + pos
+            func(*args)
+        self.clock += count
+        out = np.clip(mix * MIXER_GAIN, -32768, 32767).astype(np.int16)
+        return np.repeat(out, 2).tobytes()
+
+    def update(self):
+        # Keep one block playing and one queued behind it, while there's
+        # anything to play.
+        self.start()
+        if not self.voices and not self.events:
+            return
+        if not self.chn.get_busy():
+            self.chn.play(pygame.mixer.Sound(buffer=self.render()))
+        if self.chn.get_queue() is None:
+            self.chn.queue(pygame.mixer.Sound(buffer=self.render()))
@@ -0,0 +1,259 @@
+import zlib
+
+import numpy as np
+
+# IPS and BPS patch output.
+#
+# Both start by finding the spans where the target differs from the source.
+# If the caller knows where changes can be (the ranges build_rom wrote), only
+# those are compared; otherwise the whole file is, a chunk at a time. The
+# patch is then written from the spans alone, so its cost follows the size
+# of the changes rather than the size of the ROM.
+
+DIFF_CHUNK = 0x10000
+# Spans closer together than this are merged (a record costs more than
+# repeating a few unchanged bytes)
+SPAN_MERGE_GAP = 8
+
+IPS_MAX_OFFSET = 0xFFFFFF
+IPS_MAX_RECORD = 0xFFFF
+IPS_EOF = 0x454F46
+# Runs of one byte at least this long get an RLE record
+IPS_RLE_MIN = 9
+
+# BPS source-copy search: windows of BPS_WINDOW bytes, sampled from the
+# source every BPS_STRIDE (a multiple of 8) bytes. A copy found this way is
+# at least BPS_WINDOW long.
+BPS_WINDOW = 32
+BPS_STRIDE = 16
+# Target windows hashed at a time
+BPS_FIND_CHUNK = 4096
+# Spans shorter than this are written as they are. Hashing the source costs
+# more than a copy out of it could save in a span this short.
+BPS_INDEX_MIN = 1024
+BPS_SOURCE_READ, BPS_TARGET_READ, BPS_SOURCE_COPY, BPS_TARGET_COPY = range(4)
+
+def merge_ranges(ranges, gap=0):
+    # (offset, length) ranges, sorted and merged, as [start, end)
+    merged = []
+    for start, length in sorted(ranges):
+        end = start + length
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def diff_spans(source, target, hints=None):
+    """
+    [start, end) spans of target that differ from source, or that are past
+    its end. hints: (offset, length) ranges outside of which source and
+    target are known to be the same; without them everything is compared.
+    """
+    common = min(len(source), len(target))
+    if hints is None:
+        hints = [(0, common)]
+    src = np.frombuffer(source, dtype=np.uint8)
+    tgt = np.frombuffer(target, dtype=np.uint8)
+    spans = []
+    for start, end in merge_ranges(hints):
+        end = min(end, common)
+        for pos in range(start, end, DIFF_CHUNK):
+            stop = min(pos + DIFF_CHUNK, end)
+            diff = np.flatnonzero(src[pos:stop] != tgt[pos:stop])
+            if not len(diff):
+                continue
+            # split where consecutive differing bytes are far apart
+            breaks = np.flatnonzero(np.diff(diff) > SPAN_MERGE_GAP)
+            firsts = np.concatenate(([diff[0]], diff[breaks + 1]))
+            lasts = np.concatenate((diff[breaks], [diff[-1]]))
+            spans.extend((pos + a, b + 1 - a) for a, b in zip(firsts.tolist(), lasts.tolist()))
+    if len(target) > len(source):
+        spans.append((len(source), len(target) - len(source)))
+    return [tuple(s) for s in merge_ranges(spans, SPAN_MERGE_GAP)]
+
+def make_ips(source, target, hints=None):
+    # Returns the patch, or None if the target is too big for IPS.
+    if len(target) > IPS_MAX_OFFSET + 1:
+        return None
+    out = bytearray(b"PATCH")
+
+    def records(pos, end, rle):
+        while pos < end:
+            if pos == IPS_EOF:
+                # A record can't start at the offset that reads as "EOF", so
+                # that byte goes in a literal starting a byte early instead.
+                out.extend((pos - 1).to_bytes(3, "big") + b"\x00\x02")
+                out.extend(target[pos-1:pos+1])
+                pos += 1
+                continue
+            n = min(end - pos, IPS_MAX_RECORD)
+            if rle:
+                out.extend(pos.to_bytes(3, "big") + b"\x00\x00")
+                out.extend(n.to_bytes(2, "big") + target[pos:pos+1])
+            else:
+                out.extend(pos.to_bytes(3, "big") + n.to_bytes(2, "big"))
+                out.extend(target[pos:pos+n])
+            pos += n
+
+    for start, end in diff_spans(source, target, hints):
+        pos = start
+        for run_start, run_end in long_runs(target, start, end):
+            records(pos, run_start, False)
+            records(run_start, run_end, True)
+            pos = run_end
+        records(pos, end, False)
+    out += b"EOF"
+    if len(target) < len(source):
+        out += len(target).to_bytes(3, "big")
+    return bytes(out)
+
+def long_runs(data, start, end):
+    # [start, end) of each run of one byte in data[start:end] that is at
+    # least IPS_RLE_MIN long
+    if end - start < IPS_RLE_MIN:
+        return []
+    arr = np.frombuffer(data, dtype=np.uint8, count=end - start, offset=start)
+    bounds = np.concatenate(([0], np.flatnonzero(arr[1:] != arr[:-1]) + 1, [len(arr)]))
+    long = np.flatnonzero(np.diff(bounds) >= IPS_RLE_MIN)
+    return list(zip((bounds[long] + start).tolist(), (bounds[long + 1] + start).tolist()))
+
+def bps_number(value):
+    out = bytearray()
+    while True:
+        x = value & 0x7F
+        value >>= 7
+        if not value:
+            out.append(0x80 | x)
+            return out
+        out.append(x)
+        value -= 1
+
+def bps_signed(value):
+    return bps_number((abs(value) << 1) | (value < 0))
+
+class SourceIndex():
+    # Hashes of source windows at every BPS_STRIDE bytes, sorted for lookup.
+    # A window is hashed as its four little-endian 64-bit words, each times
+    # its own odd constant, so the windows of a target span are hashed a
+    # word (not a byte) at a time, for each of the 8 alignments.
+    WEIGHTS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+            0x165667B19E3779F9, 0xD6E8FEB86659FD93], dtype=np.uint64)
+
+    # The last index built; a project patches against the same ROM every time
+    _last = None
+
+    @classmethod
+    def get(cls, source):
+        if cls._last is None or cls._last.source != source:
+            cls._last = cls(source)
+        return cls._last
+
+    def __init__(self, source):
+        self.source = source
+        words = np.frombuffer(source, dtype="<u8", count=len(source) // 8)
+        step = BPS_STRIDE // 8
+        count = (len(words) - 4) // step + 1 if len(words) >= 4 else 0
+        hashes = np.zeros(count, dtype=np.uint64)
+        for k in range(4):
+            hashes += words[k:k+step*count:step] * self.WEIGHTS[k]
+        # one window per distinct hash is enough (most of a ROM is padding)
+        self.hashes, self.order = np.unique(hashes, return_index=True)
+
+    def hash_from(self, target, start, stop):
+        # Hashes of the windows at start, start+8, ... that end by stop
+        count = (stop - start) // 8
+        words = np.frombuffer(target, dtype="<u8", count=count, offset=start)
+        hashes = np.zeros(max(count - 3, 0), dtype=np.uint64)
+        for k in range(4):
+            hashes += words[k:k+len(hashes)] * self.WEIGHTS[k]
+        return hashes
+
+    def find(self, target, start, end):
+        # First (target offset, source offset) in [start, end) where a
+        # source window matches, or None
+        if not len(self.hashes):
+            return None
+        for chunk in range(start, end - BPS_WINDOW + 1, BPS_FIND_CHUNK):
+            stop = min(end, chunk + BPS_FIND_CHUNK + BPS_WINDOW - 1)
+            found = []
+            for align in range(min(8, stop - chunk - BPS_WINDOW + 1)):
+                hashes = self.hash_from(target, chunk + align, stop)
+                at = np.searchsorted(self.hashes, hashes)
+                at[at == len(self.hashes)] = 0
+                found.extend((chunk + align + 8*q, int(self.order[at[q]]) * BPS_STRIDE)
+                        for q in np.flatnonzero(self.hashes[at] == hashes).tolist())
+            for t, s in sorted(found):
+                if self.source[s:s+BPS_WINDOW] == target[t:t+BPS_WINDOW]:
+                    return t, s
+        return None
+
+def match_length(source, target, s, t, limit):
+    # How many bytes from source[s] on match those from target[t] on, up to
+    # limit; compared a chunk at a time, starting small as most copies are
+    src = np.frombuffer(source, dtype=np.uint8)
+    tgt = np.frombuffer(target, dtype=np.uint8)
+    n = 0
+    step = 256
+    while n < limit:
+        k = min(step, limit - n)
+        diff = np.flatnonzero(src[s+n:s+n+k] != tgt[t+n:t+n+k])
+        if len(diff):
+            return n + int(diff[0])
+        n += k
+        step = min(step * 2, DIFF_CHUNK)
+    return limit
+
+def make_bps(source, target, hints=None, metadata=b""):
+    source, target = bytes(source), bytes(target)
+    out = bytearray(b"BPS1")
+    out += bps_number(len(source)) + bps_number(len(target))
+    out += bps_number(len(metadata)) + metadata
+    index = None
+    pos = 0
+    source_rel = 0
+    target_rel = 0
+
+    def action(kind, length):
+        out.extend(bps_number(((length - 1) << 2) | kind))
+
+    def literal(start, end):
+        # Target bytes as they are, except runs of one byte, which are
+        # written once and copied from themselves
+        nonlocal target_rel
+        pos = start
+        for run_start, run_end in long_runs(target, start, end):
+            action(BPS_TARGET_READ, run_start + 1 - pos)
+            out.extend(target[pos:run_start+1])
+            action(BPS_TARGET_COPY, run_end - run_start - 1)
+            out.extend(bps_signed(run_start - target_rel))
+            target_rel = run_end - 1
+            pos = run_end
+        if pos < end:
+            action(BPS_TARGET_READ, end - pos)
+            out.extend(target[pos:end])
+
+    for start, end in diff_spans(source, target, hints) + [(len(target), len(target))]:
+        if start > pos:
+            action(BPS_SOURCE_READ, start - pos)
+        pos = start
+        while pos < end:
+            if index is None and end - pos >= BPS_INDEX_MIN:
+                index = SourceIndex.get(source)
+            found = index.find(target, pos, end) if index is not None else None
+            lit_end = found[0] if found else end
+            if lit_end > pos:
+                literal(pos, lit_end)
+                pos = lit_end
+            if found:
+                t, s = found
+                length = BPS_WINDOW + match_length(source, target, s + BPS_WINDOW,
+                        t + BPS_WINDOW, min(end - t, len(source) - s) - BPS_WINDOW)
+                action(BPS_SOURCE_COPY, length)
+                out += bps_signed(s - source_rel)
+                source_rel = s + length
+                pos += length
+    out += zlib.crc32(source).to_bytes(4, "little")
+    out += zlib.crc32(target).to_bytes(4, "little")
+    out += zlib.crc32(out).to_bytes(4, "little")
+    return bytes(out)
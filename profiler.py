@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+from array import array
+from collections import deque
+from functools import wraps
+
+from messenger import log, err
+
+# Timing spans, for seeing where frame time goes.
+#
+#   with profiler.span("name"):     time a block
+#   @profiled("name")               time every call of a function
+#   profiler.frame()                once per frame, closes the frame's totals
+#
+# While the profiler is disabled a span is one attribute check and a shared
+# do-nothing context manager. While it's enabled, each span adds its time to
+# the current frame's total for its name (the overlay's histograms come from
+# the last PROFILE_FRAMES totals) and, if recording, keeps an event for the
+# Chrome trace export (chrome://tracing, or ui.perfetto.dev).
+
+PROFILE_FRAMES = 240
+# Events kept for trace export; the oldest are dropped past this
+TRACE_EVENTS = 200000
+
+class NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span():
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.start, time.perf_counter())
+        return False
+
+class Profiler():
+    def __init__(self, frames=PROFILE_FRAMES):
+        self.enabled = False
+        self.recording = False
+        # name -> deque of per-frame ms, oldest first
+        self.history = {}
+        self.frames = frames
+        self.frame_count = 0
+        self.current = {}
+        self.frame_start = time.perf_counter()
+        # (name, start, duration, thread id), times in s
+        self.events = deque(maxlen=TRACE_EVENTS)
+        self.epoch = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def add(self, name, start, end):
+        # Spans may end on other threads (tasks.py offloads, MIDI input)
+        with self.lock:
+            self.current[name] = self.current.get(name, 0.0) + (end - start)
+            if self.recording:
+                self.events.append((name, start, end - start, threading.get_ident()))
+
+    def frame(self):
+        # Ends the current frame: its totals go into the history, with 0 for
+        # anything that didn't run this frame.
+        now = time.perf_counter()
+        if not self.enabled:
+            self.frame_start = now
+            return
+        with self.lock:
+            current, self.current = self.current, {}
+        current["frame"] = now - self.frame_start
+        if self.recording:
+            self.events.append(("frame", self.frame_start, now - self.frame_start,
+                    threading.get_ident()))
+        self.frame_start = now
+        for name in current.keys() - self.history.keys():
+            self.history[name] = deque([0.0] * self.frame_count, maxlen=self.frames)
+        for name, times in self.history.items():
+            times.append(current.get(name, 0.0) * 1000)
+        self.frame_count = min(self.frame_count + 1, self.frames)
+
+    def set_enabled(self, enabled):
+        if enabled and not self.enabled:
+            self.clear()
+        self.enabled = enabled
+
+    def clear(self):
+        self.history = {}
+        self.frame_count = 0
+        with self.lock:
+            self.current = {}
+        self.frame_start = time.perf_counter()
+
+    def names(self):
+        # Span names, slowest (on average) first
+        return sorted(self.history, key=lambda n: -sum(self.history[n]))
+
+    def values(self, name):
+        # Per-frame ms for name, as the float array imgui's plots take
+        return array("f", self.history.get(name, ()))
+
+    def stats(self, name):
+        # (last, mean, max) ms per frame
+        times = self.history.get(name)
+        if not times:
+            return 0.0, 0.0, 0.0
+        return times[-1], sum(times) / len(times), max(times)
+
+    def export_trace(self, fn):
+        # Chrome trace event format: complete ("X") events, times in us
+        pid = 1
+        with self.lock:
+            events = list(self.events)
+        trace = [{"name": name, "ph": "X", "pid": pid, "tid": tid,
+                "ts": (start - self.epoch) * 1e6, "dur": duration * 1e6}
+                for name, start, duration, tid in events]
+        try:
+            with open(fn, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        except OSError as e:
+            err.send(f"Can't write {fn}: {e}")
+            return False
+        log.send(f"Exported {len(trace)} trace events to {fn}.")
+        return True
+
+profiler = Profiler()
+
+def profiled(name):
+    # Decorator: times every call of the function as a span
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with Span(profiler, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
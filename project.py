@@ -1,14 +1,29 @@
 from copy import copy
 import json
 
-from allocator import Allocator
+from allocator import Allocator, AllocRange
 from formats import byte_insert, int_insert, to_rom_address
-from messenger import IMPRESARIA_VERSION, log, std, err, repr_bank, pretty_bytes, vblank
+from messenger import IMPRESARIA_VERSION, log, std, err, repr_bank, pretty_bytes
+from projfile import (ProjectFile, pack_record, unpack_record, pack_sequence, unpack_sequence,
+        pack_sample, unpack_sample, pack_alloc, unpack_alloc)
+from rom import Rom
+from journal import Journal, JOURNAL_EXT
+from history import History
+from build import build_rom
+from patch import make_ips, make_bps
+from profiler import profiled
+
+# Project methods that journal entries replay through (besides
+# replace_sample and put_sequence, which carry a whole sample or sequence,
+# and remove_sample)
+JOURNAL_OPS = {"set_seq_name", "set_seq_inst", "set_smp_name", "set_smp_pitch",
+        "set_smp_env", "add_range", "release_range", "put_ranges"}
 
 class Project():
     def __init__(self, name, rom):
         self.init_status = False
         
+        self.name = name
         self.sourcefile = rom.fn
         self.src = rom
         self.format = rom.format
@@ -17,6 +32,24 @@ class Project():
         self.seq = {}
         self.brr = {}
         
+        # Bumped whenever any sequence or sample changes (through the
+        # setters below); keys for the derived views in self.views.
+        self.seq_version = 0
+        self.brr_version = 0
+        self.views = ViewCache()
+        # Reverse of each Sequence.inst: sample id -> {(sequence id, slot)}
+        self.sample_users = {}
+        
+        # Project file this was last saved to or loaded from, and the
+        # (object, version) each of its seq/brr sections was written from
+        self.filename = None
+        self.file = None
+        self.saved = {}
+        self.journal = None
+        self.replaying = False
+        self.compaction = None
+        self.history = History()
+        
         self.action_queue = []
         self.action_queue_kwargs = {}
         self.completed_actions = []
@@ -28,16 +61,156 @@ class Project():
         #self.pitch_table_auto = True
         #self.env_table_auto = True
         
-    def frame_init(self):
-        status = False
-        while vblank.ok and self.init_status is not True and status is not True:
-            status = self.src.frame_init(alloc=self.alloc)
-        if status is True:
-            self.seq = copy(self.src.seq)
-            self.brr = copy(self.src.brr)
-            self.init_status = True
-        return status
+    def start_init(self, runner):
+        # Loads the source ROM's contents into the project as a TaskRunner
+        # task; init_status becomes True when it's done.
+        return runner.add("Loading ROM", self.init_steps(), priority=1)
+        
+    def init_steps(self):
+        yield from self.src.init_steps(alloc=self.alloc)
+        self.seq = copy(self.src.seq)
+        self.brr = copy(self.src.brr)
+        self.brr_version += 1
+        self.rebuild_sample_users()
+        self.init_status = True
+        
+    def load_steps(self):
+        # Fills the project from self.file (see load_project)
+        pf = self.file
+        unpack_alloc(pf.read("alloc"), self.alloc)
+        names = pf.names("seq/") + pf.names("brr/")
+        for i, name in enumerate(names):
+            kind, idx = name.split("/")
+            idx = int(idx, 16)
+            if kind == "seq":
+                obj = unpack_sequence(pf.read(name))
+                self.seq[idx] = obj
+                self.alloc.set_data(f"seq{idx:02X}", obj.get_data(), key=("seq", obj.digest))
+            else:
+                obj = unpack_sample(pf.read(name), idx)
+                self.brr[idx] = obj
+                if idx < 256:
+                    self.alloc.set_data(f"brr{idx:02X}", obj.get_data(), key=("brr", obj.digest))
+            self.saved[name] = (obj, obj.version)
+            if i % 16 == 0:
+                yield (i, len(names), f"Loading {self.filename}")
+        self.brr_version += 1
+        self.rebuild_sample_users()
+        records = self.open_journal()
+        if records:
+            self.replay(records)
+            log.send(f"Recovered {len(records)} unsaved edits from the journal.")
+        self.history.clear()
+        self.init_status = True
+        
+    def file_sections(self):
+        # Section payloads for the project file, with None for seq/brr
+        # sections whose object hasn't changed since it was last saved to
+        # self.file. Also returns what to record in self.saved.
+        sections = {
+            "project": pack_record({
+                "version": IMPRESARIA_VERSION,
+                "name": self.name,
+                "sourcefile": self.sourcefile,
+                "format": self.format.id,
+                }),
+            "alloc": pack_alloc(self.alloc),
+            }
+        saved = {}
+        for kind, objs, pack in (("seq", self.seq, pack_sequence), ("brr", self.brr, pack_sample)):
+            for idx, obj in sorted(objs.items()):
+                name = f"{kind}/{idx:X}"
+                last = self.saved.get(name)
+                if (last is not None and last[0] is obj and last[1] == obj.version
+                        and name in self.file.index):
+                    sections[name] = None
+                else:
+                    sections[name] = pack(obj)
+                saved[name] = (obj, obj.version)
+        return sections, saved
+        
+    def save(self, fn=None):
+        # Saves to fn, or wherever the project was last saved. Saving again
+        # to the same file only appends what changed. Returns the number of
+        # bytes written, or None on failure.
+        fn = self.filename if fn is None else fn
+        if fn is None:
+            err.send("No filename to save the project to.")
+            return None
+        if fn != self.filename or self.file is None:
+            if self.file is not None:
+                self.file.close()
+            self.file = ProjectFile(fn)
+            self.saved = {}
+        try:
+            sections, saved = self.file_sections()
+            written = self.file.write(sections)
+        except OSError as e:
+            err.send(f"Can't save project to {fn}: {e}")
+            return None
+        self.filename = fn
+        self.saved = saved
+        # everything in the journal is in the file now
+        self.open_journal()
+        self.journal.clear()
+        log.send(f"Saved project to {fn} ({written} bytes written).")
+        return written
+        
+    def export_json(self, fn):
+        # Whole project as JSON, for interchange
+        try:
+            with open(fn, "w", encoding="utf-8") as f:
+                f.write(self.serialize())
+        except OSError as e:
+            err.send(f"Can't write {fn}: {e}")
+            return False
+        log.send(f"Exported project to {fn}.")
+        return True
             
+    def build_rom(self):
+        # See build.py
+        return build_rom(self)
+        
+    def export_rom(self, fn):
+        built = self.build_rom()
+        if built is None:
+            return False
+        try:
+            with open(fn, "wb") as f:
+                f.write(built[0])
+        except OSError as e:
+            err.send(f"Can't write {fn}: {e}")
+            return False
+        log.send(f"Exported ROM to {fn}.")
+        return True
+
+    def export_patch(self, fn, kind="ips"):
+        # Patch from the source ROM (as its file is, with any header) to the
+        # built one. Only the ranges the build wrote are compared.
+        built = self.build_rom()
+        if built is None:
+            return False
+        target, dirty = built
+        header = self.src.header or b""
+        source = header + self.src.rom()
+        hints = [(len(header) + offset, length) for offset, length in dirty]
+        if kind == "bps":
+            data = make_bps(source, target, hints)
+        else:
+            data = make_ips(source, target, hints)
+            if data is None:
+                err.send("Can't export IPS patch: the ROM is too big for IPS offsets. "
+                        "Use BPS instead.")
+                return False
+        try:
+            with open(fn, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            err.send(f"Can't write {fn}: {e}")
+            return False
+        log.send(f"Exported {kind.upper()} patch to {fn} ({len(data):X} bytes).")
+        return True
+        
     def repr_seq(self, idx):
         seq = self.seq[idx]
         name = seq.name if seq.name else "Unknown Sequence"
@@ -49,21 +222,296 @@ class Project():
         idx_text = f"@{idx-256:X}" if idx >= 256 else f"{idx:02X}"
         return f"{idx_text} {name} ({len(smp.data) // 9} blk)"
     
+    def replace_sample(self, idx, smp):
+        self.history.record("Replace sample", "brr", idx, self.brr.get(idx), smp)
+        self.put_sample(idx, smp)
+        
+    # Edits from the UI go through these, so the view caches, the journal
+    # and the undo history see them. They're no-ops if nothing actually
+    # changes. Samples and sequences are edited copy-on-write (see
+    # history.py).
+    def edit_sample(self, label, idx, method, *args):
+        old = self.brr[idx]
+        smp = old.copy()
+        getattr(smp, method)(*args)
+        if smp.version == old.version:
+            return False
+        self.history.record(label, "brr", idx, old, smp)
+        self.brr[idx] = smp
+        self.brr_version += 1
+        return True
+        
+    def edit_sequence(self, label, idx, method, *args):
+        old = self.seq[idx]
+        seq = old.copy()
+        getattr(seq, method)(*args)
+        if seq.version == old.version:
+            return False
+        self.history.record(label, "seq", idx, old, seq)
+        self.seq[idx] = seq
+        self.seq_version += 1
+        return True
+        
+    def set_seq_name(self, idx, name):
+        if self.edit_sequence("Rename sequence", idx, "set_name", name):
+            self.log_edit("set_seq_name", idx, name)
+        
+    def set_seq_inst(self, idx, slot, sample_id):
+        old = self.seq[idx].inst[slot]
+        if not self.edit_sequence("Change instrument", idx, "set_inst", slot, sample_id):
+            return
+        self.move_sample_user(idx, slot, old, sample_id)
+        self.log_edit("set_seq_inst", idx, slot, sample_id)
+        
+    def set_smp_name(self, idx, name):
+        if self.edit_sample("Rename sample", idx, "set_name", name):
+            self.log_edit("set_smp_name", idx, name)
+        
+    def set_smp_pitch(self, idx, pitch):
+        if self.edit_sample("Change pitch", idx, "set_pitch", pitch):
+            self.log_edit("set_smp_pitch", idx, pitch)
+        
+    def set_smp_env(self, idx, a, d, s, r):
+        if self.edit_sample("Change envelope", idx, "set_env", a, d, s, r):
+            self.log_edit("set_smp_env", idx, a, d, s, r)
+            
+    def add_range(self, start, end):
+        before = self.get_ranges()
+        self.alloc.add(start, end)
+        self.history.record("Add range", "ranges", None, before, self.get_ranges())
+        self.log_edit("add_range", start, end)
+        
+    def release_range(self, start, end):
+        before = self.get_ranges()
+        self.alloc.release(start, end)
+        self.history.record("Release range", "ranges", None, before, self.get_ranges())
+        self.log_edit("release_range", start, end)
+        
+    def get_ranges(self):
+        return [(r.start, r.end) for r in self.alloc.ranges]
+        
+    # These swap in a whole object or state with no history of their own;
+    # they're what undo and redo apply.
+    def put_sample(self, idx, smp):
+        old = self.brr.get(idx)
+        if smp is None:
+            self.brr.pop(idx, None)
+        else:
+            self.brr[idx] = smp
+        self.brr_version += 1
+        if idx < 256 and (old is None or smp is None or old.data is not smp.data):
+            self.alloc.set_data(f"brr{idx:02X}", None if smp is None else smp.get_data(),
+                    key=None if smp is None else ("brr", smp.digest))
+        if self.journaling:
+            self.journal_sample(idx, old, smp)
+        
+    def put_sequence(self, idx, seq):
+        old = self.seq[idx]
+        self.seq[idx] = seq
+        self.seq_version += 1
+        for slot in range(16):
+            if old.inst[slot] != seq.inst[slot]:
+                self.move_sample_user(idx, slot, old.inst[slot], seq.inst[slot])
+        if old.data is not seq.data:
+            self.alloc.set_data(f"seq{idx:02X}", seq.get_data(), key=("seq", seq.digest))
+        if self.journaling:
+            self.journal_sequence(idx, old, seq)
+        
+    # Journal records for a whole-object swap. When only fields the setters
+    # edit differ (as when undoing or redoing one of those edits), the
+    # setters' own ops are journaled instead of the whole object.
+    def journal_sample(self, idx, old, smp):
+        if smp is None:
+            self.log_edit("remove_sample", idx)
+        elif old is not None and old.data is smp.data and old.loop == smp.loop:
+            if old.name != smp.name:
+                self.log_edit("set_smp_name", idx, smp.name)
+            if old.pitch != smp.pitch:
+                self.log_edit("set_smp_pitch", idx, smp.pitch)
+            if old.env != smp.env:
+                env = smp.env
+                self.log_edit("set_smp_env", idx, env.a, env.d, env.s, env.r)
+        else:
+            self.log_edit("replace_sample", idx, data=pack_sample(smp))
+            
+    def journal_sequence(self, idx, old, seq):
+        if old.data is seq.data:
+            if old.name != seq.name:
+                self.log_edit("set_seq_name", idx, seq.name)
+            for slot in range(16):
+                if old.inst[slot] != seq.inst[slot]:
+                    self.log_edit("set_seq_inst", idx, slot, seq.inst[slot])
+        else:
+            self.log_edit("put_sequence", idx, data=pack_sequence(seq))
+        
+    def put_ranges(self, ranges):
+        self.alloc.ranges = [AllocRange(start, end) for start, end in ranges]
+        self.alloc.changed()
+        self.log_edit("put_ranges", ranges)
+        
+    def move_sample_user(self, idx, slot, old, sample_id):
+        users = self.sample_users.get(old)
+        if users is not None:
+            users.discard((idx, slot))
+            if not users:
+                del self.sample_users[old]
+        if sample_id:
+            self.sample_users.setdefault(sample_id, set()).add((idx, slot))
+            
+    def undo(self):
+        step = self.history.pop_undo()
+        if step is None:
+            return None
+        for kind, key, before, after in reversed(step.changes):
+            self.apply_change(kind, key, before)
+        return step.label
+        
+    def redo(self):
+        step = self.history.pop_redo()
+        if step is None:
+            return None
+        for kind, key, before, after in step.changes:
+            self.apply_change(kind, key, after)
+        return step.label
+        
+    def apply_change(self, kind, key, value):
+        if kind == "brr":
+            self.put_sample(key, value)
+        elif kind == "seq":
+            self.put_sequence(key, value)
+        elif kind == "ranges":
+            self.put_ranges(value)
+            
+    # Journal (see journal.py). It lives next to the project file, so there
+    # is one once the project has been saved or loaded.
+    @property
+    def journaling(self):
+        return self.journal is not None and not self.replaying
+        
+    def log_edit(self, op, *args, data=b""):
+        if self.journaling:
+            self.journal.append(op, *args, data=data)
+            
+    def open_journal(self):
+        # Returns the edits found in the journal
+        fn = self.filename + JOURNAL_EXT
+        if self.journal is not None:
+            if self.journal.fn == fn:
+                return []
+            self.journal.close()
+        self.journal = Journal(fn)
+        return self.journal.open()
+        
+    def replay(self, records):
+        self.replaying = True
+        try:
+            for op, args, data in records:
+                if op == "replace_sample":
+                    self.put_sample(args[0], unpack_sample(data, args[0]))
+                elif op == "remove_sample":
+                    self.put_sample(args[0], None)
+                elif op == "put_sequence":
+                    self.put_sequence(args[0], unpack_sequence(data))
+                elif op in JOURNAL_OPS:
+                    getattr(self, op)(*args)
+                else:
+                    err.send(f"Unknown journal entry '{op}', skipped.")
+        finally:
+            self.replaying = False
+            
+    def autosave(self, runner):
+        # Starts compacting the journal into the project file, if there's
+        # anything in it and that isn't already under way.
+        if self.journal is None or not self.journal.count or not self.init_status:
+            return
+        if self.compaction is not None and not self.compaction.finished:
+            return
+        self.compaction = runner.add("Autosave", self.compact_steps())
+        
+    def compact_steps(self):
+        yield (0, 1, "Autosaving")
+        self.save()
+        
+    # Cached views for the UI. Each is recomputed only when the versions it
+    # depends on change.
+    def seq_list_view(self):
+        return self.views.get("seq_list", (self.seq_version,),
+                lambda: [self.repr_seq(i) for i in range(len(self.seq))])
+        
+    def smp_list_view(self):
+        return self.views.get("smp_list", (self.brr_version,),
+                lambda: [self.repr_smp(i) for i in sorted(self.brr.keys())])
+                
+    def smp_id_list_view(self):
+        return self.views.get("smp_id_list", (self.brr_version,),
+                lambda: [f"{i:02X}" for i in range(len(self.get_samples())+1)])
+        
+    def address_view(self, id):
+        return self.views.get(("address", id), (self.alloc.version,),
+                self.alloc.get_address, id)
+        
+    def clones_view(self, idx):
+        return self.views.get(("clones", idx), (self.alloc.version, self.brr_version),
+                self.sample_get_clones, idx)
+                
+    def used_in_view(self, idx):
+        # {sequence id: [slots]} for sequences using sample idx
+        def used_in():
+            ret = {}
+            for seqid, slot in sorted(self.sample_users.get(idx, ())):
+                ret.setdefault(seqid, []).append(slot)
+            return ret
+        return self.views.get(("used_in", idx), (self.seq_version,), used_in)
+        
+    def usage_view(self):
+        return self.views.get("usage", (self.alloc.version,), self.alloc.repr_total_usage)
+            
     def get_samples(self):
         return {k: v for k, v in self.brr.items() if k < 256}
+        
+    def rebuild_sample_users(self):
+        self.seq_version += 1
+        self.sample_users = {}
+        for seqid, seq in self.seq.items():
+            for slot, sid in seq.inst.items():
+                if sid:
+                    self.sample_users.setdefault(sid, set()).add((seqid, slot))
+                    
+    def get_sample_users(self, idx):
+        # (sequence id, slot) pairs that use sample idx
+        return sorted(self.sample_users.get(idx, ()))
+        
+    def unused_samples(self):
+        # Sample ids (not counting fixed samples) no sequence refers to
+        return [k for k in sorted(self.get_samples()) if k not in self.sample_users]
+        
+    def bytes_freed_if_removed(self, ids):
+        # ROM space released if the samples in ids were removed. Data shared
+        # with a sample outside ids (see sample_get_clones) stays put.
+        ids = {f"brr{i:02X}" for i in ids if i < 256}
+        freed = 0
+        seen = set()
+        for id in ids:
+            key = self.alloc.data_index.get(id)
+            if key is None or key in seen:
+                continue
+            seen.add(key)
+            if ids.issuperset(self.alloc.data_blocks[key]):
+                freed += len(self.alloc.block_data[key])
+        return freed
 
     def sample_get_clones(self, idx):
         # Returns None if no duplicates, otherwise
         # returns two lists of IDs, one for non-exact and one for exact clones.
         idx_t = f"brr{idx:02X}"
-        bin = self.alloc.data_index[idx_t]
-        if len(self.alloc.data_blocks[bin]) <= 1:
+        key = self.alloc.data_index[idx_t]
+        if len(self.alloc.data_blocks[key]) <= 1:
             return None
 
         smp = self.brr[idx]
         partial_clones = []
         full_clones = []
-        for cloneid in self.alloc.data_blocks[bin]:
+        for cloneid in self.alloc.data_blocks[key]:
             if cloneid == idx_t:
                 continue
             try:
@@ -95,6 +543,7 @@ class Project():
             sav["brr"][k] = v.get_saveable()
         return json.dumps(sav)
 
+    @profiled("project.actions")
     def process_action_queue(self):
         # An action queue function returns:
         # - a list of action queue functions to append to the start of the queue
@@ -121,6 +570,32 @@ class Project():
     #def replace_sample_from_file(self, idx, fn, type=None):
         
             
+def load_project(fn, runner):
+    # Opens a project file. The source ROM it was made from has to be
+    # available. Returns the Project, whose contents are loaded by a task on
+    # runner, or None.
+    pf = ProjectFile(fn)
+    if not pf.open():
+        return None
+    buf = pf.read("project")
+    if buf is None:
+        err.send(f"Can't open project {fn}: no project information in file.")
+        pf.close()
+        return None
+    meta, _ = unpack_record(buf)
+    rom = Rom(meta["sourcefile"])
+    if not rom.is_valid:
+        err.send(f"Can't open project {fn}: source ROM {meta['sourcefile']} is missing or invalid.")
+        pf.close()
+        return None
+    if rom.format.id != meta["format"]:
+        log.send(f"Source ROM is now {rom.format.id}, project was made from {meta['format']}.")
+    prj = Project(meta["name"], rom)
+    prj.file = pf
+    prj.filename = fn
+    runner.add("Loading project", prj.load_steps(), priority=1)
+    return prj
+    
 class ActionQueueEntry():
     def __init__(self, func, text, *args, **kwargs):
         self.func = func
@@ -130,3 +605,16 @@ class ActionQueueEntry():
         
     def process(self, **kwargs):
         return self.func(*self.args, {**self.kwargs, **kwargs})
+        
+class ViewCache():
+    # Values derived from project data, stored with the versions of the data
+    # they were computed from.
+    def __init__(self):
+        self.entries = {}
+        
+    def get(self, key, versions, func, *args):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != versions:
+            entry = (versions, func(*args))
+            self.entries[key] = entry
+        return entry[1]
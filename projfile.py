@@ -0,0 +1,273 @@
+import json
+import mmap
+import os
+import struct
+
+from allocator import AllocRange
+from formats import content_digest
+from messenger import err
+from sample import Sample, Envelope
+from sequence import Sequence
+
+# Binary project container.
+#
+#   header    fixed size: magic, format version, where the index is
+#   sections  named blobs, stored back to back in the order they were written
+#   index     name, offset, length and digest of each current section
+#
+# Saving appends only the sections whose contents changed, then a new index,
+# and finally points the header at it, so an interrupted save leaves the old
+# index (and project) intact. Copies of sections that were superseded stay
+# in the file as dead space until it's rewritten in full (compacted).
+#
+# Files are opened with mmap; sections are sliced out only when asked for.
+
+PROJECT_EXT = ".imprj"
+PROJECT_MAGIC = b"IMPRPRJ\x00"
+PROJECT_FILE_VERSION = 1
+# magic, version, reserved, index offset, index length
+HEADER = struct.Struct("<8sIIQQ")
+# offset, length, digest, name length (name follows)
+INDEX_ENTRY = struct.Struct("<QQ16sH")
+# Compact when more than this fraction of the file is dead space
+COMPACT_RATIO = 0.5
+
+def pack_record(meta, data=b""):
+    # Section payload: a small JSON header followed by raw data
+    meta = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+    return len(meta).to_bytes(4, "little") + meta + bytes(data)
+
+def unpack_record(buf):
+    size = int.from_bytes(buf[:4], "little")
+    return json.loads(buf[4:4+size]), buf[4+size:]
+
+# Section payloads for project contents. Names are "seq/XX" and "brr/XX"
+# (hex ids), "alloc" and "project".
+
+def pack_sequence(seq):
+    return pack_record({
+        "inst": [seq.inst[i] for i in range(16)],
+        "name": seq.name,
+        "source_type": seq.source_type,
+        "source_detail": seq.source_detail,
+        }, seq.data)
+
+def unpack_sequence(buf):
+    meta, data = unpack_record(buf)
+    inst = b"".join(i.to_bytes(2, "little") for i in meta["inst"])
+    source = (meta["source_type"], meta["source_detail"]) if meta["source_type"] else None
+    seq = Sequence(data, inst, source=source, lookup=False)
+    seq.name = meta["name"]
+    return seq
+
+def pack_sample(smp):
+    return pack_record({
+        "loop": smp.loop,
+        "pitch": smp.pitch,
+        "env": [smp.env.a, smp.env.d, smp.env.s, smp.env.r],
+        "name": smp.name,
+        "source_type": smp.source_type,
+        "source_detail": smp.source_detail,
+        }, smp.data)
+
+def unpack_sample(buf, id):
+    # The sample's BRR isn't decoded until something needs its PCM
+    meta, data = unpack_record(buf)
+    smp = Sample(data, meta["loop"], meta["pitch"], Envelope(*meta["env"]), id=id,
+            lookup=False, decode=False)
+    if meta["source_type"]:
+        smp.set_source(meta["source_type"], meta["source_detail"])
+    smp.name = meta["name"]
+    return smp
+
+def pack_block_key(key):
+    # Allocator block keys are a digest, or (kind, digest)
+    if key is None:
+        return None
+    if isinstance(key, tuple):
+        return [key[0], key[1].hex()]
+    return ["", key.hex()]
+
+def unpack_block_key(key):
+    if key is None:
+        return None
+    kind, digest = key
+    return (kind, bytes.fromhex(digest)) if kind else bytes.fromhex(digest)
+
+def pack_alloc(alloc):
+    # Ranges and pins, plus data that isn't a sequence or sample (i.e. the
+    # tables); sequence and sample data is restored from those sections.
+    ids = sorted(id for id in alloc.data_index if id[:3] not in ("seq", "brr"))
+    return pack_record({
+        "ranges": [[r.start, r.end] for r in alloc.ranges],
+        "pins": {id: [addr, pack_block_key(key)] for id, (addr, key) in alloc.pins.items()},
+        "data": [[id, len(alloc.get_data(id))] for id in ids],
+        }, b"".join(alloc.get_data(id) for id in ids))
+
+def unpack_alloc(buf, alloc):
+    meta, data = unpack_record(buf)
+    alloc.ranges = [AllocRange(start, end) for start, end in meta["ranges"]]
+    alloc.pins = {id: (addr, unpack_block_key(key)) for id, (addr, key) in meta.get("pins", {}).items()}
+    alloc.changed()
+    pos = 0
+    for id, length in meta["data"]:
+        alloc.set_data(id, data[pos:pos+length])
+        pos += length
+
+class ProjectFile():
+    def __init__(self, fn):
+        self.fn = fn
+        # name -> (offset, length, digest)
+        self.index = {}
+        self.file = None
+        self.map = None
+        self.size = 0
+
+    def open(self):
+        # Returns False (and reports why) if the file isn't a readable project
+        self.close()
+        try:
+            self.file = open(self.fn, "rb")
+            self.size = os.fstat(self.file.fileno()).st_size
+            if self.size < HEADER.size:
+                raise ValueError("file is too short")
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, _, offset, length = HEADER.unpack_from(self.map, 0)
+            if magic != PROJECT_MAGIC:
+                raise ValueError("not a project file")
+            if version > PROJECT_FILE_VERSION:
+                raise ValueError(f"made by a newer version (file format {version})")
+            if offset + length > self.size:
+                raise ValueError("index is past the end of the file")
+            self.index = self.read_index(offset, length)
+        except (OSError, ValueError, struct.error) as e:
+            err.send(f"Can't open project {self.fn}: {e}")
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read_index(self, offset, length):
+        index = {}
+        pos, end = offset, offset + length
+        while pos < end:
+            sec_offset, sec_length, digest, namelen = INDEX_ENTRY.unpack_from(self.map, pos)
+            pos += INDEX_ENTRY.size
+            name = bytes(self.map[pos:pos+namelen]).decode("utf-8")
+            pos += namelen
+            if sec_offset + sec_length > self.size:
+                raise ValueError(f"section {name} is past the end of the file")
+            index[name] = (sec_offset, sec_length, digest)
+        return index
+
+    def pack_index(self):
+        index = bytearray()
+        for name, (offset, length, digest) in self.index.items():
+            name = name.encode("utf-8")
+            index += INDEX_ENTRY.pack(offset, length, digest, len(name)) + name
+        return bytes(index)
+
+    def names(self, prefix=""):
+        return [n for n in self.index if n.startswith(prefix)]
+
+    def read(self, name):
+        # Section contents, or None. Only this section's pages are read.
+        if name not in self.index or self.map is None:
+            return None
+        offset, length, _ = self.index[name]
+        return self.map[offset:offset+length]
+
+    def dead_space(self):
+        live = HEADER.size + sum(length for _, length, _ in self.index.values())
+        return self.size - live - len(self.pack_index())
+
+    def write(self, sections):
+        """
+        Save sections ({name: bytes}) as the new contents of the file. A
+        value of None keeps that section's current contents; names not in
+        sections are dropped. Returns the number of bytes written.
+        """
+        new = {}
+        for name, data in sections.items():
+            if data is None:
+                if name not in self.index:
+                    raise KeyError(f"no saved section {name} to keep")
+                continue
+            digest = content_digest(data)
+            if name in self.index and self.index[name][2] == digest:
+                continue
+            new[name] = (data, digest)
+
+        if self.map is None:
+            return self.write_full(sections, new)
+        dropped = [n for n in self.index if n not in sections]
+        if not new and not dropped:
+            return 0
+        kept = {n: v for n, v in self.index.items() if n in sections and n not in new}
+        stale = self.dead_space() + sum(self.index[n][1] for n in self.index if n not in kept)
+        if stale > self.size * COMPACT_RATIO:
+            return self.write_full(sections, new)
+
+        # Append the changed sections and an index, then switch the header
+        # over once they're safely on disk.
+        self.close()
+        written = 0
+        with open(self.fn, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            index = dict(kept)
+            for name, (data, digest) in new.items():
+                f.write(data)
+                index[name] = (pos, len(data), digest)
+                pos += len(data)
+                written += len(data)
+            self.index = index
+            packed = self.pack_index()
+            f.write(packed)
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(0)
+            f.write(HEADER.pack(PROJECT_MAGIC, PROJECT_FILE_VERSION, 0, pos, len(packed)))
+            f.flush()
+            os.fsync(f.fileno())
+            written += len(packed) + HEADER.size
+        self.open()
+        return written
+
+    def write_full(self, sections, new):
+        # Rewrite the whole file (without dead space) next to the old one,
+        # then swap it in.
+        blobs = {}
+        for name in sections:
+            if name in new:
+                blobs[name] = new[name]
+            else:
+                blobs[name] = (self.read(name), self.index[name][2])
+        self.close()
+        tmp = f"{self.fn}.tmp"
+        index = {}
+        with open(tmp, "wb") as f:
+            f.write(b"\x00" * HEADER.size)
+            pos = HEADER.size
+            for name in sections:
+                blob, digest = blobs[name]
+                f.write(blob)
+                index[name] = (pos, len(blob), digest)
+                pos += len(blob)
+            self.index = index
+            packed = self.pack_index()
+            f.write(packed)
+            f.seek(0)
+            f.write(HEADER.pack(PROJECT_MAGIC, PROJECT_FILE_VERSION, 0, pos, len(packed)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fn)
+        self.open()
+        return pos + len(packed)
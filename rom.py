@@ -1,21 +1,24 @@
-from formats import G, FORMATS, file_read, from_rom_address, load_rom_data_block
+from formats import G, file_read, from_rom_address, load_rom_data_block
 from sequence import Sequence
 from sample import Sample, Envelope
-from messenger import log, std, err, vblank
+from messenger import log, std, lookup_metadata_batch
+from scanner import identify, scan_file
 
 roms = {}
 
 class Rom():
     def __init__(self, fn, data=None):
         self.init_status = False
-        self._seq_init = 0
-        self._fixed_brr_init = 0
-        self._brr_init = 0
         
         self.max_brr = 255
         self.is_valid = False
         if not data:
-            data = file_read(fn, bin=True)
+            # don't read the whole file unless it's a ROM we can use
+            scan = scan_file(fn)
+            if scan.valid:
+                data = file_read(fn, bin=True)
+            else:
+                log.send(f"ERROR: {scan.describe()}")
         if data:
             self.format, self.header, data = self.identify_format(data)
             if self.format and len(data) >= self.format.original_romsize:
@@ -41,18 +44,16 @@ class Rom():
                 roms[fn] = data
             
     def identify_format(self, data):
-        for format in FORMATS.values():
-            address = format.scanner_address
-            end = address + len(format.scanner_data)
-            if data[address:end] == format.scanner_data:
-                log.queue(f"Found format {format.id}, no header.")
-                return format, None, data
-            elif data[address+0x200:end+0x200] == format.scanner_data:
-                log.queue(f"Found format {format.id}, with header.")
-                return format, data[:0x200], data[0x200:]
-            else:
-                log.send(f"ERROR: Unrecognized ROM format.")
-                return None, None, data
+        # Checks every registered format (see scanner.py)
+        format, header = identify(data)
+        if format is None:
+            log.send(f"ERROR: Unrecognized ROM format.")
+            return None, None, data
+        if header:
+            log.queue(f"Found format {format.id}, with header.")
+            return format, data[:header], data[header:]
+        log.queue(f"Found format {format.id}, no header.")
+        return format, None, data
     
     def identify_mapping_mode(self, data):
         modebyte = data[0xFFD5]
@@ -120,122 +121,118 @@ class Rom():
             if next_data_address > taddr:
                 self.max_brr = min(self.max_brr, (next_data_address - taddr) // entrysize)
             
-    # This starts/continues the second distinct initialization pass.
-    # Won't be called on temp files and the like that don't need it.
+    # The second distinct initialization pass, as a generator for a
+    # TaskRunner: loads one sequence or sample per step and yields progress.
+    # Won't be run on temp files and the like that don't need it.
     # Optionally, an Allocator object can be passed and fed each of these
-    # objects' locations as "usable space".
-    def frame_init(self, alloc=None):
-        #while vblank.ok and self.init_status is not True:
-        if self.init_status is not True:
-            if self._seq_init is not True:
-                sequences = self.seq
-                loc = self.seq_table_address
-                stbl = self.rom()[loc:loc+(self.seq_count*3)]
-                loc = self.inst_table_address
-                itbl = self.rom()[loc:loc+(self.seq_count*0x20)]
-                
-                i = self._seq_init
-                goal = self.seq_count - 1
-
-                seq_addr = from_rom_address(int.from_bytes(stbl[i*3:i*3+3], "little"))
-                inst = itbl[i*0x20:i*0x20+0x20]
-                seq = load_rom_data_block(self.rom(), seq_addr, seq=True)
-                seqobj = Sequence(seq, inst, source=("rom", (i, seq_addr)))
-                sequences[i] = seqobj
-                self.truncate_max_brr(seq_addr)
-                if alloc:
-                    alloc.add(seq_addr, length = len(seq) + 2)
-                    alloc.set_data(f"seq{i:02X}", seqobj.get_data())
-
-                self._seq_init = True if i == goal else i+1
-                self.seq = sequences
-                
-            elif self._fixed_brr_init is not True:
-                brrs = load_rom_data_block(self.rom(), self.format.spc_static_brr_address)
-                ptrs = load_rom_data_block(self.rom(), self.format.spc_static_ptr_address)
-                envs = load_rom_data_block(self.rom(), self.format.spc_static_env_address)
-                pits = load_rom_data_block(self.rom(), self.format.spc_static_pitch_address)
-                
-                i = self._fixed_brr_init
-                goal = (len(ptrs) // 4) - 1
-                ptr = int.from_bytes(ptrs[i*4:i*4+2], "little")
-                loop = int.from_bytes(ptrs[i*4+2:i*4+4], "little") - ptr
-                ptr -= self.format.brr_spc_ram_address
-                endptr = int.from_bytes(ptrs[i*4+4:i*4+6], "little") - self.format.brr_spc_ram_address
-                if i == goal:
-                    endptr = len(brrs)
-                # TODO - assumption is made here that samples are stored in order, may not always be
-                # the case?
-                brr = brrs[ptr:endptr]
-                pitch = int.from_bytes(pits[i*2:i*2+2], "big", signed=True)
-                env = Envelope(bin=envs[i*2:i*2+2])
-                
-                samp = Sample(brr, loop, pitch, env, id=f"@{i:X}")
-                samp.set_source("rom_fixed", (i, ptr + self.format.spc_static_brr_address + 2))
-                #self.brr[f"@{i:X}"] = samp                    
-                self.brr[i+256] = samp
-                
-                self._fixed_brr_init = True if i == goal else i+1
-                self._brr_init = 0 if i == goal else f"@{i:X}"
-            elif self._brr_init is not True:
-                
-                samples = self.brr
-                loc = self.brr_table_address
-                btbl = self.rom()[loc:loc+(self.max_brr*3)]
-                loc = self.loop_table_address
-                ltbl = self.rom()[loc:loc+(self.max_brr*2)]
-                loc = self.pitch_table_address
-                ptbl = self.rom()[loc:loc+(self.max_brr*2)]
-                loc = self.env_table_address
-                etbl = self.rom()[loc:loc+(self.max_brr*2)]
+    # objects' locations as "usable space". A ContentPool (see session.py)
+    # can be passed to share sequences and samples with other ROMs.
+    def init_steps(self, alloc=None, pool=None):
+        rom = self.rom()
+        loc = self.seq_table_address
+        stbl = rom[loc:loc+(self.seq_count*3)]
+        loc = self.inst_table_address
+        itbl = rom[loc:loc+(self.seq_count*0x20)]
+        
+        brrs = load_rom_data_block(rom, self.format.spc_static_brr_address)
+        ptrs = load_rom_data_block(rom, self.format.spc_static_ptr_address)
+        envs = load_rom_data_block(rom, self.format.spc_static_env_address)
+        pits = load_rom_data_block(rom, self.format.spc_static_pitch_address)
+        fixed_count = len(ptrs) // 4
+        
+        total = self.seq_count + fixed_count + self.max_brr
+        done = 0
+        yield (done, total, "Located ROM data tables.")
+        
+        for i in range(self.seq_count):
+            seq_addr = from_rom_address(int.from_bytes(stbl[i*3:i*3+3], "little"))
+            inst = itbl[i*0x20:i*0x20+0x20]
+            seq = load_rom_data_block(rom, seq_addr, seq=True)
+            if pool:
+                seqobj = pool.sequence(seq, inst, source=("rom", (i, seq_addr)))
+            else:
+                seqobj = Sequence(seq, inst, source=("rom", (i, seq_addr)), lookup=False)
+            self.seq[i] = seqobj
+            self.truncate_max_brr(seq_addr)
+            if alloc:
+                alloc.add(seq_addr, length = len(seq) + 2)
+                alloc.set_data(f"seq{i:02X}", seqobj.get_data(), key=("seq", seqobj.digest))
+                alloc.pin(f"seq{i:02X}", seq_addr)
+            done += 1
+            yield (done, total, f"Processing sequence {i} of {self.seq_count}")
+        
+        # sequence data may have lowered max_brr
+        total = self.seq_count + fixed_count + self.max_brr
+        for i in range(fixed_count):
+            ptr = int.from_bytes(ptrs[i*4:i*4+2], "little")
+            loop = int.from_bytes(ptrs[i*4+2:i*4+4], "little") - ptr
+            ptr -= self.format.brr_spc_ram_address
+            endptr = int.from_bytes(ptrs[i*4+4:i*4+6], "little") - self.format.brr_spc_ram_address
+            if i == fixed_count - 1:
+                endptr = len(brrs)
+            # TODO - assumption is made here that samples are stored in order, may not always be
+            # the case?
+            brr = brrs[ptr:endptr]
+            pitch = int.from_bytes(pits[i*2:i*2+2], "big", signed=True)
+            env = Envelope(bin=envs[i*2:i*2+2])
             
-                i = self._brr_init
-                goal = self.max_brr - 1
-
-                brr_addr = from_rom_address(int.from_bytes(btbl[i*3:i*3+3], "little"))
-                if brr_addr == 0 or brr_addr % 0x10000 == 0xFFFF or brr_addr > len(self.rom()):
-                    samples[i+1] = Sample()
+            source = ("rom_fixed", (i, ptr + self.format.spc_static_brr_address + 2))
+            if pool:
+                samp = pool.sample(brr, loop, pitch, env, f"@{i:X}", source)
+            else:
+                samp = Sample(brr, loop, pitch, env, id=f"@{i:X}", lookup=False)
+                samp.set_source(*source)
+            self.brr[i+256] = samp
+            done += 1
+            yield (done, total, f"Processing sample @{i:X}")
+            
+        loc = self.brr_table_address
+        btbl = rom[loc:loc+(self.max_brr*3)]
+        loc = self.loop_table_address
+        ltbl = rom[loc:loc+(self.max_brr*2)]
+        loc = self.pitch_table_address
+        ptbl = rom[loc:loc+(self.max_brr*2)]
+        loc = self.env_table_address
+        etbl = rom[loc:loc+(self.max_brr*2)]
+        
+        for i in range(self.max_brr):
+            brr_addr = from_rom_address(int.from_bytes(btbl[i*3:i*3+3], "little"))
+            if brr_addr == 0 or brr_addr % 0x10000 == 0xFFFF or brr_addr > len(rom):
+                self.brr[i+1] = pool.empty_sample() if pool else Sample()
+            else:
+                brr = load_rom_data_block(rom, brr_addr)
+                loop = int.from_bytes(ltbl[i*2:i*2+2], "little")
+                pitch = int.from_bytes(ptbl[i*2:i*2+2], "big", signed=True)
+                env = Envelope(bin=etbl[i*2:i*2+2])
+                if pool:
+                    samp = pool.sample(brr, loop, pitch, env, i+1, ("rom", (i+1, brr_addr)))
                 else:
-                    brr = load_rom_data_block(self.rom(), brr_addr)
-                    loop = int.from_bytes(ltbl[i*2:i*2+2], "little")
-                    pitch = int.from_bytes(ptbl[i*2:i*2+2], "big", signed=True)
-                    env = Envelope(bin=etbl[i*2:i*2+2])
-                    samp = Sample(brr, loop, pitch, env, id=i+1)
+                    samp = Sample(brr, loop, pitch, env, id=i+1, lookup=False)
                     samp.set_source("rom", (i+1, brr_addr))
-                    samples[i+1] = samp
-                    if alloc:
-                        alloc.add(brr_addr, length = len(brr) + 2)
-                        alloc.set_data(f"brr{i+1:02X}", samp.get_data())
-
-                self._brr_init = True if i == goal else i+1
-                self.brr = samples
-            if self._brr_init is True:
+                self.brr[i+1] = samp
                 if alloc:
-                    sequences = self.seq
-                    loc = self.seq_table_address
-                    stbl = self.rom()[loc:loc+(self.seq_count*3)]
-                    loc = self.inst_table_address
-                    itbl = self.rom()[loc:loc+(self.seq_count*0x20)]
-                    tableinfo = [
-                        (self.seq_table_address, stbl, G.SEQ_ID),
-                        (self.inst_table_address, itbl, G.INST_ID),
-                        (self.brr_table_address, btbl, G.BRR_ID),
-                        (self.loop_table_address, ltbl, G.LOOP_ID),
-                        (self.pitch_table_address, ptbl, G.PITCH_ID),
-                        (self.env_table_address, etbl, G.ENV_ID)
-                        ]
-                    for addr, table, id in tableinfo:
-                        alloc.add(addr, length=len(table))
-                        alloc.set_data(id, table)
-                self.init_status = True
-                return True
-        retstring = "Located ROM data tables."
-        if self._seq_init is True:
-            retstring += "\nSequences loaded."
-            retstring += f"\nProcessing sample {self._brr_init} of {self.max_brr}"
-        else:
-            retstring += f"\nProcessing sequence {self._seq_init} of {self.max_brr}"
-        return retstring
+                    alloc.add(brr_addr, length = len(brr) + 2)
+                    alloc.set_data(f"brr{i+1:02X}", samp.get_data(), key=("brr", samp.digest))
+                    alloc.pin(f"brr{i+1:02X}", brr_addr)
+            done += 1
+            yield (done, total, f"Processing sample {i} of {self.max_brr}")
+            
+        lookup_metadata_batch(self.seq.values(), self.brr.values())
+        
+        if alloc:
+            tableinfo = [
+                (self.seq_table_address, stbl, G.SEQ_ID),
+                (self.inst_table_address, itbl, G.INST_ID),
+                (self.brr_table_address, btbl, G.BRR_ID),
+                (self.loop_table_address, ltbl, G.LOOP_ID),
+                (self.pitch_table_address, ptbl, G.PITCH_ID),
+                (self.env_table_address, etbl, G.ENV_ID)
+                ]
+            for addr, table, id in tableinfo:
+                alloc.add(addr, length=len(table))
+                alloc.set_data(id, table)
+                alloc.pin(id, addr)
+        self.init_status = True
         
     def rom(self):
         return roms[self.fn]
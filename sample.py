@@ -1,15 +1,58 @@
+import audioop
+import hashlib
+import wave
 from array import array
+from copy import copy
 from base64 import b64encode
+
+import numpy as np
+
 from messenger import err, std, log, lookup_brr_metadata
-from formats import clamp
+from formats import clamp, content_digest
 from audio import scale_to_unity_key
+from brr import encode_brr, read_wav
 
 SAMPLE_EXTRA_ITERATIONS = 1
 SAMPLE_MIN_SIZE = 512
-STEREO = True
+SAMPLE_RATE = 32000
+
+# Bucket size of the finest waveform pyramid level (one BRR block), and the
+# factor between levels
+PYRAMID_BASE = 16
+PYRAMID_STEP = 4
+
+def build_minmax_pyramid(pcm):
+    # List of (bucket size, int16 array of [min, max] per bucket), finest
+    # first, down to a level of a single bucket.
+    levels = []
+    bucket = PYRAMID_BASE
+    count = -(-len(pcm) // bucket)
+    pad = count * bucket - len(pcm)
+    if pad:
+        # pad with the last value, which leaves min/max of the tail unchanged
+        pcm = np.concatenate((pcm, np.full(pad, pcm[-1], dtype=pcm.dtype)))
+    blocks = pcm.reshape(count, bucket)
+    level = np.stack((blocks.min(axis=1), blocks.max(axis=1)), axis=1)
+    levels.append((bucket, level))
+    while len(level) > 1:
+        count = -(-len(level) // PYRAMID_STEP)
+        pad = count * PYRAMID_STEP - len(level)
+        if pad:
+            level = np.concatenate((level, np.repeat(level[-1:], pad, axis=0)))
+        groups = level.reshape(count, PYRAMID_STEP, 2)
+        level = np.stack((groups[:, :, 0].min(axis=1), groups[:, :, 1].max(axis=1)), axis=1)
+        bucket *= PYRAMID_STEP
+        levels.append((bucket, level))
+    return levels
 
 class Sample():
-    def __init__(self, data=None, loop=None, pitch=None, env=None, id=""):
+    # Set by decode_brr; a sample made with decode=False decodes on first use
+    # of any of these.
+    DECODED_ATTRS = {"pcm", "pcmlooplen", "pcmsamples", "plot_pyramid", "_plot_cache"}
+    
+    def __init__(self, data=None, loop=None, pitch=None, env=None, id="", lookup=True, decode=True):
+        # lookup: fetch the name from the names database. Bulk loaders pass
+        # False and use messenger.lookup_metadata_batch instead.
         try:
             id = f" {id:02X}"
         except ValueError:
@@ -34,24 +77,55 @@ class Sample():
         self.source_type = ""
         self.source_detail = None
         self.name = ""
-        lookup_brr_metadata(self)
+        # Bumped on edits, for caches of derived views (see Project.views)
+        self.version = 0
+        if lookup:
+            lookup_brr_metadata(self)
+        
+        # pcm is mono 16-bit, native byte order. Anything that needs stereo
+        # (pygame's mixer) or floats (plotting) derives it on demand.
+        if decode:
+            self.decode_brr(self.data, self.loop, extend=True)
+            
+    def __getattr__(self, name):
+        # Only reached for attributes that aren't set yet
+        if name in Sample.DECODED_ATTRS:
+            self.decode_brr(self.data, self.loop, extend=True)
+            return self.__dict__[name]
+        raise AttributeError(name)
+        
+    @property
+    def data(self):
+        return self._data
+        
+    @data.setter
+    def data(self, data):
+        # Hashes of the old data go with it
+        self._data = data
+        self._digest = None
+        self._meta_hash = None
         
-        self.decode_brr(self.data, self.loop, extend=True)
+    @property
+    def digest(self):
+        # Content digest of the BRR data: dedup key in the allocator, and
+        # what clone detection and the note cache compare.
+        if self._digest is None:
+            self._digest = content_digest(self._data)
+        return self._digest
         
-        pcmfloats = []
-        stride = 4 if STEREO else 2
-        for i in range(len(self.pcm)//stride):
-            word = self.pcm[i*stride:i*stride+2]
-            intword = int.from_bytes(word, "little", signed=True)
-            pcmfloats.append(float(intword))
-        self.pcmarray = array('f', pcmfloats)
+    @property
+    def meta_hash(self):
+        # md5 of the BRR data, as used for keys in the names database
+        if self._meta_hash is None:
+            self._meta_hash = hashlib.md5(self._data).hexdigest()
+        return self._meta_hash
         
     def get_data(self):
         return (len(self.data)).to_bytes(2, "little") + self.data
         
     def get_split_loop_pcm(self):
         if self.is_looped:
-            truncate_point = len(self.pcm) - 64
+            truncate_point = len(self.pcm) - 16 * 2
             split_point = truncate_point - self.pcmlooplen
             onset = self.pcm[:split_point]
             loop = self.pcm[split_point:truncate_point]
@@ -59,6 +133,57 @@ class Sample():
         else:
             return self.pcm, b""
             
+    def get_single_pass_pcm(self):
+        # Onset plus one iteration of the loop, as 15-bit values.
+        pcm = array('h')
+        pcm.frombytes(self.pcm[:self.blocks * 16 * 2])
+        return pcm
+        
+    def get_plot_envelope(self, points, start=0, end=None):
+        # Waveform between sample positions start and end, reduced to at most
+        # `points` values (min, max, min, max... when reduced) for plotting.
+        # Draws from the finest pyramid level whose buckets fit in the width,
+        # so the cost follows the widget size rather than the sample length.
+        points = max(2, int(points))
+        end = self.pcmsamples if end is None else min(end, self.pcmsamples)
+        start = clamp(0, int(start), max(0, end - 1))
+        key = (points, start, end)
+        if self._plot_cache[0] == key:
+            return self._plot_cache[1]
+        if end - start <= points:
+            env = np.frombuffer(self.pcm, dtype=np.int16)[start:end].astype(np.float32)
+        else:
+            # falls through to the coarsest level if nothing fits
+            for bucket, level in self.plot_pyramid:
+                if -(-(end - start) // bucket) * 2 <= points:
+                    break
+            env = level[start // bucket:-(-end // bucket)].astype(np.float32).ravel()
+        self._plot_cache = (key, env)
+        return env
+        
+    def set_name(self, name):
+        if self.name != name:
+            self.name = name
+            self.version += 1
+            
+    def set_pitch(self, pitch):
+        if self.pitch != pitch:
+            self.pitch = pitch
+            self.version += 1
+            
+    def set_env(self, a, d, s, r):
+        # A new Envelope rather than a changed one, as copies share it
+        env = self.env
+        if (env.a, env.d, env.s, env.r) != (a, d, s, r):
+            self.env = Envelope(a, d, s, r)
+            self.version += 1
+            
+    def copy(self):
+        # Shallow copy, sharing the data and everything decoded from it.
+        # For copy-on-write edits (see history.py); none of the set_
+        # methods change shared objects.
+        return copy(self)
+            
     def set_source(self, source, detail):
         source = source.lower()
         if source == "rom":
@@ -78,37 +203,38 @@ class Sample():
         return round(ret) if int else ret
         
     def decode_brr(self, brr, loop, extend=False):
-        channels = 2 if STEREO else 1
-        looplength = ((len(brr) - loop) // 9) * 16 * channels
-        orig_len = len(brr)
+        # samples of output per pass through the looped section
+        looplength = ((len(brr) - loop) // 9) * 16
         
-        pcm = bytearray()
+        pcm = array('h')
         pre = 0
         prepre = 0
         loc = 0
         loops = 0
+        # decoder state and output position on each entry to the loop start
+        entries = []
         while True:
+            if loc == loop and not loops:
+                entries.append((pre, prepre, len(pcm)))
             block = brr[loc:loc+9]
             pcm_samples, pre, prepre = self.decode_block(block, pre, prepre)
-            
-            for p in pcm_samples:
-                ext = p.to_bytes(2, "little", signed=True)
-                for i in range(channels):
-                    pcm.extend(ext)
+            pcm.extend(pcm_samples)
                 
             if block[0] & 0b11 == 0b11:
                 if (extend
                         and loops >= SAMPLE_EXTRA_ITERATIONS
-                        and len(pcm) >= SAMPLE_MIN_SIZE * channels
+                        and len(pcm) * 2 >= SAMPLE_MIN_SIZE
                         ):
-                    valid = self.validate_loop(pcm, looplength, orig_len)
+                    valid = self.validate_loop(pcm, entries, (pre, prepre), len(brr))
                     if valid:
-                        looplength *= valid
+                        # (valid is in half passes)
+                        looplength = looplength * valid // 2
                         #std.send(f"\n  Loop extended by {valid}x (total iterations {loops+1})")
                         #std.send(f"  loop size {looplength}, sample size {len(pcm)}")
                         break
                 loops += 1
                 loc = loop
+                entries.append((pre, prepre, len(pcm)))
                 continue
             elif block[0] & 1:
                 break
@@ -119,8 +245,11 @@ class Sample():
                 break
         
         #std.send(f"pcm is {len(pcm)}, looplength {looplength}")
-        self.pcm = pcm
-        self.pcmlooplen = looplength
+        self.pcm = pcm.tobytes()
+        self.pcmlooplen = looplength * 2
+        self.pcmsamples = len(pcm)
+        self.plot_pyramid = build_minmax_pyramid(np.frombuffer(self.pcm, dtype=np.int16))
+        self._plot_cache = (None, None)
         
             
     def decode_block(self, block, pre, prepre):
@@ -166,18 +295,41 @@ class Sample():
             pre = pcm
         return pcms, pre, prepre
 
-    def validate_loop(self, pcm, looplen, orig_len):
-        lstart = len(pcm) - looplen
-        lscale = 1
+    def validate_loop(self, pcm, entries, state, orig_len):
+        # Find the smallest number of half passes through the loop after
+        # which the output repeats, i.e. the last n half passes equal the n
+        # before them. (Half, as the old stereo decoder measured the loop in
+        # samples but compared bytes; a silent tail repeats every half
+        # pass.) The decoder state when a pass starts determines its whole
+        # output, so whole passes are compared by the states at their
+        # boundaries instead of PCM.
+        # entries holds (pre, prepre, pcm position) at the start of each pass
+        # and state is the decoder state now, at the end of the latest one.
+        # As before, spans are only compared while the earlier one starts
+        # past orig_len, as measured in the old stereo output (4 bytes per
+        # sample).
+        bounds = entries + [(*state, len(pcm))]
+        passes = len(bounds) - 1
+        half = (len(pcm) - bounds[-2][2]) // 2
+        n = 0
         while True:
-            lstart = len(pcm) - looplen * lscale
-            prelstart = lstart - looplen * lscale
-            if prelstart <= orig_len:
-                break
-            if pcm[lstart:] == pcm[prelstart:lstart]:
-                return lscale
-            lscale += 1
-        return False
+            n += 1
+            mid = len(pcm) - half * n
+            first = mid - half * n
+            if first * 4 <= orig_len:
+                return False
+            if n % 2 == 0 and n <= passes:
+                now, mid_state, first_state = bounds[passes], bounds[passes - n//2], bounds[passes - n]
+                if now[:2] != mid_state[:2]:
+                    # the two spans end in different states, so they differ
+                    continue
+                if mid_state[:2] == first_state[:2]:
+                    return n
+            # Different starting states can still produce the same output
+            # (e.g. if the loop starts on a filter 0 block), so check, once
+            # the spans' last samples (their end states) agree.
+            if pcm[mid-2:mid] == pcm[-2:] and pcm[mid:] == pcm[first:mid]:
+                return n
         
     def get_saveable(self):
         sav = {}
@@ -209,20 +361,39 @@ class Envelope():
         val[1] = (self.s << 5) + self.r
         return val
 
+    def curve(self):
+        return envelope_curve(self.a, self.d, self.s, self.r)
+        
+    def levels(self, t):
+        # Envelope level (0 - ENV_MAX) at each sample index t after key-on,
+        # while the key is held
+        times, levels = self.curve()[:2]
+        return levels[np.searchsorted(times, t, side="right") - 1]
+        
+    def level(self, t):
+        return int(self.levels(np.array([t]))[0])
+        
+    def release_levels(self, start_level, dt):
+        # Envelope dt samples after key-off at start_level
+        return np.maximum(0, start_level - ENV_RELEASE_STEP * np.asarray(dt))
+        
     def attack_time(self):
-        return self.attack_table[self.a]
+        return self.curve()[2] * 1000 / SAMPLE_RATE
         
     def decay_time(self):
-        dt = int(self.decay_table[self.d] * (1 - self.sustain_level()))
-        # this seems wrong / too long but i can't find the error so
-        # temporarily just adjusting this by feel
-        return dt // 1.25
+        curve = self.curve()
+        return (curve[3] - curve[2]) * 1000 / SAMPLE_RATE
         
     def sustain_level(self):
         return (self.s + 1) / 8
         
     def release_time(self):
-        return self.release_table[self.r]
+        # Time from the end of decay to silence at the sustain rate, in ms;
+        # None if the note sustains indefinitely
+        times, levels, _, decay_end = self.curve()
+        if levels[-1]:
+            return None
+        return (times[-1] - decay_end) * 1000 / SAMPLE_RATE
         
     def __eq__(self, other):
         if (self.a == other.a and self.d == other.d
@@ -230,84 +401,104 @@ class Envelope():
             return True
         return False
         
-    attack_table = {
-        0: 4100,
-        1: 2600,
-        2: 1500,
-        3: 1000,
-        4: 640,
-        5: 380,
-        6: 260,
-        7: 160,
-        8: 96,
-        9: 64,
-        10: 40,
-        11: 24,
-        12: 16,
-        13: 10,
-        14: 6,
-        15: 0 }
+# S-DSP envelope generator. The envelope is an 11-bit value, stepped each
+# time the global counter fires for the current rate (0 never fires; 31
+# fires every sample). Attack adds 32 (1024 at rate 31) at rate A*2+1, decay
+# and sustain subtract env/256 + 1 at rates D*2+16 and SR, and decay becomes
+# sustain when the next step would land in the sustain level's 1/8 band.
+# Release (key-off) subtracts 8 every sample. Counter offsets between
+# rates are ignored: rate n fires on samples that are multiples of its
+# period, counting from key-on.
+ENV_MAX = 0x7FF
+ENV_RELEASE_STEP = 8
+ENV_RATE_PERIODS = (
+    None, 2048, 1536, 1280, 1024, 768, 640, 512,
+    384, 320, 256, 192, 160, 128, 96, 80,
+    64, 48, 40, 32, 24, 20, 16, 12,
+    10, 8, 6, 5, 4, 3, 2, 1)
 
-    decay_table = {
-        0: 1200,
-        1: 740,
-        2: 440,
-        3: 290,
-        4: 180,
-        5: 110,
-        6: 74,
-        7: 37 }
-        
-    release_table = {
-        0: None,
-        1: 38000,
-        2: 38000,
-        3: 24000,
-        4: 19000,
-        5: 14000,
-        6: 12000,
-        7: 9400,
-        8: 7100,
-        9: 5900,
-        10: 4700,
-        11: 3500,
-        12: 2900,
-        13: 2400,
-        14: 1800,
-        15: 1500,
-        16: 1200,
-        17: 880,
-        18: 740,
-        19: 590,
-        20: 440,
-        21: 370,
-        22: 290,
-        23: 220,
-        24: 180,
-        25: 150,
-        26: 110,
-        27: 92,
-        28: 74,
-        29: 55,
-        30: 37,
-        31: 28 }
+_envelope_curves = {}
+
+def envelope_curve(a, d, s, r):
+    """
+    Step curve of the envelope for one ADSR setting, while the key is held:
+    (times, levels, attack end, decay end), where the envelope takes
+    levels[i] from sample times[i] on. times is uint32, levels uint16.
+    Computed once per setting.
+    """
+    key = (a, d, s, r)
+    if key in _envelope_curves:
+        return _envelope_curves[key]
+    times = [0]
+    levels = [0]
+    env = 0
+    mode = "attack"
+    t = 0
+    attack_end = decay_end = None
+    while True:
+        if mode == "attack":
+            rate = a * 2 + 1
+            nxt = env + (0x400 if rate == 31 else 0x20)
+        else:
+            rate = d * 2 + 16 if mode == "decay" else r
+            nxt = env - 1 - ((env - 1) >> 8)
+            if mode == "decay" and nxt >> 8 == s:
+                # sustain takes over from the next sample; this one still
+                # runs at the decay rate, and stores nxt if that fires now
+                mode = "sustain"
+                decay_end = t
+                if t % ENV_RATE_PERIODS[rate] == 0:
+                    env = nxt
+                    times.append(t)
+                    levels.append(env)
+                t += 1
+                continue
+        if not rate:
+            break
+        period = ENV_RATE_PERIODS[rate]
+        fire = -(-t // period) * period
+        if nxt > ENV_MAX:
+            # attack overflows: decay starts at once, and the clamped value
+            # is only kept if the counter fires on this very sample
+            mode = "decay"
+            attack_end = t
+            if fire == t:
+                times.append(t)
+                levels.append(ENV_MAX)
+                env = ENV_MAX
+            t += 1
+            continue
+        env = max(0, nxt)
+        times.append(fire)
+        levels.append(env)
+        t = fire + 1
+        if not env:
+            break
+    if attack_end is None:
+        attack_end = t
+    if decay_end is None:
+        decay_end = t
+    curve = (np.array(times, dtype=np.uint32), np.array(levels, dtype=np.uint16),
+            attack_end, decay_end)
+    _envelope_curves[key] = curve
+    return curve
+    
         
+# Maps a BRR block header to 1 if it has the end flag set, otherwise 0.
+END_FLAG_TABLE = bytes(i & 1 for i in range(256))
+
 # Walk through a BRR sample to record some basic info about it.
 # Returns [# of blocks until end, or None if no end], [True if looped],
 #                        [True if no extra data is attached afterward]
 def walk_brr(brr):
-    end = None
-    loop = False
-    proper = False
-    i = 0
-    while i < len(brr):
-        if brr[i] & 1:
-            end = i // 9 + 1
-            loop = True if brr[i] & 2 else False
-            break
-        i += 9
-    if end and len(brr) == end * 9:
-        proper = True
+    # Every 9th byte is a block header; find the first one flagged as the end.
+    headers = bytes(brr[::9]).translate(END_FLAG_TABLE)
+    i = headers.find(1)
+    if i < 0:
+        return None, False, False
+    end = i + 1
+    loop = True if brr[i * 9] & 2 else False
+    proper = True if len(brr) == end * 9 else False
     return end, loop, proper
     
 def decode_brr_akaotool_ver(brr, stereo=False):
@@ -359,3 +550,36 @@ def decode_brr_akaotool_ver(brr, stereo=False):
             break
     return pcm
     
+
+def scale_to_pitch(scale):
+    # inverse of Sample.get_pitch_as_scale, limited to the table's range
+    return clamp(-0x8000, round(scale * 0x10000) - 0x10000, 0x7FFF)
+
+def sample_from_pcm(pcm, loop=None, pitch=0, env=None, id="", processes=None):
+    # Encode 16-bit mono PCM at 32kHz (little-endian bytes or a sequence of
+    # ints) into a new Sample. loop is a sample index (not a byte offset).
+    data, loop_offset, ratio = encode_brr(pcm, loop, processes=processes)
+    if ratio != 1:
+        pitch = scale_to_pitch(((pitch + 0x10000) / 0x10000) * ratio)
+    return Sample(data, loop_offset, pitch, env, id=id)
+
+def sample_from_wav(fn, id="", processes=None):
+    try:
+        pcm, rate, loop = read_wav(fn)
+    except (wave.Error, EOFError, IOError) as e:
+        err.send(f"Could not read WAV file {fn}: {e}")
+        return None
+    if rate != SAMPLE_RATE:
+        pcm, _ = audioop.ratecv(pcm, 2, 1, rate, SAMPLE_RATE, None)
+        if loop is not None:
+            loop = round(loop * SAMPLE_RATE / rate)
+    if not pcm:
+        err.send(f"WAV file {fn} contains no audio")
+        return None
+    if loop is not None and loop >= len(pcm) // 2:
+        loop = None
+    smp = sample_from_pcm(pcm, loop, id=id, processes=processes)
+    smp.set_source("file", fn)
+    log.send(f"Imported {fn} as {len(smp.data) // 9} blocks"
+            + (f", loop at block {smp.loop // 9}." if smp.is_looped else "."))
+    return smp
@@ -0,0 +1,144 @@
+import mmap
+import os
+
+from formats import G, FORMATS, from_rom_address
+from messenger import log, err
+
+# ROM identification without loading the ROM.
+#
+# Every registered format (formats.FORMATS, see register_format) is checked
+# for its scanner signature with and without a copier header, then the table
+# pointers it names are read and checked against the file. Files are mapped
+# rather than read, so only the pages holding the signature, the pointers and
+# the cartridge header are touched; identifying a file costs a few KB of I/O
+# however big it is.
+
+COPIER_HEADER = 0x200
+MAPPING_MODE_ADDRESS = 0xFFD5
+ROM_EXTENSIONS = (".smc", ".sfc")
+
+# table id: format attribute of the ASM pointer to it
+TABLE_POINTERS = {
+    G.SEQ_ID: "asm_seq_pointer_address",
+    G.INST_ID: "asm_inst_table_address",
+    G.BRR_ID: "asm_brr_pointer_address",
+    G.LOOP_ID: "asm_brr_loop_address",
+    G.PITCH_ID: "asm_brr_pitch_address",
+    G.ENV_ID: "asm_brr_env_address",
+    }
+
+class ScanResult():
+    def __init__(self, fn, size):
+        self.fn = fn
+        self.size = size
+        self.format = None
+        self.header_size = 0
+        # table id -> ROM offset (without header)
+        self.tables = {}
+        self.seq_count = 0
+        self.mapping_mode = None
+        self.problems = []
+
+    @property
+    def valid(self):
+        return self.format is not None and not self.problems
+
+    def describe(self):
+        if self.format is None:
+            return f"{self.fn}: unrecognized"
+        header = "with header" if self.header_size else "no header"
+        text = f"{self.fn}: {self.format.id}, {header}, {self.seq_count} sequences"
+        if self.problems:
+            text += " - " + "; ".join(self.problems)
+        return text
+
+def identify(buf, size=None):
+    # (format, header size) of the first registered format whose signature
+    # is in buf, or (None, 0)
+    size = len(buf) if size is None else size
+    for format in FORMATS.values():
+        for header in (0, COPIER_HEADER):
+            address = format.scanner_address + header
+            end = address + len(format.scanner_data)
+            if end <= size and buf[address:end] == format.scanner_data:
+                return format, header
+    return None, 0
+
+def validate(result, buf):
+    # Fills in and checks the tables of an identified ROM
+    format, base = result.format, result.header_size
+    romsize = result.size - base
+
+    def read(addr, length):
+        if addr + length > romsize:
+            return None
+        return buf[base+addr:base+addr+length]
+
+    if romsize < format.original_romsize:
+        result.problems.append(f"too small (${romsize:X} bytes)")
+    # (an unexpected mapping mode is only logged when the ROM is loaded)
+    mode = read(MAPPING_MODE_ADDRESS, 1)
+    result.mapping_mode = mode[0] if mode else None
+    count = read(format.sequence_count_address, 1)
+    result.seq_count = count[0] if count else 0
+    if not result.seq_count:
+        result.problems.append("no sequences")
+    for id, attr in TABLE_POINTERS.items():
+        pointer = read(getattr(format, attr), 3)
+        if pointer is None:
+            result.problems.append(f"table pointer for {id} is past the end of the file")
+            continue
+        addr = from_rom_address(int.from_bytes(pointer, "little"))
+        if not addr or addr >= romsize:
+            result.problems.append(f"table {id} at ${addr:06X} is outside the ROM")
+        result.tables[id] = addr
+
+def scan_file(fn):
+    # ScanResult for one file; problems reading it count as unrecognized
+    try:
+        with open(fn, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            result = ScanResult(fn, size)
+            if not size:
+                return result
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                result.format, result.header_size = identify(buf, size)
+                if result.format is not None:
+                    validate(result, buf)
+    except (OSError, ValueError) as e:
+        err.send(f"Can't scan {fn}: {e}")
+        return ScanResult(fn, 0)
+    return result
+
+def scan_data(data, fn=""):
+    # As scan_file, for ROM data already in memory
+    result = ScanResult(fn, len(data))
+    result.format, result.header_size = identify(data)
+    if result.format is not None:
+        validate(result, data)
+    return result
+
+def scan_directory(path, extensions=ROM_EXTENSIONS, recursive=False):
+    # Generator of ScanResults for the ROM files in a directory
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        err.send(f"Can't scan {path}: {e}")
+        return
+    for entry in sorted(entries, key=lambda e: e.name):
+        if entry.is_dir():
+            if recursive:
+                yield from scan_directory(entry.path, extensions, recursive)
+        elif entry.name.lower().endswith(extensions):
+            yield scan_file(entry.path)
+
+def find_roms(path, recursive=False):
+    # Files in path that are supported ROMs, with a log line for each file
+    # that isn't
+    found = []
+    for result in scan_directory(path, recursive=recursive):
+        if result.valid:
+            found.append(result)
+        else:
+            log.send(f"Skipped {result.describe()}")
+    return found
@@ -0,0 +1,79 @@
+import threading
+import time
+
+from messenger import OPT
+from profiler import profiler
+
+# Main loop pacing. Between frames the GUI thread sleeps until whichever
+# comes first: the next frame, the next due task, or a wake() from another
+# thread (e.g. MIDI input arriving). Tasks run on the GUI thread, so they
+# can touch the project and audio state without locking.
+
+class PeriodicTask():
+    def __init__(self, name, func, interval, budget=None, on_wake=False):
+        # interval, budget: ms. If budget is given, it's passed to func as
+        # the time it may spend before returning.
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.budget = budget
+        self.on_wake = on_wake
+        self.next_due = 0.0
+        self.runs = 0
+        self.last_duration = 0.0
+        self.overruns = 0
+        self.span_name = f"scheduler: {name}"
+
+    def run(self, now):
+        with profiler.span(self.span_name):
+            if self.budget is None:
+                self.func()
+            else:
+                self.func(self.budget)
+        done = time.perf_counter()
+        self.last_duration = (done - now) * 1000
+        if self.budget is not None and self.last_duration > self.budget:
+            self.overruns += 1
+        self.runs += 1
+        # don't try to catch up on missed runs
+        self.next_due = max(self.next_due + self.interval / 1000, done)
+
+class FrameScheduler():
+    def __init__(self, frame_interval=None):
+        # frame_interval: ms, defaults to OPT.frame_interval (read each frame)
+        self.frame_interval = frame_interval
+        self.tasks = []
+        self.last_frame = time.perf_counter()
+        self._wake = threading.Event()
+
+    def add(self, name, func, interval, budget=None, on_wake=False):
+        task = PeriodicTask(name, func, interval, budget, on_wake)
+        self.tasks.append(task)
+        return task
+
+    def wake(self):
+        # Safe to call from any thread
+        self._wake.set()
+
+    def wait_for_frame(self):
+        # Run due tasks and sleep in between, until it's time for the next frame.
+        interval = (self.frame_interval or OPT.frame_interval) / 1000
+        frame_deadline = self.last_frame + interval
+        while True:
+            start = time.perf_counter()
+            for task in self.tasks:
+                if task.next_due <= start:
+                    task.run(time.perf_counter())
+            now = time.perf_counter()
+            if now >= frame_deadline:
+                break
+            deadline = min([frame_deadline] + [t.next_due for t in self.tasks])
+            if deadline > now:
+                if self._wake.wait(deadline - now):
+                    self._wake.clear()
+                    for task in self.tasks:
+                        if task.on_wake:
+                            task.next_due = 0.0
+        # a long frame pushes the next one back rather than bunching frames up
+        self.last_frame = max(frame_deadline, time.perf_counter() - interval)
+
@@ -1,11 +1,15 @@
-from formats import int_insert
+import hashlib
+from copy import copy
+
+from formats import int_insert, content_digest
 from messenger import lookup_seq_metadata
 from base64 import b64encode
 
 from mfvitools.mfvi2mml import akao_to_mml
 
 class Sequence():
-    def __init__(self, data=None, inst=None, source=None):
+    def __init__(self, data=None, inst=None, source=None, lookup=True):
+        # lookup: as for Sample
         self.data = b"\x26\x00" * 18 if data is None else data
         self.inst = {}
         if inst is None:
@@ -14,22 +18,68 @@ class Sequence():
         else:
             self.setup_inst_data(inst)
         
+        # Bumped on edits, for caches of derived views (see Project.views)
+        self.version = 0
         self.raw_mml = ""
         self.source_type = ""
         self.source_detail = None
         self.name = ""
-        lookup_seq_metadata(self)
+        if lookup:
+            lookup_seq_metadata(self)
         
         if source:
             self.set_source(*source)
         self.update_raw_mml()
         
+    @property
+    def data(self):
+        return self._data
+        
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._digest = None
+        self._meta_hash = None
+        
+    @property
+    def digest(self):
+        # Content digest of the sequence data (see Sample.digest)
+        if self._digest is None:
+            self._digest = content_digest(self._data)
+        return self._digest
+        
+    @property
+    def meta_hash(self):
+        # md5 of instrument table + data, the names database key. The
+        # instrument table is part of it, so inst changes drop it too.
+        if self._meta_hash is None:
+            self._meta_hash = hashlib.md5(self.get_inst_table() + self._data).hexdigest()
+        return self._meta_hash
+        
     def setup_inst_data(self, data):
+        self._meta_hash = None
         if len(data) < 32:
             data += b"\x00" * 32
         for i in range(16):
             self.inst[i] = int.from_bytes(data[i*2:i*2+2], "little")
         
+    def set_inst(self, slot, sample_id):
+        if self.inst[slot] != sample_id:
+            self.inst[slot] = sample_id
+            self._meta_hash = None
+            self.version += 1
+            
+    def copy(self):
+        # Shallow copy with its own instrument table (see Sample.copy)
+        seq = copy(self)
+        seq.inst = dict(self.inst)
+        return seq
+        
+    def set_name(self, name):
+        if self.name != name:
+            self.name = name
+            self.version += 1
+        
     def get_data(self):
         return (len(self.data) - 1).to_bytes(2, "little") + self.data
         
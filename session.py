@@ -0,0 +1,200 @@
+from formats import content_digest, from_rom_address
+from messenger import log, err, repr_bank
+from rom import Rom, roms
+from sample import Sample
+from sequence import Sequence
+
+# Multi-ROM comparison.
+#
+# A RomSession loads any number of ROMs into one ContentPool, which hands out
+# a single Sequence or Sample object for each distinct content, so loading a
+# ROM costs only what it doesn't share with the ones already loaded. Raw ROM
+# data isn't kept once a ROM is loaded; what's left per ROM is its tables
+# (as references into the pool) and where each item was found.
+#
+# Pooled objects keep the source (ROM location) of the first ROM they were
+# found in. Per-ROM locations are in RomSession.locations.
+
+class ContentPool():
+    def __init__(self):
+        # (data digest, instrument table) -> Sequence
+        self.sequences = {}
+        # (data digest, loop, pitch, envelope) -> Sample
+        self.samples = {}
+        self.empty = None
+        self.requests = 0
+
+    def sequence(self, data, inst, source):
+        self.requests += 1
+        key = (content_digest(data), bytes(inst))
+        seq = self.sequences.get(key)
+        if seq is None:
+            seq = Sequence(data, inst, source=source, lookup=False)
+            self.sequences[key] = seq
+        return seq
+
+    def sample(self, brr, loop, pitch, env, id, source):
+        # The BRR isn't decoded until something needs the PCM
+        self.requests += 1
+        key = (content_digest(brr), loop, pitch, bytes(env.bytes()))
+        smp = self.samples.get(key)
+        if smp is None:
+            smp = Sample(brr, loop, pitch, env, id=id, lookup=False, decode=False)
+            smp.set_source(*source)
+            self.samples[key] = smp
+        return smp
+
+    def empty_sample(self):
+        if self.empty is None:
+            self.empty = Sample(lookup=False, decode=False)
+        return self.empty
+
+    def unique(self):
+        return len(self.sequences) + len(self.samples)
+
+class RomSession():
+    def __init__(self):
+        self.pool = ContentPool()
+        # fn -> Rom, in the order loaded
+        self.roms = {}
+        # fn -> {"seq": {id: address}, "brr": {id: address}}
+        self.locations = {}
+
+    def load_steps(self, fns):
+        # Generator for a TaskRunner: loads each ROM in turn. ROMs that
+        # can't be read are reported and skipped.
+        for n, fn in enumerate(fns):
+            if fn in self.roms:
+                continue
+            yield (n, len(fns), f"Loading {fn}")
+            rom = Rom(fn)
+            if not rom.is_valid:
+                err.send(f"Skipping {fn}: not a supported ROM.")
+                roms.pop(fn, None)
+                continue
+            for _ in rom.init_steps(pool=self.pool):
+                yield None
+            self.locations[fn] = self.find_locations(rom)
+            # everything needed is in the pool now
+            roms.pop(fn, None)
+            self.roms[fn] = rom
+        log.send(f"Loaded {len(self.roms)} ROMs: {self.pool.requests} sequences and samples, "
+                f"{self.pool.unique()} distinct.")
+        yield (len(fns), len(fns), "Loaded ROMs.")
+
+    def load(self, fns):
+        for _ in self.load_steps(fns):
+            pass
+
+    def find_locations(self, rom):
+        data = rom.rom()
+
+        def pointer(table, i):
+            loc = table + i*3
+            return from_rom_address(int.from_bytes(data[loc:loc+3], "little"))
+
+        seq = {i: pointer(rom.seq_table_address, i) for i in rom.seq}
+        brr = {i: pointer(rom.brr_table_address, i-1) for i, smp in rom.brr.items()
+                if i < 256 and smp is not self.pool.empty}
+        return {"seq": seq, "brr": brr}
+
+    def diff(self, fn, ref):
+        """
+        Differences of ROM fn from ROM ref, as {"seq": [...], "brr": [...]},
+        each a list of (id, field, ref value, value) sorted by id. Fields are
+        "missing", "data", "inst" and "address" for sequences, and
+        "missing", "data", "loop", "pitch", "env" and "address" for samples.
+        For "data", the ref value is the offset of the first differing byte
+        and the value is (address, length) of the data in fn.
+        """
+        a, b = self.roms[ref], self.roms[fn]
+        la, lb = self.locations[ref], self.locations[fn]
+        report = {"seq": [], "brr": []}
+
+        for id in sorted(set(a.seq) | set(b.seq)):
+            sa, sb = a.seq.get(id), b.seq.get(id)
+            if sa is sb:
+                continue
+            if sa is None or sb is None:
+                report["seq"].append((id, "missing", sa is None, sb is None))
+                continue
+            if sa.digest != sb.digest:
+                report["seq"].append((id, "data", first_difference(sa.data, sb.data),
+                        (lb["seq"][id], len(sb.data))))
+            if sa.inst != sb.inst:
+                changed = [i for i in range(16) if sa.inst[i] != sb.inst[i]]
+                report["seq"].append((id, "inst", [sa.inst[i] for i in changed],
+                        {i: sb.inst[i] for i in changed}))
+            if la["seq"][id] != lb["seq"][id]:
+                report["seq"].append((id, "address", la["seq"][id], lb["seq"][id]))
+
+        empty = self.pool.empty
+        for id in sorted(set(a.brr) | set(b.brr)):
+            sa, sb = a.brr.get(id), b.brr.get(id)
+            if sa is sb:
+                if id in la["brr"] and la["brr"][id] != lb["brr"].get(id):
+                    report["brr"].append((id, "address", la["brr"][id], lb["brr"][id]))
+                continue
+            if sa is None or sb is None or sa is empty or sb is empty:
+                report["brr"].append((id, "missing", sa in (None, empty), sb in (None, empty)))
+                continue
+            if sa.digest != sb.digest:
+                report["brr"].append((id, "data", first_difference(sa.data, sb.data),
+                        (lb["brr"].get(id), len(sb.data))))
+            for field in ("loop", "pitch"):
+                if getattr(sa, field) != getattr(sb, field):
+                    report["brr"].append((id, field, getattr(sa, field), getattr(sb, field)))
+            if sa.env != sb.env:
+                report["brr"].append((id, "env", sa.env, sb.env))
+            if id in la["brr"] and la["brr"][id] != lb["brr"].get(id):
+                report["brr"].append((id, "address", la["brr"][id], lb["brr"][id]))
+        return report
+
+    def report(self, ref=None):
+        # Text report of how every ROM differs from ref (the first loaded,
+        # by default)
+        if not self.roms:
+            return ""
+        fns = list(self.roms)
+        ref = fns[0] if ref is None else ref
+        lines = [f"Reference: {ref}",
+                f"{len(fns)} ROMs, {self.pool.requests} sequences and samples, "
+                f"{len(self.pool.sequences)} distinct sequences, "
+                f"{len(self.pool.samples)} distinct samples", ""]
+        for fn in fns:
+            if fn == ref:
+                continue
+            diff = self.diff(fn, ref)
+            if not diff["seq"] and not diff["brr"]:
+                lines.append(f"{fn}: same songs and samples")
+                continue
+            lines.append(f"{fn}:")
+            for kind, title in (("seq", "Sequence"), ("brr", "Sample")):
+                for id, field, old, new in diff[kind]:
+                    lines.append(f"  {title} {repr_id(id)}: {describe(field, old, new)}")
+        return "\n".join(lines)
+
+def repr_id(id):
+    return f"@{id-256:X}" if id >= 256 else f"{id:02X}"
+
+def first_difference(a, b):
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    return min(len(a), len(b))
+
+def describe(field, old, new):
+    if field == "missing":
+        return "only in the reference" if new else "not in the reference"
+    if field == "data":
+        addr, length = new
+        where = f" at {repr_bank(addr)}" if addr is not None else ""
+        return f"data differs from byte ${old:X} ({length:X} bytes{where})"
+    if field == "address":
+        return f"moved from {repr_bank(old)} to {repr_bank(new)}"
+    if field == "inst":
+        return "instruments " + ", ".join(f"{i:X}: {o:02X} -> {n:02X}"
+                for o, (i, n) in zip(old, new.items()))
+    if field == "env":
+        return f"envelope {old.a},{old.d},{old.s},{old.r} -> {new.a},{new.d},{new.s},{new.r}"
+    return f"{field} {old} -> {new}"
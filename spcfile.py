@@ -0,0 +1,92 @@
+from pathlib import Path
+
+from aram import AramBudget
+from formats import load_rom_data_block, byte_insert, int_insert, FORMATS
+from messenger import err
+
+# SPC file output, kept apart from spc.py (which needs the emulator and the
+# GUI) so it can be used headless.
+
+dat_dir = Path(__file__).resolve().parent / "res"
+SPC_WORK_RAM_FILE = dat_dir / "spc_work_ram.bin"
+SPC_AUX_RAM_FILE = dat_dir / "spc_aux_ram.bin"
+
+def build_spc(prj, seqid):
+    rom = prj.src.rom()
+    format = FORMATS["ff6"]
+    seq = prj.seq[seqid]
+    
+    with open(SPC_WORK_RAM_FILE, "rb") as f:
+        work_ram = f.read()
+    with open(SPC_AUX_RAM_FILE, "rb") as f:
+        aux_ram = f.read()
+    
+    spc = bytearray(0x10100)
+    header = work_ram[:0x100]
+    
+    spc = byte_insert(spc, 0, work_ram[0x100:0x300])
+    spc = byte_insert(spc, 0x200, load_rom_data_block(rom, format.spc_engine_address))
+    
+    static_brr_data = load_rom_data_block(rom, format.spc_static_brr_address)
+    static_brr_ptr = load_rom_data_block(rom, format.spc_static_ptr_address)
+    static_brr_env = load_rom_data_block(rom, format.spc_static_env_address)
+    static_brr_pitch = load_rom_data_block(rom, format.spc_static_pitch_address)
+    
+    free_brr_offset = 0x4800 + len(static_brr_data)
+    
+    all_brr_data = bytearray(static_brr_data)
+    dyn_brr_ptr = bytearray(0x40)
+    dyn_brr_env = bytearray(0x20)
+    dyn_brr_pitch = bytearray(0x20)
+    
+    for i in range(16):
+        inst_id = seq.inst[i]
+        if inst_id:
+            brr_loop = prj.brr[inst_id].loop
+            brr_env = prj.brr[inst_id].env.bytes()
+            brr_pitch = prj.brr[inst_id].pitch.to_bytes(2, "big", signed=True)
+            inst_brr_data = prj.brr[inst_id].data
+            
+            dyn_brr_ptr = int_insert(dyn_brr_ptr, 4 * i, free_brr_offset, 2)
+            dyn_brr_ptr = int_insert(dyn_brr_ptr, 4 * i + 2, free_brr_offset + brr_loop, 2)
+            dyn_brr_env = byte_insert(dyn_brr_env, 2 * i, brr_env, 2)
+            dyn_brr_pitch = byte_insert(dyn_brr_pitch, 2 * i, brr_pitch, 2)
+            all_brr_data += inst_brr_data
+            free_brr_offset = 0x4800 + len(all_brr_data)
+            
+    budget = AramBudget(prj)
+    if free_brr_offset > budget.echo_start:
+        err.send(f"Samples for sequence {seqid:02X} overflow SPC RAM by "
+                f"${free_brr_offset - budget.echo_start:X} bytes.")
+    
+    meta = bytearray(0x200)
+    meta = byte_insert(meta, 0x000, static_brr_pitch)
+    meta = byte_insert(meta, 0x040, dyn_brr_pitch)
+    meta = byte_insert(meta, 0x080, static_brr_env)
+    meta = byte_insert(meta, 0x0C0, dyn_brr_env)
+    meta = byte_insert(meta, 0x100, static_brr_ptr)
+    meta = byte_insert(meta, 0x180, dyn_brr_ptr)
+    
+    spc = byte_insert(spc, 0x1A00, meta)
+    spc = byte_insert(spc, 0x4800, all_brr_data)
+    
+    seqdata = seq.data + b"\xEB"
+    spc = byte_insert(spc, 0x1C00, seqdata)
+    
+    address_base = int.from_bytes(seqdata[0:2], "little")
+    script_offset = 0x11C24 - address_base
+    while script_offset >= 0x10000:
+        script_offset -= 0x10000    
+    spc = int_insert(spc, 0, script_offset, 2)
+    for i in range(8):
+        loc = 4 + i * 2
+        track_start = int.from_bytes(seqdata[loc:loc+2], "little")
+        track_start -= address_base
+        track_start += 0x1C24
+        loc = 2 + i * 2
+        spc = int_insert(spc, loc, track_start, 2)
+
+    spc = byte_insert(spc, 0xF600, aux_ram)
+    
+    spc = header + spc
+    return spc
@@ -0,0 +1,147 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from messenger import err
+from profiler import profiler
+
+# Cooperative task runner for long jobs (ROM ingest, repacking, bulk imports,
+# rendering) that have to share the GUI thread.
+#
+# A task is a generator. Each yield is a point where it can be paused; what
+# it yields is one of:
+#   None                     - just a checkpoint
+#   (done, total, text)      - progress, with a status line for the UI
+#   Offload(func, *args)     - run func(*args) in the worker pool; the
+#                              generator is resumed with its return value
+# The generator's return value becomes Task.result.
+
+class Offload():
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+class Task():
+    def __init__(self, name, gen, priority=0, on_done=None):
+        self.name = name
+        self.gen = gen
+        self.priority = priority
+        self.on_done = on_done
+        self.state = "pending"
+        self.done = 0
+        self.total = 0
+        self.text = ""
+        self.result = None
+        self.future = None
+        self._order = 0
+        self.span_name = f"task: {name}"
+
+    @property
+    def finished(self):
+        return self.state in ("done", "cancelled", "failed")
+
+    @property
+    def progress(self):
+        return self.done / self.total if self.total else 0.0
+
+    def cancel(self):
+        if self.finished:
+            return
+        if self.future is not None:
+            self.future.cancel()
+        self.gen.close()
+        self.state = "cancelled"
+
+    def step(self, pool):
+        # Advance to the next yield. Returns False if waiting on the pool.
+        send = None
+        if self.future is not None:
+            if not self.future.done():
+                return False
+            future, self.future = self.future, None
+            try:
+                send = future.result()
+            except Exception as e:
+                # the generator gets to handle failures of its own offloads
+                return self.advance(self.gen.throw, e, pool=pool)
+        return self.advance(self.gen.send, send, pool=pool)
+
+    def advance(self, resume, value, pool=None):
+        self.state = "running"
+        try:
+            ret = resume(value)
+        except StopIteration as e:
+            self.result = e.value
+            self.state = "done"
+            if self.on_done:
+                self.on_done(self)
+            return True
+        except Exception as e:
+            self.state = "failed"
+            err.send(f"{self.name} failed: {e}")
+            return True
+        if isinstance(ret, Offload):
+            if pool is None:
+                try:
+                    value = ret.func(*ret.args)
+                except Exception as e:
+                    return self.advance(self.gen.throw, e)
+                return self.advance(self.gen.send, value)
+            self.future = pool.submit(ret.func, *ret.args)
+        elif isinstance(ret, tuple):
+            self.done, self.total, self.text = ret
+        return True
+
+    def __repr__(self):
+        if self.total:
+            return f"{self.name}: {self.done}/{self.total} {self.text}".strip()
+        return f"{self.name}: {self.state}"
+
+class TaskRunner():
+    def __init__(self, processes=0):
+        # processes: size of the worker pool for Offload steps; 0 runs them
+        # inline, in the slice that yields them.
+        self.processes = processes
+        self.pool = None
+        self.tasks = []
+        self._order = 0
+
+    def add(self, name, gen, priority=0, on_done=None):
+        task = Task(name, gen, priority, on_done)
+        self.tasks.append(task)
+        return task
+
+    @property
+    def busy(self):
+        return bool(self.tasks)
+
+    def get_pool(self):
+        if self.processes and self.pool is None:
+            self.pool = ProcessPoolExecutor(self.processes)
+        return self.pool
+
+    def run_slice(self, budget):
+        # Step tasks until budget (ms) runs out or none can proceed. The
+        # highest priority task goes first; equal priorities take turns.
+        deadline = time.perf_counter() + budget / 1000
+        pool = self.get_pool()
+        while self.tasks:
+            progressed = False
+            for task in sorted(self.tasks, key=lambda t: (-t.priority, t._order)):
+                with profiler.span(task.span_name):
+                    stepped = task.step(pool)
+                if stepped:
+                    self._order += 1
+                    task._order = self._order
+                    progressed = True
+                    break
+            self.tasks = [t for t in self.tasks if not t.finished]
+            if not progressed or time.perf_counter() >= deadline:
+                break
+
+    def cancel_all(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def status(self):
+        return "\n".join(repr(t) for t in sorted(self.tasks, key=lambda t: -t.priority))